@@ -0,0 +1,207 @@
+from collections.abc import Iterable
+from concurrent.futures import Future
+from dataclasses import dataclass
+import logging
+import os
+from pathlib import Path
+from queue import Queue
+import subprocess
+import tempfile
+from threading import Thread
+from time import localtime, time
+from typing import IO
+import zipfile
+
+import humanize
+
+from Backup import CompressAlgorithm, DontCompressFileExtensions, ReadCustomPathList, SubmitBackupTask
+from Checksum import MultiHash
+from CompressionPolicy import ChooseCompression, ChooseStreamCompression
+from ProcessTimer import MeasureExecutionTime, RecordStageBytes, WaitForChildProcess
+
+ArchiveCopyChunkSize: int = 1024 * 1024
+
+@dataclass
+class ArchiveTask:
+    Kind: str
+    Source: Path | IO[bytes]
+    ArcName: str
+    Result: Future
+
+@dataclass
+class ArchiveTaskStatistics:
+    Kind: str
+    ArcName: str
+    BytesIn: int = 0
+    BytesOut: int = 0
+    Seconds: float = 0
+
+class ArchiveBuilder:
+    def __init__(self, ArchiveFileName: str, QueueSize: int = 64, OutputFile: IO[bytes] | None = None):
+        self.ArchiveFileName = ArchiveFileName
+        self.OutputFile = OutputFile
+        self.TaskQueue: Queue[ArchiveTask | None] = Queue(maxsize=QueueSize)
+        self.Checksums: dict[str, dict[str, str]] = {}
+        self.Statistics: list[ArchiveTaskStatistics] = []
+        self.StartTime = time()
+        self.ZipFile = zipfile.ZipFile(OutputFile or ArchiveFileName, "w", CompressAlgorithm, compresslevel=6)
+        self.WriterThread = Thread(target=self.RunWriter, daemon=True)
+        self.WriterThread.start()
+
+    def Submit(self, Kind: str, Source: Path | IO[bytes], ArcName: str) -> Future:
+        Result: Future = Future()
+        self.TaskQueue.put(ArchiveTask(Kind, Source, ArcName, Result))
+        return Result
+
+    def AddFile(self, FilePath: Path, ArcName: str) -> Future:
+        return self.Submit("File", FilePath, ArcName)
+
+    def AddDirectory(self, Directory: Path, Prefix: str) -> Future:
+        return self.Submit("Directory", Directory, Prefix)
+
+    def SpoolStream(self, Chunks: Iterable[bytes]) -> IO[bytes]:
+        # 归档只有一个写入线程，边读边写会让其他数据库备份和目录都等着这一个备份进程；先在调用者的线程中暂存到归档所在目录的临时文件，读完后再交给写入线程压缩
+        SpoolFile = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.ArchiveFileName)))
+        try:
+            for DataChunk in Chunks:
+                SpoolFile.write(DataChunk)
+            SpoolFile.seek(0)
+        except BaseException:
+            SpoolFile.close()
+            raise
+        return SpoolFile
+
+    def AddStream(self, ArcName: str, Chunks: Iterable[bytes]) -> Future:
+        return self.Submit("Stream", self.SpoolStream(Chunks), ArcName)
+
+    def RunWriter(self):
+        while (Task := self.TaskQueue.get()) is not None:
+            Statistics = ArchiveTaskStatistics(Task.Kind, Task.ArcName)
+            StartTime = time()
+            try:
+                if Task.Kind == "Directory":
+                    assert isinstance(Task.Source, Path)
+                    self.WriteDirectory(Task.Source, Task.ArcName, Statistics)
+                elif Task.Kind == "File":
+                    assert isinstance(Task.Source, Path)
+                    self.WriteFile(Task.Source, Task.ArcName, Statistics)
+                else:
+                    assert not isinstance(Task.Source, Path)
+                    self.WriteStream(Task.Source, Task.ArcName, Statistics)
+            except Exception as Error:
+                logging.error(f"写入归档成员 {Task.ArcName} 失败：{Error}")
+                Task.Result.set_exception(Error)
+                continue
+            Statistics.Seconds = time() - StartTime
+            self.Statistics.append(Statistics)
+            Task.Result.set_result(Statistics)
+
+    def WriteMember(self, Info: zipfile.ZipInfo, Chunks: Iterable[bytes], Statistics: ArchiveTaskStatistics, ForceZip64: bool = False):
+        Hash = MultiHash()
+        with self.ZipFile.open(Info, "w", force_zip64=ForceZip64) as Member:
+            for DataChunk in Chunks:
+                Hash.update(DataChunk)
+                Member.write(DataChunk)
+                Statistics.BytesIn += len(DataChunk)
+        Statistics.BytesOut += Info.compress_size
+        self.Checksums[Info.filename] = Hash.Digests()
+
+    def WriteFile(self, FilePath: Path, ArcName: str, Statistics: ArchiveTaskStatistics):
+        Info = zipfile.ZipInfo.from_file(FilePath, ArcName)
+        Decision = ChooseCompression(str(FilePath), FilePath.stat(), CompressAlgorithm, DontCompressFileExtensions)
+        Info.compress_type = Decision.Method
+        Info.compress_level = Decision.Level
+        with open(FilePath, "rb") as DataFile:
+            self.WriteMember(Info, iter(lambda: DataFile.read(ArchiveCopyChunkSize), b""), Statistics)
+
+    def WriteDirectory(self, Directory: Path, Prefix: str, Statistics: ArchiveTaskStatistics):
+        for FolderName, SubFolders, FileNames in os.walk(Directory):
+            for FileName in FileNames:
+                FilePath = os.path.join(FolderName, FileName)
+                self.WriteFile(Path(FilePath), f"{Prefix}/{os.path.relpath(FilePath, Directory)}", Statistics)
+
+    def WriteStream(self, SpoolFile: IO[bytes], ArcName: str, Statistics: ArchiveTaskStatistics):
+        Info = zipfile.ZipInfo(ArcName, date_time=localtime()[:6])
+        Decision = ChooseStreamCompression(ArcName, CompressAlgorithm, os.fstat(SpoolFile.fileno()).st_size)
+        Info.compress_type = Decision.Method
+        Info.compress_level = Decision.Level
+        Info.external_attr = 0o600 << 16
+        with SpoolFile:
+            self.WriteMember(Info, iter(lambda: SpoolFile.read(ArchiveCopyChunkSize), b""), Statistics, ForceZip64=True)
+
+    def Close(self, ChecksumFileName: Path):
+        self.TaskQueue.put(None)
+        self.WriterThread.join()
+        for Algorithm in MultiHash().Digests():
+            Lines = [f"{ArcName}: {Digests[Algorithm]}\n" for ArcName, Digests in sorted(self.Checksums.items())]
+            self.ZipFile.writestr(str(ChecksumFileName) if Algorithm == "sha256" else f"{Algorithm}.txt", "".join(Lines))
+        self.ZipFile.close()
+        if self.OutputFile is not None:
+            self.OutputFile.flush()
+        self.ReportSavings()
+
+    def ReportSavings(self):
+        ElapsedSeconds = time() - self.StartTime
+        ArchiveSize = os.path.getsize(self.ArchiveFileName)
+        # 旧流程先把每个来源写成独立的zip（数据库为未压缩的.sql），之后再读回来打包进最终归档并计算SHA256
+        IntermediateBytes = sum(Item.BytesIn if Item.Kind == "Stream" else Item.BytesOut for Item in self.Statistics)
+        RecompressSeconds = sum(Item.Seconds for Item in self.Statistics if Item.Kind == "Stream")
+        CopySeconds = sum(Item.BytesOut for Item in self.Statistics if Item.Kind != "Stream") / (ArchiveSize / ElapsedSeconds) if ArchiveSize > 0 and ElapsedSeconds > 0 else 0
+        logging.info(f"单次打包完成：{self.ArchiveFileName}，大小：{humanize.naturalsize(ArchiveSize)}，耗时：{humanize.naturaldelta(ElapsedSeconds)}")
+        logging.info(f"与旧流程相比，估计少写入磁盘 {humanize.naturalsize(IntermediateBytes)}，少读取磁盘 {humanize.naturalsize(IntermediateBytes * 2)}")
+        logging.info(f"与旧流程相比，估计节省时间 {humanize.precisedelta(RecompressSeconds + CopySeconds)}")
+
+@MeasureExecutionTime("备份数据库进归档", Label=lambda *args, **kwargs: args[4])
+def BackupDatabaseIntoArchive(Builder: ArchiveBuilder, ShellCommand: list[str], MemberName: str, ErrorLogFileName: str, DatabaseName: str, RunAsUser: str | None = None):
+    logging.info(f"正在将数据库直接备份进归档：{DatabaseName}")
+    try:
+        with tempfile.TemporaryFile() as ErrorLogFile:
+            with subprocess.Popen(
+                    args=ShellCommand,
+                    stdout=subprocess.PIPE,
+                    stderr=ErrorLogFile,
+                    user=RunAsUser) as DumpProcess:
+                assert DumpProcess.stdout is not None
+                SpoolFile = Builder.SpoolStream(iter(lambda: DumpProcess.stdout.read(ArchiveCopyChunkSize), b"")) # type: ignore
+                WaitForChildProcess(DumpProcess)
+            logging.debug(f"{ShellCommand}的返回值：{DumpProcess.returncode}")
+            ErrorLogFile.seek(0)
+            if Contents := ErrorLogFile.read():
+                logging.error(f"{DatabaseName}备份时输出了错误信息。")
+                logging.debug(f"{ShellCommand}输出的StdErr：{Contents.decode('utf-8')}")
+                Builder.AddStream(ErrorLogFileName, [Contents]).result()
+                logging.info(f"{DatabaseName}错误日志已保存进归档：{ErrorLogFileName}")
+            # 不完整的导出不能写进归档，否则看起来像是一份可用的备份
+            if DumpProcess.returncode != 0:
+                SpoolFile.close()
+                logging.error(f"{DatabaseName}备份失败，{ShellCommand[0]}的返回值为{DumpProcess.returncode}。")
+                raise RuntimeError(f"{ShellCommand[0]}的返回值为{DumpProcess.returncode}")
+            Statistics: ArchiveTaskStatistics = Builder.Submit("Stream", SpoolFile, MemberName).result()
+            logging.info(f"{DatabaseName}备份成功，原始大小：{humanize.naturalsize(Statistics.BytesIn)}，压缩后大小：{humanize.naturalsize(Statistics.BytesOut)}")
+            RecordStageBytes(Statistics.BytesIn, Statistics.BytesOut)
+    except FileNotFoundError as Exception:
+        logging.error(f"由于可执行文件{ShellCommand[0]}不存在，无法备份{DatabaseName}。")
+        logging.debug(f"异常信息：{Exception}")
+        raise
+    except PermissionError as Exception:
+        logging.error(f"由于权限不足，故无法备份{DatabaseName}。请切换到root或使用sudo重试。")
+        logging.debug(f"异常信息：{Exception}")
+        raise
+    finally:
+        logging.info(f"{DatabaseName}数据库备份操作已完成。")
+
+def AddFileIntoArchive(Builder: ArchiveBuilder, FilePath: Path, ArcName: str):
+    # 作为备份任务提交并等待写入完成，写入失败时由任务调度器计入失败的备份任务
+    Builder.AddFile(FilePath, ArcName).result()
+
+def AddDirectoryIntoArchive(Builder: ArchiveBuilder, Directory: Path, Prefix: str):
+    Builder.AddDirectory(Directory, Prefix).result()
+
+def BackupCustomPathIntoArchive(Builder: ArchiveBuilder, PathListFile: Path):
+    for BackupPath in ReadCustomPathList(PathListFile):
+        if BackupPath.is_file():
+            logging.info(f"正在备份自定义文件：{BackupPath}")
+            SubmitBackupTask(BackupPath.name, "io", BackupPath, AddFileIntoArchive, Builder, BackupPath, BackupPath.name)
+        elif BackupPath.is_dir():
+            logging.info(f"正在备份自定义目录：{BackupPath}")
+            SubmitBackupTask(BackupPath.name, "io", BackupPath, AddDirectoryIntoArchive, Builder, BackupPath, BackupPath.name)
@@ -1,20 +1,32 @@
+from collections.abc import Callable
 from concurrent.futures import ThreadPoolExecutor
-import hashlib
 import logging
 import os
 from pathlib import Path
-import shutil
 import subprocess
-from threading import Lock
+from typing import IO
 import zipfile
 
 import humanize
 
-from ProcessTimer import MeasureExecutionTime
+from Checksum import CopyFileWithChecksum, HashingWriter, Manifest, MultiHash
+from CompressionPolicy import ChooseCompression, ChooseStreamCompression
+from Incremental import FileIndex, IncrementalZipDirectoryTree
+from ParallelZip import ParallelZipDirectoryTree
+from ProcessTimer import MeasureExecutionTime, RecordStageBytes, WaitForChildProcess
+from TaskScheduler import BackupTask, BackupTaskScheduler
 
-ZipWorker = ThreadPoolExecutor()
+TaskLaneWorkers: dict[str, int] = {"cpu": os.cpu_count() or 1, "io": 4}
+DeviceJobs: int | None = None
+TaskDestination: Path | None = None
+TaskScheduler = BackupTaskScheduler(TaskLaneWorkers, DeviceJobs)
+CompressionWorkers: int = 1
+CompressionPool: ThreadPoolExecutor | None = None
+IncrementalIndex: FileIndex | None = None
+IncrementalArchiveName: str = ""
+IncrementalFullBackup: bool = True
 DontCompressFileExtensions = (".mp4", ".mkv", ".zip", ".tar.gz")
-SHA256ResultFileLock: Lock = Lock()
+DatabaseDumpStreamChunkSize: int = 1024 * 1024
 CompressAlgorithm: int
 try:
     CompressAlgorithm = zipfile.ZIP_ZSTANDARD
@@ -23,13 +35,61 @@ except AttributeError:
     CompressAlgorithm = zipfile.ZIP_DEFLATED
     logging.warning("您使用的Python运行时不支持Zstd，将使用Deflate进行压缩，建议升级到Python 3.14或更高版本以获得更好的压缩性能")
 
-def ZipDirectoryTree(ZipFileName: str, TargetDirectory: Path):
+def ConfigureCompressionWorkers(Workers: int):
+    global CompressionWorkers, CompressionPool
+    CompressionWorkers = max(Workers, 1)
+    if CompressionWorkers > 1:
+        CompressionPool = ThreadPoolExecutor(max_workers=CompressionWorkers, thread_name_prefix="Compression")
+        logging.info(f"已启用并行压缩，压缩线程数：{CompressionWorkers}")
+
+def ConfigureIncrementalBackup(Index: FileIndex, ArchiveName: str, FullBackup: bool):
+    global IncrementalIndex, IncrementalArchiveName, IncrementalFullBackup
+    IncrementalIndex = Index
+    IncrementalArchiveName = ArchiveName
+    IncrementalFullBackup = FullBackup
+    logging.info(f"已启用增量备份，本次备份类型：{'完整备份' if FullBackup else '增量备份'}")
+
+def ConfigureTaskScheduler(CPUJobs: int, IOJobs: int, DeviceJobsLimit: int | None, Destination: Path | None = None):
+    global DeviceJobs, TaskDestination, TaskScheduler
+    TaskLaneWorkers.update({"cpu": CPUJobs, "io": IOJobs})
+    DeviceJobs = DeviceJobsLimit
+    TaskDestination = Destination
+    TaskScheduler = BackupTaskScheduler(TaskLaneWorkers, DeviceJobs, TaskDestination)
+    logging.info(f"备份任务调度：CPU通道 {CPUJobs} 个线程，IO通道 {IOJobs} 个线程，每个设备的并发数：{'机械硬盘为1，其余不限' if DeviceJobs is None else (DeviceJobs or '不限')}")
+
+def SubmitBackupTask(Name: str, Lane: str, Source: Path | None, Function: Callable, *args) -> BackupTask:
+    # Lane为cpu（压缩）或io（复制文件、等待数据库备份进程）；Source是要读取的文件或目录，用于按设备限制并发和估计任务大小
+    return TaskScheduler.Submit(Name, Lane, Source, Function, *args)
+
+def WaitForBackupTasks() -> list[BackupTask]:
+    # 守护进程模式下同一个进程会进行多次备份，等本次的任务全部结束后换一个新的调度器供下次使用
+    global TaskScheduler
+    FailedTasks = TaskScheduler.Wait()
+    TaskScheduler = BackupTaskScheduler(TaskLaneWorkers, DeviceJobs, TaskDestination)
+    return FailedTasks
+
+@MeasureExecutionTime("压缩目录", Label=lambda ZipFileName, TargetDirectory: TargetDirectory)
+def ZipSourceDirectory(ZipFileName: str, TargetDirectory: Path):
+    with open(ZipFileName, "wb") as ZipOutputFile:
+        Writer = HashingWriter(ZipOutputFile)
+        if IncrementalIndex is not None:
+            IncrementalZipDirectoryTree(ZipFileName, TargetDirectory, IncrementalIndex, IncrementalArchiveName, IncrementalFullBackup, CompressAlgorithm, DontCompressFileExtensions, Writer)
+        else:
+            ZipDirectoryTree(Writer, TargetDirectory)
+    Manifest.Record(ZipFileName, Writer.Hash)
+
+def ZipDirectoryTree(ZipFileName: str | IO[bytes], TargetDirectory: Path):
+    if CompressionPool is not None:
+        Entries = ParallelZipDirectoryTree(ZipFileName, TargetDirectory, CompressionPool, CompressionWorkers, CompressAlgorithm, DontCompressFileExtensions)
+        RecordStageBytes(sum(Entry.FileSize for Entry in Entries), sum(Entry.CompressSize for Entry in Entries))
+        return
     with zipfile.ZipFile(ZipFileName, "w", CompressAlgorithm) as ZipFile:
         for FolderName, SubFolders, FileNames in os.walk(TargetDirectory):
             for FileName in FileNames:
                 FilePath = os.path.join(FolderName, FileName)
-                CompressLevel = 0 if FileName.endswith( DontCompressFileExtensions ) else 6
-                ZipFile.write(FilePath, arcname=os.path.relpath(FilePath, TargetDirectory), compresslevel=CompressLevel)                    
+                Decision = ChooseCompression(FilePath, os.stat(FilePath), CompressAlgorithm, DontCompressFileExtensions)
+                ZipFile.write(FilePath, arcname=os.path.relpath(FilePath, TargetDirectory), compress_type=Decision.Method, compresslevel=Decision.Level)
+    RecordStageBytes(sum(Info.file_size for Info in ZipFile.infolist()), sum(Info.compress_size for Info in ZipFile.infolist()))
 
 def LogDirectoryTree(RootDirectory: Path, Prefix: str= ""):
     Entries = sorted(RootDirectory.iterdir())
@@ -40,81 +100,150 @@ def LogDirectoryTree(RootDirectory: Path, Prefix: str= ""):
             Extension = "    " if Index == len(Entries) - 1 else "│   "
             LogDirectoryTree(Entry, Prefix + Extension)
 
+@MeasureExecutionTime("备份数据库", Label=lambda *args, **kwargs: args[3])
 def BackupDatabase(ShellCommand: list[str], OutputFileName: str, ErrorLogFileName: str, DatabaseName: str, RunAsUser: str | None = None):
     logging.info(f"正在备份数据库：{DatabaseName}")
+    Succeeded = False
     try:
         with open(OutputFileName, "bw+") as OutputFile, open(ErrorLogFileName, "bw+") as ErrorLogFile:
-            DatabaseDumpResult = subprocess.run(
-                args=ShellCommand,
-                stdout=OutputFile,
-                stderr=ErrorLogFile,
-                user=RunAsUser)
-            logging.debug(f"{ShellCommand}的返回值：{DatabaseDumpResult.returncode}")
-            if DatabaseDumpResult.returncode == 0:
-                logging.info(f"{DatabaseName}备份成功。")
-                logging.info(f"{DatabaseName}备份文件已保存：{OutputFileName}")
-                logging.info(f"{DatabaseName}备份文件大小：{humanize.naturalsize(os.path.getsize(OutputFileName))}")
+            Writer = HashingWriter(OutputFile)
+            with subprocess.Popen(
+                    args=ShellCommand,
+                    stdout=subprocess.PIPE,
+                    stderr=ErrorLogFile,
+                    user=RunAsUser) as DatabaseDumpResult:
+                assert DatabaseDumpResult.stdout is not None
+                while DataChunk := DatabaseDumpResult.stdout.read(DatabaseDumpStreamChunkSize):
+                    Writer.write(DataChunk)
+                WaitForChildProcess(DatabaseDumpResult)
+        logging.debug(f"{ShellCommand}的返回值：{DatabaseDumpResult.returncode}")
+        if DatabaseDumpResult.returncode != 0:
+            logging.error(f"{DatabaseName}备份失败，{ShellCommand[0]}的返回值为{DatabaseDumpResult.returncode}。")
+            raise RuntimeError(f"{ShellCommand[0]}的返回值为{DatabaseDumpResult.returncode}")
+        Succeeded = True
+        if Writer.Hash.Size > 0:
+            Manifest.Record(OutputFileName, Writer.Hash)
+        logging.info(f"{DatabaseName}备份成功。")
+        logging.info(f"{DatabaseName}备份文件已保存：{OutputFileName}")
+        logging.info(f"{DatabaseName}备份文件大小：{humanize.naturalsize(os.path.getsize(OutputFileName))}")
+        RecordStageBytes(os.path.getsize(OutputFileName), os.path.getsize(OutputFileName))
     except FileNotFoundError as Exception:
-        logging.error(f"由于可执行文件{ShellCommand[0]}不存在，故跳过对{DatabaseName}的备份。")
+        logging.error(f"由于可执行文件{ShellCommand[0]}不存在，无法备份{DatabaseName}。")
         logging.debug(f"异常信息：{Exception}")
+        raise
     except PermissionError as Exception:
         logging.error(f"由于权限不足，故无法备份{DatabaseName}。请切换到root或使用sudo重试。")
         logging.debug(f"异常信息：{Exception}")
+        raise
     finally:
-        if os.path.getsize(ErrorLogFileName) == 0:
+        if os.path.exists(ErrorLogFileName) and os.path.getsize(ErrorLogFileName) == 0:
             os.remove(ErrorLogFileName)
-        else:
-            logging.error(f"{DatabaseName}备份失败。")
+        elif os.path.exists(ErrorLogFileName):
+            logging.error(f"{DatabaseName}备份时输出了错误信息。")
             with open(ErrorLogFileName, "br") as ErrorLogFile:
                 Contents = ErrorLogFile.read().decode("utf-8")
                 logging.debug(f"{ShellCommand}输出的StdErr：{Contents}")
                 logging.info(f"{DatabaseName}错误日志已保存：{ErrorLogFileName}")
-        if os.path.getsize(OutputFileName) == 0:
+        # 不完整的备份文件不能被打包和上传，否则看起来像是一份可用的备份
+        if os.path.exists(OutputFileName) and (Succeeded == False or os.path.getsize(OutputFileName) == 0):
             os.remove(OutputFileName)
         logging.info(f"{DatabaseName}数据库备份操作已完成。")
 
+@MeasureExecutionTime("流式备份数据库", Label=lambda *args, **kwargs: args[4])
+def BackupDatabaseStream(ShellCommand: list[str], ArchiveFileName: str, MemberName: str, ErrorLogFileName: str, DatabaseName: str, RunAsUser: str | None = None):
+    logging.info(f"正在以流式模式备份数据库：{DatabaseName}")
+    MemberHash = MultiHash()
+    DumpedSize = 0
+    Succeeded = False
+    try:
+        with open(ErrorLogFileName, "bw+") as ErrorLogFile, open(ArchiveFileName, "wb") as ArchiveOutputFile:
+            Writer = HashingWriter(ArchiveOutputFile)
+            # 边导出边压缩，事先不知道大小，按导出文件通常很大来选择压缩级别
+            Decision = ChooseStreamCompression(MemberName, CompressAlgorithm)
+            with zipfile.ZipFile(Writer, "w", Decision.Method, compresslevel=Decision.Level) as ArchiveFile:
+                with subprocess.Popen(
+                        args=ShellCommand,
+                        stdout=subprocess.PIPE,
+                        stderr=ErrorLogFile,
+                        user=RunAsUser) as DumpProcess, ArchiveFile.open(MemberName, "w", force_zip64=True) as Member:
+                    assert DumpProcess.stdout is not None
+                    while DataChunk := DumpProcess.stdout.read(DatabaseDumpStreamChunkSize):
+                        MemberHash.update(DataChunk)
+                        Member.write(DataChunk)
+                        DumpedSize += len(DataChunk)
+                    WaitForChildProcess(DumpProcess)
+        logging.debug(f"{ShellCommand}的返回值：{DumpProcess.returncode}")
+        if DumpProcess.returncode != 0:
+            logging.error(f"{DatabaseName}备份失败，{ShellCommand[0]}的返回值为{DumpProcess.returncode}。")
+            raise RuntimeError(f"{ShellCommand[0]}的返回值为{DumpProcess.returncode}")
+        Succeeded = True
+        logging.info(f"{DatabaseName}备份成功。")
+        logging.info(f"{DatabaseName}备份文件已保存：{ArchiveFileName}")
+    except FileNotFoundError as Exception:
+        logging.error(f"由于可执行文件{ShellCommand[0]}不存在，无法备份{DatabaseName}。")
+        logging.debug(f"异常信息：{Exception}")
+        raise
+    except PermissionError as Exception:
+        logging.error(f"由于权限不足，故无法备份{DatabaseName}。请切换到root或使用sudo重试。")
+        logging.debug(f"异常信息：{Exception}")
+        raise
+    finally:
+        if os.path.exists(ErrorLogFileName) and os.path.getsize(ErrorLogFileName) == 0:
+            os.remove(ErrorLogFileName)
+        elif os.path.exists(ErrorLogFileName):
+            logging.error(f"{DatabaseName}备份时输出了错误信息。")
+            with open(ErrorLogFileName, "br") as ErrorLogFile:
+                Contents = ErrorLogFile.read().decode("utf-8")
+                logging.debug(f"{ShellCommand}输出的StdErr：{Contents}")
+                logging.info(f"{DatabaseName}错误日志已保存：{ErrorLogFileName}")
+        if Succeeded == False or DumpedSize == 0:
+            if os.path.exists(ArchiveFileName):
+                os.remove(ArchiveFileName)
+        else:
+            Manifest.Record(f"{ArchiveFileName}/{MemberName}", MemberHash)
+            Manifest.Record(ArchiveFileName, Writer.Hash)
+            RecordStageBytes(DumpedSize, os.path.getsize(ArchiveFileName))
+            logging.info(f"{DatabaseName}备份原始大小：{humanize.naturalsize(DumpedSize)}，压缩后大小：{humanize.naturalsize(os.path.getsize(ArchiveFileName))}")
+        logging.info(f"{DatabaseName}数据库备份操作已完成。")
+
 def BackupWebsite(WebsiteLocation: Path, WebsiteZipFileName: str):
-    ZipWorker.submit(ZipDirectoryTree, WebsiteZipFileName, WebsiteLocation)
+    SubmitBackupTask(WebsiteZipFileName, "cpu", WebsiteLocation, ZipSourceDirectory, WebsiteZipFileName, WebsiteLocation)
 
 def BackupCertbot(CertbotLocation: Path, CertbotZipFileName: str):
-    ZipWorker.submit(ZipDirectoryTree, CertbotZipFileName, CertbotLocation)
-
-def ComputeSingleFileSHA256(FileName: Path, ResultFile: Path):
-    SHA256 = hashlib.sha256()
-    with open(FileName, "rb") as DataFile:
-            while DataChunk := DataFile.read(65536):
-                SHA256.update(DataChunk)
-    with SHA256ResultFileLock, open(ResultFile, "a", encoding="utf-8") as ChecksumFile:
-        ChecksumFile.write(f"{FileName}: {SHA256.hexdigest()}\n")
+    SubmitBackupTask(CertbotZipFileName, "cpu", CertbotLocation, ZipSourceDirectory, CertbotZipFileName, CertbotLocation)
 
+@MeasureExecutionTime("计算SHA256校验和")
 def GenerateSHA256Checksum(ChecksumFileName: Path, Directory: Path = Path(".")):
-    ChecksumWorker = ThreadPoolExecutor()
-    Files = [File for File in Directory.iterdir() if File.is_file()]
-    for FileName in Files:
-        ChecksumWorker.submit(ComputeSingleFileSHA256, FileName, ChecksumFileName)
-    ChecksumWorker.shutdown(wait=True)
+    # 绝大多数文件的校验和已经在写入时算好，这里只补算外部程序直接写出的文件，然后一次性按顺序写出清单
+    Manifest.Write(ChecksumFileName, Directory)
 
-def BackupCustomPath(PathListFile: Path):
+def ReadCustomPathList(PathListFile: Path) -> list[Path]:
     if PathListFile.exists() == False:
         logging.warning(f"自定义路径列表文件 {PathListFile} 不存在，跳过自定义路径备份。")
-        return
+        return []
     Paths: list[Path] = []
     with open(PathListFile, "rt", encoding="utf-8") as File:
         Paths = [Path(Line.strip()) for Line in File.readlines() if Line.strip() != "" and Line.strip().startswith("#") == False]
     if len(Paths) == 0:
         logging.info("自定义路径列表文件中没有有效条目，跳过自定义路径备份。")
-        return
+        return []
+    ExistingPaths: list[Path] = []
     for BackupPath in Paths:
         if BackupPath.exists() == False:
             logging.warning(f"自定义路径 {BackupPath} 不存在，跳过对该条目的备份。")
             continue
+        ExistingPaths.append(BackupPath)
+    return ExistingPaths
+
+def BackupCustomPath(PathListFile: Path):
+    for BackupPath in ReadCustomPathList(PathListFile):
         if BackupPath.is_file():
             logging.info(f"正在备份自定义文件：{BackupPath}")
-            ZipWorker.submit(shutil.copy, BackupPath, os.getcwd())
+            SubmitBackupTask(BackupPath.name, "io", BackupPath, CopyFileWithChecksum, BackupPath, Path(BackupPath.name), Manifest)
         elif BackupPath.is_dir():
             logging.info(f"正在备份自定义目录：{BackupPath}")
-            ZipWorker.submit(ZipDirectoryTree, f"{BackupPath.name}.zip", BackupPath)
+            SubmitBackupTask(f"{BackupPath.name}.zip", "cpu", BackupPath, ZipSourceDirectory, f"{BackupPath.name}.zip", BackupPath)
 
 @MeasureExecutionTime(StageName="打包所有文件")
-def PackAllFiles(ZipFileName: str, Directory: Path):
+def PackAllFiles(ZipFileName: str | IO[bytes], Directory: Path):
     ZipDirectoryTree(ZipFileName, Directory)
\ No newline at end of file
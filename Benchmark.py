@@ -0,0 +1,297 @@
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+import json
+import logging
+import os
+from pathlib import Path
+import random
+import shutil
+import subprocess
+import sys
+import zipfile
+
+import humanize
+
+from PrepareBackup import GetIntegerArgumentValue, GetPassArgumentValue, ParseSize
+
+BenchmarkBucketName: str = "benchmark"
+DatasetMarkerName: str = ".Dataset.json"
+DatasetWriteSize: int = 1024 * 1024
+DatasetScales: dict[str, dict[str, int]] = {
+    "tiny": {"SmallFiles": 200, "MediaFiles": 2, "MediaSize": 8 * 1024 ** 2, "SQLSize": 16 * 1024 ** 2},
+    "small": {"SmallFiles": 2000, "MediaFiles": 2, "MediaSize": 64 * 1024 ** 2, "SQLSize": 256 * 1024 ** 2},
+    "full": {"SmallFiles": 20000, "MediaFiles": 3, "MediaSize": 2 * 1024 ** 3, "SQLSize": 4 * 1024 ** 3} }
+CompressAlgorithms: dict[str, int | None] = {
+    "stored": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+    "zstd": getattr(zipfile, "ZIP_ZSTANDARD", None) }
+StageNames: dict[str, str] = {
+    "website": "压缩目录",
+    "media": "压缩目录",
+    "sql": "流式备份数据库",
+    "upload": "上传备份文件",
+    "stream-upload": "流式上传备份文件",
+    "resumable-upload": "可续传上传备份文件" }
+UploadStages: tuple[str, ...] = ("upload", "stream-upload", "resumable-upload")
+Vocabulary: list[str] = ("echo return function class public private static array string int foreach if else while include require "
+    "div span section article header footer nav table tr td ul li href src title content user post comment session config "
+    "wp_query get_option esc_html apply_filters add_action the_content mysqli_query SELECT FROM WHERE").split()
+
+@dataclass
+class BenchmarkConfiguration:
+    Stage: str
+    Algorithm: str = "deflate"
+    Workers: int = 1
+    ChunkSize: int = 0
+    Concurrency: int = 0
+
+    def Name(self) -> str:
+        if self.Stage in UploadStages:
+            return f"{self.Stage} chunk={humanize.naturalsize(self.ChunkSize)} concurrency={self.Concurrency}"
+        return f"{self.Stage} {self.Algorithm} workers={self.Workers}"
+
+@dataclass
+class BenchmarkResult:
+    Configuration: BenchmarkConfiguration
+    WallSeconds: float
+    CPUSeconds: float
+    BytesIn: int
+    BytesOut: int
+    PeakRSS: int
+
+    def Throughput(self) -> float:
+        return self.BytesIn / self.WallSeconds if self.WallSeconds > 0 else 0
+
+    def CompressionRatio(self) -> float | None:
+        return self.BytesOut / self.BytesIn if self.BytesIn > 0 else None
+
+def RandomText(Random: random.Random, Size: int) -> str:
+    Words: list[str] = []
+    Length = 0
+    while Length < Size:
+        Word = Random.choice(Vocabulary) if Random.random() < 0.8 else str(Random.randrange(100000))
+        Words.append(Word)
+        Length += len(Word) + 1
+    return " ".join(Words)
+
+def GenerateSmallFiles(Directory: Path, Random: random.Random, Count: int):
+    for Index in range(Count):
+        FilePath = Directory / f"wp-content{Index % 20}" / f"module{Index % 200}" / f"page{Index}.{Random.choice(('php', 'html', 'css', 'js'))}"
+        FilePath.parent.mkdir(parents=True, exist_ok=True)
+        Body = RandomText(Random, Random.randrange(512, 32 * 1024))
+        FilePath.write_text(f"<?php\n/* {FilePath.name} */\n{Body}\n?>\n" if FilePath.suffix == ".php" else f"<html><body>\n{Body}\n</body></html>\n")
+
+def GenerateMediaFiles(Directory: Path, Random: random.Random, Count: int, Size: int):
+    # 随机字节无法压缩，和真实的视频文件一样走DontCompressFileExtensions的不压缩路径
+    Directory.mkdir(parents=True, exist_ok=True)
+    for Index in range(Count):
+        with open(Directory / f"video{Index}{('.mp4', '.mkv')[Index % 2]}", "wb") as MediaFile:
+            for Offset in range(0, Size, DatasetWriteSize):
+                MediaFile.write(Random.randbytes(min(DatasetWriteSize, Size - Offset)))
+
+def GenerateSQLDump(FilePath: Path, Random: random.Random, Size: int):
+    # 先生成一批不同的INSERT语句再随机抽取拼接，生成几GB的文本时不必逐行调用随机数
+    FilePath.parent.mkdir(parents=True, exist_ok=True)
+    Lines = [f"INSERT INTO `wp_posts` VALUES ({Index},1,'2024-01-{Index % 28 + 1:02d} 12:00:00','{RandomText(Random, Random.randrange(40, 400))}','publish');\n" for Index in range(65536)]
+    Written = 0
+    with open(FilePath, "wt", encoding="utf-8") as SQLFile:
+        SQLFile.write("-- MySQL dump\nCREATE TABLE `wp_posts` (`ID` bigint, `post_author` bigint, `post_date` datetime, `post_content` longtext, `post_status` varchar(20));\n")
+        while Written < Size:
+            Block = "".join(Random.choices(Lines, k=2048))
+            SQLFile.write(Block)
+            Written += len(Block)
+
+def GenerateDataset(Directory: Path, Scale: str, Seed: int):
+    Parameters = DatasetScales[Scale] | {"Seed": Seed}
+    MarkerPath = Directory / DatasetMarkerName
+    if MarkerPath.exists() and json.loads(MarkerPath.read_text()) == Parameters:
+        logging.info(f"使用已生成的测试数据：{Directory}")
+        return
+    shutil.rmtree(Directory, ignore_errors=True)
+    Directory.mkdir(parents=True)
+    logging.info(f"正在生成测试数据（{Scale}）：{Directory}")
+    Random = random.Random(Seed)
+    GenerateSmallFiles(Directory / "Website", Random, Parameters["SmallFiles"])
+    GenerateMediaFiles(Directory / "Media", Random, Parameters["MediaFiles"], Parameters["MediaSize"])
+    GenerateSQLDump(Directory / "SQL" / "Dump.sql", Random, Parameters["SQLSize"])
+    MarkerPath.write_text(json.dumps(Parameters))
+
+def GetNumberListArgumentValue(Name: str, Default: str, Parse: Callable[[str], float], Minimum: float) -> list:
+    Values = []
+    for Text in GetPassArgumentValue(Name, Default).split(","): # type: ignore
+        try:
+            Value = Parse(Text)
+        except ValueError:
+            Value = None
+        if Value is None or Value < Minimum:
+            logging.fatal(f"用法：{Name}=N[,N...]，N应为不小于{Minimum}的数，当前值为：{Text}")
+            sys.exit(1)
+        Values.append(Value)
+    return Values
+
+def BuildConfigurations(Stages: list[str], Algorithms: list[str], Workers: list[int], ChunkSizes: list[int], Concurrencies: list[int]) -> list[BenchmarkConfiguration]:
+    Configurations: list[BenchmarkConfiguration] = []
+    for Algorithm in Algorithms:
+        if CompressAlgorithms.get(Algorithm) is None:
+            logging.warning(f"当前的Python运行时不支持压缩算法{Algorithm}，跳过相关配置。")
+    Algorithms = [Algorithm for Algorithm in Algorithms if CompressAlgorithms.get(Algorithm) is not None]
+    for Stage in Stages:
+        if Stage == "website":
+            Configurations += [BenchmarkConfiguration(Stage, Algorithm, WorkerCount) for Algorithm in Algorithms for WorkerCount in Workers]
+        elif Stage == "media":
+            # 视频文件的扩展名在DontCompressFileExtensions中，无论选择哪种算法都直接存储，只按线程数各运行一次
+            Configurations += [BenchmarkConfiguration(Stage, "stored", WorkerCount) for WorkerCount in Workers]
+        elif Stage == "sql":
+            Configurations += [BenchmarkConfiguration(Stage, Algorithm) for Algorithm in Algorithms]
+        elif Stage in UploadStages:
+            Configurations += [BenchmarkConfiguration(Stage, ChunkSize=ChunkSize, Concurrency=Concurrency) for ChunkSize in ChunkSizes for Concurrency in Concurrencies]
+    return Configurations
+
+def RunConfiguration(Configuration: BenchmarkConfiguration, DatasetDirectory: Path) -> dict:
+    # 在子进程中执行：Upload在导入时就读取环境变量并创建S3客户端，峰值内存也只能按进程统计
+    import Backup
+    import ResumableUpload
+    import Upload
+    from ProcessTimer import BuildRunReport
+    Backup.CompressAlgorithm = CompressAlgorithms[Configuration.Algorithm] # type: ignore
+    Backup.ConfigureCompressionWorkers(Configuration.Workers)
+    if Configuration.Stage == "website":
+        Backup.ZipSourceDirectory("Website.zip", DatasetDirectory / "Website")
+    elif Configuration.Stage == "media":
+        Backup.ZipSourceDirectory("Media.zip", DatasetDirectory / "Media")
+    elif Configuration.Stage == "sql":
+        Backup.BackupDatabaseStream(["cat", str(DatasetDirectory / "SQL" / "Dump.sql")], "SQL.sql.zip", "SQL.sql", "SQLError.log", "SQL")
+    elif Configuration.Stage in UploadStages:
+        # 分块大小和并发数在导入Upload时就已经确定，传输控制器和ResumableUpload各自保存了一份，需要一起修改
+        Upload.ChunkSize = Configuration.ChunkSize
+        Upload.MaxConcurrency = ResumableUpload.MaxConcurrency = Configuration.Concurrency
+        Upload.Controller.MaxPartSize = Configuration.ChunkSize
+        Upload.Controller.MaxConcurrency = Configuration.Concurrency
+        Upload.Controller.Configure(Adaptive=False, BandwidthLimit=0)
+        MediaFile = max((DatasetDirectory / "Media").iterdir(), key=lambda File: File.stat().st_size)
+        if Configuration.Stage == "upload":
+            Upload.UploadFile(str(MediaFile))
+        elif Configuration.Stage == "stream-upload":
+            Streaming = Upload.StreamingUpload(MediaFile.name, MediaFile.stat().st_size)
+            with open(MediaFile, "rb") as DataFile:
+                while DataChunk := DataFile.read(DatasetWriteSize):
+                    Streaming.write(DataChunk)
+            Streaming.Complete()
+        else:
+            ResumableUpload.ResumableUploadFile(MediaFile)
+    Report = BuildRunReport(True)
+    Stage = next(Stage for Stage in Report["Stages"] if Stage["Name"] == StageNames[Configuration.Stage])
+    return {
+        "WallSeconds": Stage["WallSeconds"],
+        "CPUSeconds": Stage["ProcessCPUSeconds"] + Stage["ChildCPUSeconds"],
+        "BytesIn": Stage["BytesIn"],
+        "BytesOut": Stage["BytesOut"],
+        "PeakRSS": Report["PeakRSS"] }
+
+def StartS3Server(Port: int) -> dict[str, str] | None:
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        logging.warning("没有安装moto，跳过上传测试，可以使用 uv run --with \"moto[server]\" Benchmark.py 运行。")
+        return None
+    import boto3
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    Server = ThreadedMotoServer(ip_address="127.0.0.1", port=Port, verbose=False)
+    Server.start()
+    Environment = {"R2_Endpoint": f"http://127.0.0.1:{Port}", "R2_Access_Key": "benchmark", "R2_Secret_Key": "benchmark", "R2_Bucket_Name": BenchmarkBucketName}
+    boto3.client("s3", endpoint_url=Environment["R2_Endpoint"], aws_access_key_id="benchmark", aws_secret_access_key="benchmark", region_name="us-east-1").create_bucket(Bucket=BenchmarkBucketName)
+    logging.info(f"本地S3服务已启动：{Environment['R2_Endpoint']}")
+    return Environment
+
+def RunBenchmark(Configuration: BenchmarkConfiguration, DatasetDirectory: Path, OutputDirectory: Path, Environment: dict[str, str]) -> BenchmarkResult | None:
+    shutil.rmtree(OutputDirectory, ignore_errors=True)
+    OutputDirectory.mkdir(parents=True)
+    Process = subprocess.run(
+        [sys.executable, str(Path(__file__).resolve()), str(DatasetDirectory), "--run-configuration", json.dumps(asdict(Configuration))],
+        cwd=OutputDirectory,
+        env=os.environ | Environment,
+        stdout=subprocess.PIPE,
+        text=True)
+    shutil.rmtree(OutputDirectory, ignore_errors=True)
+    if Process.returncode != 0:
+        logging.error(f"测试配置 {Configuration.Name()} 运行失败，返回值：{Process.returncode}")
+        return None
+    return BenchmarkResult(Configuration, **json.loads(Process.stdout.strip().splitlines()[-1]))
+
+def LogResult(Result: BenchmarkResult, Baseline: dict | None):
+    Ratio = Result.CompressionRatio()
+    Change = ""
+    if Baseline is not None and Baseline["Throughput"] > 0:
+        Change = f"，与基准相比：{(Result.Throughput() / Baseline['Throughput'] - 1) * 100:+.1f}%"
+    logging.info(f"{Result.Configuration.Name()}：{humanize.naturalsize(Result.Throughput())}/秒，"
+                 f"耗时 {Result.WallSeconds:.2f} 秒，CPU {Result.CPUSeconds:.2f} 秒，"
+                 f"压缩率 {f'{Ratio:.3f}' if Ratio is not None else '-'}，内存峰值 {humanize.naturalsize(Result.PeakRSS)}{Change}")
+
+def SaveResults(Results: list[BenchmarkResult], OutputPath: Path):
+    OutputPath.write_text(json.dumps({
+        Result.Configuration.Name(): asdict(Result) | {"Throughput": Result.Throughput(), "CompressionRatio": Result.CompressionRatio()}
+        for Result in Results }, ensure_ascii=False, indent=2), encoding="utf-8")
+    logging.info(f"测试结果已保存：{OutputPath}")
+
+def FindRegressions(Results: list[BenchmarkResult], Baseline: dict[str, dict], Tolerance: float) -> list[str]:
+    Regressions: list[str] = []
+    for Result in Results:
+        Previous = Baseline.get(Result.Configuration.Name())
+        if Previous is None:
+            continue
+        if Result.Throughput() < Previous["Throughput"] * (1 - Tolerance):
+            Regressions.append(f"{Result.Configuration.Name()} 吞吐量从 {humanize.naturalsize(Previous['Throughput'])}/秒 下降到 {humanize.naturalsize(Result.Throughput())}/秒")
+        if Result.PeakRSS > Previous["PeakRSS"] * (1 + Tolerance):
+            Regressions.append(f"{Result.Configuration.Name()} 内存峰值从 {humanize.naturalsize(Previous['PeakRSS'])} 上升到 {humanize.naturalsize(Result.PeakRSS)}")
+    return Regressions
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        force=True)
+    if len(sys.argv) < 2 or sys.argv[1].startswith("--"):
+        logging.fatal("用法：uv run --with \"moto[server]\" Benchmark.py <工作目录> [--scale=tiny|small|full] [--stages=website,media,sql,upload,stream-upload,resumable-upload] [--algorithms=deflate,zstd] [--workers=1,4] [--chunk-sizes=16M,64M] [--concurrency=4,16] [--output=结果.json] [--baseline=基准.json] [--tolerance=0.1]")
+        sys.exit(1)
+    WorkingDirectory = Path(sys.argv[1]).resolve()
+    ConfigurationValue = GetPassArgumentValue("--run-configuration")
+    if ConfigurationValue is not None:
+        logging.getLogger().setLevel(logging.WARNING)
+        print(json.dumps(RunConfiguration(BenchmarkConfiguration(**json.loads(ConfigurationValue)), WorkingDirectory)))
+        sys.exit(0)
+
+    try:
+        Tolerance = float(GetPassArgumentValue("--tolerance", "0.1")) # type: ignore
+    except ValueError:
+        Tolerance = -1
+    if Tolerance < 0:
+        logging.fatal(f"用法：--tolerance=N，N应为不小于0的数，当前值为：{GetPassArgumentValue('--tolerance')}")
+        sys.exit(1)
+    Stages = GetPassArgumentValue("--stages", "website,media,sql,upload,stream-upload,resumable-upload").split(",") # type: ignore
+    Configurations = BuildConfigurations(
+        Stages,
+        GetPassArgumentValue("--algorithms", "deflate,zstd").split(","), # type: ignore
+        GetNumberListArgumentValue("--workers", f"1,{min(os.cpu_count() or 1, 8)}", int, 1),
+        GetNumberListArgumentValue("--chunk-sizes", "16M,64M", ParseSize, 1),
+        GetNumberListArgumentValue("--concurrency", "4,16", int, 1))
+    DatasetDirectory = WorkingDirectory / "Dataset"
+    GenerateDataset(DatasetDirectory, GetPassArgumentValue("--scale", "small"), GetIntegerArgumentValue("--seed", 9487, 0)) # type: ignore
+    Environment: dict[str, str] = {}
+    if any(Stage in UploadStages for Stage in Stages):
+        Environment = StartS3Server(GetIntegerArgumentValue("--s3-port", 5059, 1, 65535)) or {} # type: ignore
+        if len(Environment) == 0:
+            Configurations = [Configuration for Configuration in Configurations if Configuration.Stage not in UploadStages]
+    BaselineValue = GetPassArgumentValue("--baseline")
+    Baseline: dict[str, dict] = json.loads(Path(BaselineValue).read_text(encoding="utf-8")) if BaselineValue is not None else {}
+    Results: list[BenchmarkResult] = []
+    for Configuration in Configurations:
+        Result = RunBenchmark(Configuration, DatasetDirectory, WorkingDirectory / "Output", Environment)
+        if Result is not None:
+            LogResult(Result, Baseline.get(Configuration.Name()))
+            Results.append(Result)
+    SaveResults(Results, Path(GetPassArgumentValue("--output", str(WorkingDirectory / "Benchmark.json")))) # type: ignore
+    Regressions = FindRegressions(Results, Baseline, Tolerance)
+    for Regression in Regressions:
+        logging.error(f"性能回退：{Regression}")
+    sys.exit(1 if len(Regressions) > 0 or len(Results) < len(Configurations) else 0)
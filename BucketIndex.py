@@ -0,0 +1,80 @@
+from dataclasses import dataclass
+import datetime
+import logging
+from threading import Lock
+
+from types_boto3_s3 import S3Client
+
+DeleteObjectsBatchSize: int = 1000
+
+@dataclass
+class BucketObject:
+    Key: str
+    Size: int
+    LastModified: datetime.datetime
+    ETag: str
+
+class BucketIndex:
+    def __init__(self, S3: S3Client, BucketName: str):
+        self.S3 = S3
+        self.BucketName = BucketName
+        self.Objects: dict[str, BucketObject] = {}
+        self.Loaded = False
+        self.Lock = Lock()
+
+    def Refresh(self):
+        Objects: dict[str, BucketObject] = {}
+        Paginator = self.S3.get_paginator("list_objects_v2")
+        for Page in Paginator.paginate(Bucket=self.BucketName):
+            for Object in Page.get("Contents", []):
+                Objects[Object["Key"]] = BucketObject( # type: ignore
+                    Object["Key"], # type: ignore
+                    Object.get("Size", 0),
+                    Object.get("LastModified") or datetime.datetime.now(datetime.timezone.utc),
+                    Object.get("ETag", ""))
+        with self.Lock:
+            self.Objects = Objects
+            self.Loaded = True
+        logging.debug(f"已从存储桶 {self.BucketName} 获取 {len(Objects)} 个对象的信息。")
+
+    def EnsureLoaded(self):
+        if self.Loaded == False:
+            self.Refresh()
+
+    def Find(self, Prefix: str = "") -> list[BucketObject]:
+        self.EnsureLoaded()
+        with self.Lock:
+            return [Object for Key, Object in self.Objects.items() if Key.startswith(Prefix)]
+
+    def Contains(self, Key: str) -> bool:
+        self.EnsureLoaded()
+        with self.Lock:
+            return Key in self.Objects
+
+    def TotalSize(self, Prefix: str = "") -> int:
+        return sum(Object.Size for Object in self.Find(Prefix))
+
+    def SortedByAge(self, Prefix: str = "") -> list[BucketObject]:
+        return sorted(self.Find(Prefix), key=lambda Object: Object.LastModified)
+
+    def RecordUpload(self, Key: str, Size: int, ETag: str = ""):
+        with self.Lock:
+            self.Objects[Key] = BucketObject(Key, Size, datetime.datetime.now(datetime.timezone.utc), ETag)
+
+    def Delete(self, Keys: list[str]) -> list[str]:
+        # delete_objects即使部分对象删除失败也会返回成功，只返回确实删除了的对象
+        DeletedKeys: list[str] = []
+        for Start in range(0, len(Keys), DeleteObjectsBatchSize):
+            Batch = Keys[Start:Start + DeleteObjectsBatchSize]
+            Response = self.S3.delete_objects(
+                Bucket=self.BucketName,
+                Delete={"Objects": [{"Key": Key} for Key in Batch], "Quiet": True})
+            FailedKeys = {Error.get("Key") for Error in Response.get("Errors", [])}
+            for Error in Response.get("Errors", []):
+                logging.error(f"删除对象 {Error.get('Key')} 失败：{Error.get('Code')} {Error.get('Message')}")
+            with self.Lock:
+                for Key in Batch:
+                    if Key not in FailedKeys:
+                        self.Objects.pop(Key, None)
+                        DeletedKeys.append(Key)
+        return DeletedKeys
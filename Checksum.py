@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+import shutil
+from threading import Lock
+from typing import IO
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+from ProcessTimer import RecordStageBytes
+
+ChecksumReadSize: int = 1024 * 1024
+FastHashAlgorithm: str | None = None
+
+def ConfigureFastHash(Algorithm: str | None):
+    global FastHashAlgorithm
+    if Algorithm is None:
+        FastHashAlgorithm = None
+    elif Algorithm in ("blake3", "xxh3") and IsHashAvailable(Algorithm):
+        FastHashAlgorithm = Algorithm
+        logging.info(f"将同时计算{Algorithm}校验和，保存在{Algorithm}.txt中")
+    elif Algorithm in ("blake3", "xxh3"):
+        logging.warning(f"没有安装{'blake3' if Algorithm == 'blake3' else 'xxhash'}，将只计算SHA256校验和")
+    else:
+        logging.warning(f"不支持的快速校验算法：{Algorithm}，可选值为blake3或xxh3，将只计算SHA256校验和")
+
+def NewHash(Algorithm: str):
+    if Algorithm == "blake3" and blake3 is not None:
+        return blake3.blake3()
+    if Algorithm == "xxh3" and xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.new(Algorithm)
+
+def IsHashAvailable(Algorithm: str) -> bool:
+    return Algorithm == "sha256" or Algorithm == "blake3" and blake3 is not None or Algorithm == "xxh3" and xxhash is not None
+
+class MultiHash:
+    def __init__(self):
+        self.SHA256 = hashlib.sha256()
+        self.FastHash = None
+        if FastHashAlgorithm is not None:
+            self.FastHash = NewHash(FastHashAlgorithm)
+        self.Size = 0
+
+    def update(self, Data: bytes):
+        self.SHA256.update(Data)
+        if self.FastHash is not None:
+            self.FastHash.update(Data)
+        self.Size += len(Data)
+
+    def Digests(self) -> dict[str, str]:
+        Digests = {"sha256": self.SHA256.hexdigest()}
+        if self.FastHash is not None:
+            Digests[FastHashAlgorithm] = self.FastHash.hexdigest() # type: ignore
+        return Digests
+
+class HashingWriter:
+    # 和TeeWriter一样不提供tell和seek，zipfile会改用数据描述符顺序写出，写入的每个字节都只经过一次哈希
+    def __init__(self, Output: IO[bytes]):
+        self.Output = Output
+        self.Hash = MultiHash()
+
+    def write(self, Data: bytes) -> int:
+        self.Hash.update(Data)
+        return self.Output.write(Data) or len(Data)
+
+    def flush(self):
+        self.Output.flush()
+
+class ChecksumManifest:
+    def __init__(self):
+        self.Lock = Lock()
+        self.Digests: dict[str, dict[str, str]] = {}
+
+    def Record(self, Name: str | Path, Hash: MultiHash):
+        with self.Lock:
+            self.Digests[os.path.normpath(Name)] = Hash.Digests()
+
+    def Clear(self):
+        with self.Lock:
+            self.Digests = {}
+
+    def Write(self, ChecksumFileName: Path, Directory: Path = Path(".")):
+        # 没有经过HashingWriter写出的文件（例如数据库备份的错误日志）只能在这里补算
+        OutputFileNames = {ChecksumFileName.name, f"{FastHashAlgorithm}.txt"}
+        for FilePath in sorted(Directory.rglob("*")):
+            Name = os.path.normpath(FilePath.relative_to(Directory))
+            if FilePath.is_file() == False or Name in self.Digests or Name in OutputFileNames:
+                continue
+            logging.debug(f"{Name} 没有在写入时计算校验和，正在读取文件计算。")
+            Hash = MultiHash()
+            with open(FilePath, "rb") as DataFile:
+                while DataChunk := DataFile.read(ChecksumReadSize):
+                    Hash.update(DataChunk)
+            self.Record(Name, Hash)
+            RecordStageBytes(Hash.Size, 0)
+        with self.Lock:
+            Algorithms = ["sha256"] + ([FastHashAlgorithm] if FastHashAlgorithm is not None else [])
+            for Algorithm in Algorithms:
+                OutputPath = Directory / (ChecksumFileName if Algorithm == "sha256" else Path(f"{Algorithm}.txt"))
+                with open(OutputPath, "wt", encoding="utf-8") as ChecksumFile:
+                    ChecksumFile.writelines(f"{Name}: {Digests[Algorithm]}\n" for Name, Digests in sorted(self.Digests.items()) if Algorithm in Digests)
+
+def CopyFileWithChecksum(Source: Path, Destination: Path, Manifest: ChecksumManifest):
+    with open(Source, "rb") as SourceFile, open(Destination, "wb") as DestinationFile:
+        Writer = HashingWriter(DestinationFile)
+        while DataChunk := SourceFile.read(ChecksumReadSize):
+            Writer.write(DataChunk)
+    shutil.copystat(Source, Destination)
+    Manifest.Record(Destination, Writer.Hash)
+
+Manifest = ChecksumManifest()
@@ -0,0 +1,208 @@
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import sys
+from threading import BoundedSemaphore
+
+import humanize
+from botocore.exceptions import ClientError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from BucketIndex import BucketObject
+from ProcessTimer import MeasureExecutionTime, RecordStageBytes
+from Upload import Bucket, MaxConcurrency, R2_Bucket_Name, R2_Free_Space, S3
+
+ChunkPrefix: str = "chunks/"
+ManifestPrefix: str = "manifests/"
+MinChunkSize: int = 1 * 1024 * 1024
+AverageChunkSize: int = 4 * 1024 * 1024
+MaxChunkSize: int = 16 * 1024 * 1024
+ChunkStoreReadSize: int = 16 * 1024 * 1024
+# 等待上传的分块最多占用的内存，超过后切分线程等待上传完成
+ChunkUploadBufferSize: int = 256 * 1024 * 1024
+# FastCDC的归一化分块：达到平均大小之前使用更难满足的掩码，之后使用更容易满足的掩码，分块大小集中在平均大小附近
+# Gear哈希的低N位只取决于最后N个字节，所以边界只由附近的内容决定，插入或删除字节后之后的边界会重新对齐
+GearWindow: int = AverageChunkSize.bit_length() + 1
+SmallChunkMask: int = (1 << GearWindow) - 1
+LargeChunkMask: int = (1 << (GearWindow - 4)) - 1
+GearSearchStep: int = 1024 * 1024
+GearTable: list[int] = [int.from_bytes(hashlib.sha256(bytes([Byte])).digest()[:4], "little") for Byte in range(256)]
+
+def FindChunkBoundaryPython(Data: bytes | bytearray, End: int) -> int:
+    Hash = 0
+    for Position in range(MinChunkSize - GearWindow, End):
+        Hash = ((Hash << 1) + GearTable[Data[Position]]) & 0xFFFFFFFF
+        if Position + 1 >= MinChunkSize and Hash & (SmallChunkMask if Position + 1 < AverageChunkSize else LargeChunkMask) == 0:
+            return Position + 1
+    return End
+
+def CombineGearHashes(Recent, RecentWidth: int, Older, OlderWidth: int):
+    # Recent[i]和Older[i]分别是结束于第i+RecentWidth-1和第i+OlderWidth-1个字节的窗口哈希，合并成宽度为两者之和的窗口
+    Length = len(Older) - RecentWidth
+    return Recent[OlderWidth:OlderWidth + Length] + (Older[:Length] << numpy.uint32(RecentWidth)) # type: ignore
+
+def FindGearMatchNumpy(Data: bytes | bytearray, FirstLength: int, LastLength: int, Mask: int) -> int | None:
+    # 逐字节的滚动哈希按窗口宽度的二进制位倍增合并，只需要log2(GearWindow)次整体运算，低GearWindow位与逐字节计算的结果完全相同
+    assert numpy is not None
+    if LastLength < FirstLength:
+        return None
+    Values = numpy.array(GearTable, dtype=numpy.uint32)[numpy.frombuffer(Data, dtype=numpy.uint8, count=LastLength)[FirstLength - GearWindow:]]
+    Hashes, HashesWidth = None, 0
+    Power, PowerWidth = Values, 1
+    while True:
+        if GearWindow & PowerWidth:
+            Hashes, HashesWidth = (Power, PowerWidth) if Hashes is None else (CombineGearHashes(Hashes, HashesWidth, Power, PowerWidth), HashesWidth + PowerWidth)
+        if PowerWidth * 2 > GearWindow:
+            break
+        Power, PowerWidth = CombineGearHashes(Power, PowerWidth, Power, PowerWidth), PowerWidth * 2
+    Matches = numpy.flatnonzero((Hashes & numpy.uint32(Mask)) == 0)
+    return FirstLength + int(Matches[0]) if len(Matches) > 0 else None
+
+def FindChunkBoundaryNumpy(Data: bytes | bytearray, End: int) -> int:
+    Cut = FindGearMatchNumpy(Data, MinChunkSize, min(AverageChunkSize - 1, End), SmallChunkMask)
+    # 超过平均大小后通常很快就能找到边界，分段计算，不必每次都算到最大分块大小
+    for FirstLength in range(AverageChunkSize, End + 1, GearSearchStep):
+        if Cut is not None:
+            break
+        Cut = FindGearMatchNumpy(Data, FirstLength, min(FirstLength + GearSearchStep - 1, End), LargeChunkMask)
+    return Cut if Cut is not None else End
+
+def FindChunkBoundary(Data: bytes | bytearray) -> int:
+    End = min(len(Data), MaxChunkSize)
+    if End <= MinChunkSize:
+        return End
+    return (FindChunkBoundaryNumpy if numpy is not None else FindChunkBoundaryPython)(Data, End)
+
+def SplitIntoChunks(FilePath: str) -> Iterator[bytes]:
+    Buffer = bytearray()
+    with open(FilePath, "rb") as DataFile:
+        while True:
+            Data = DataFile.read(ChunkStoreReadSize)
+            Buffer += Data
+            while len(Buffer) >= MaxChunkSize or (len(Data) == 0 and len(Buffer) > 0):
+                Cut = FindChunkBoundary(Buffer)
+                yield bytes(Buffer[:Cut])
+                del Buffer[:Cut]
+            if len(Data) == 0:
+                return
+
+def UploadChunk(Key: str, Data: bytes, Slots: BoundedSemaphore):
+    try:
+        Response = S3.put_object(Bucket=R2_Bucket_Name, Key=Key, Body=Data) # type: ignore
+        Bucket.RecordUpload(Key, len(Data), Response.get("ETag", ""))
+    finally:
+        Slots.release()
+
+def WarnIfChunkingIsSlow():
+    # 不使用numpy时逐字节计算Gear哈希，切分几GB的备份文件比使用numpy慢几个数量级；在开始备份前提示，而不是等打包完才发现
+    if numpy is None:
+        logging.warning("没有安装numpy，分块存储模式将逐字节计算分块边界，速度很慢，建议安装：uv sync --extra chunk-store")
+
+@MeasureExecutionTime("上传备份文件到分块存储")
+def UploadFileToChunkStore(FilePath: str):
+    assert R2_Bucket_Name is not None
+    ExistingChunks = {Object.Key for Object in Bucket.Find(ChunkPrefix)}
+    logging.info(f"分块存储中已有 {len(ExistingChunks)} 个分块。")
+    SHA256 = hashlib.sha256()
+    Chunks: list[tuple[str, int]] = []
+    UploadedSize = ReusedSize = 0
+    Slots = BoundedSemaphore(max(min(MaxConcurrency * 2, ChunkUploadBufferSize // MaxChunkSize), 1))
+    Uploads: list[Future] = []
+    with ThreadPoolExecutor(max_workers=MaxConcurrency) as UploadWorker:
+        for Chunk in SplitIntoChunks(FilePath):
+            SHA256.update(Chunk)
+            ChunkHash = hashlib.sha256(Chunk).hexdigest()
+            Chunks.append((ChunkHash, len(Chunk)))
+            Key = ChunkPrefix + ChunkHash
+            if Key in ExistingChunks:
+                ReusedSize += len(Chunk)
+                continue
+            ExistingChunks.add(Key)
+            UploadedSize += len(Chunk)
+            Slots.acquire()
+            Uploads.append(UploadWorker.submit(UploadChunk, Key, Chunk, Slots))
+    for Upload in Uploads:
+        Upload.result()
+    Manifest = {
+        "Name": os.path.basename(FilePath),
+        "Size": os.path.getsize(FilePath),
+        "SHA256": SHA256.hexdigest(),
+        "Chunks": Chunks }
+    ManifestBody = json.dumps(Manifest).encode("utf-8")
+    ManifestKey = ManifestPrefix + os.path.basename(FilePath) + ".json"
+    Response = S3.put_object(Bucket=R2_Bucket_Name, Key=ManifestKey, Body=ManifestBody)
+    Bucket.RecordUpload(ManifestKey, len(ManifestBody), Response.get("ETag", ""))
+    RecordStageBytes(UploadedSize + ReusedSize, UploadedSize)
+    logging.info(f"分块上传完成，共 {len(Chunks)} 个分块，新上传 {humanize.naturalsize(UploadedSize)}，复用已有分块 {humanize.naturalsize(ReusedSize)}。")
+    OptimizeChunkStore()
+
+def ReadManifest(Key: str) -> dict:
+    return json.loads(S3.get_object(Bucket=R2_Bucket_Name, Key=Key)["Body"].read()) # type: ignore
+
+def OptimizeChunkStore():
+    assert R2_Bucket_Name is not None
+    Manifests: list[BucketObject] = Bucket.SortedByAge(ManifestPrefix)
+    Chunks = {Object.Key: Object for Object in Bucket.Find(ChunkPrefix)}
+    # 免费额度由存储桶中的所有对象共享，其余对象（例如顶层的备份文件）由Upload.OptimizeStorage清理，这里只计入它们的体积
+    OtherSize = sum(Object.Size for Object in Bucket.Find() if Object.Key.startswith((ChunkPrefix, ManifestPrefix)) == False)
+    ReferencedChunks = {Object.Key: {ChunkPrefix + Hash for Hash, Size in ReadManifest(Object.Key)["Chunks"]} for Object in Manifests}
+    def UsedSize() -> int:
+        Referenced = set().union(*ReferencedChunks.values())
+        return sum(Object.Size for Key, Object in Chunks.items() if Key in Referenced) + sum(Object.Size for Object in Manifests) + OtherSize
+    DeleteManifests: list[BucketObject] = []
+    while len(Manifests) > 1 and UsedSize() > R2_Free_Space:
+        Oldest = Manifests.pop(0)
+        DeleteManifests.append(Oldest)
+        del ReferencedChunks[Oldest.Key]
+    DeletedManifests = set(Bucket.Delete([Object.Key for Object in DeleteManifests]))
+    for Object in DeleteManifests:
+        if Object.Key in DeletedManifests:
+            logging.warning(f"存储空间不足，已删除最旧的备份清单：{Object.Key}，最后修改时间：{Object.LastModified.strftime('%Y-%m-%d %H:%M:%S')}。")
+        else:
+            # 清单没能删除时它引用的分块必须保留，否则清单对应的备份无法还原
+            Manifests.insert(0, Object)
+            ReferencedChunks[Object.Key] = {ChunkPrefix + Hash for Hash, Size in ReadManifest(Object.Key)["Chunks"]}
+    Referenced = set().union(*ReferencedChunks.values())
+    UnreferencedChunks = [Key for Key in Chunks if Key not in Referenced]
+    if len(UnreferencedChunks) > 0:
+        DeletedChunks = Bucket.Delete(UnreferencedChunks)
+        logging.info(f"已清理 {len(DeletedChunks)} 个不再被引用的分块。")
+    logging.info(f"分块存储中共保留 {len(Manifests)} 个备份，存储桶共占用 {humanize.naturalsize(UsedSize())} 的空间。")
+
+def DownloadFromChunkStore(ArchiveName: str, OutputPath: Path):
+    try:
+        Manifest = ReadManifest(ManifestPrefix + ArchiveName + ".json")
+    except ClientError:
+        logging.fatal(f"分块存储中不存在备份：{ArchiveName}")
+        sys.exit(1)
+    SHA256 = hashlib.sha256()
+    with open(OutputPath, "wb") as OutputFile:
+        for ChunkHash, Size in Manifest["Chunks"]:
+            Chunk = S3.get_object(Bucket=R2_Bucket_Name, Key=ChunkPrefix + ChunkHash)["Body"].read() # type: ignore
+            if hashlib.sha256(Chunk).hexdigest() != ChunkHash:
+                logging.fatal(f"分块 {ChunkHash} 校验失败。")
+                sys.exit(1)
+            SHA256.update(Chunk)
+            OutputFile.write(Chunk)
+    if SHA256.hexdigest() != Manifest["SHA256"]:
+        logging.fatal(f"还原出的 {ArchiveName} 校验失败。")
+        sys.exit(1)
+    logging.info(f"已从分块存储还原：{OutputPath}，文件大小：{humanize.naturalsize(Manifest['Size'])}")
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S')
+    if len(sys.argv) != 3:
+        logging.fatal("用法：uv run ChunkStore.py <备份文件名> <还原到的路径>")
+        sys.exit(1)
+    DownloadFromChunkStore(sys.argv[1], Path(sys.argv[2]))
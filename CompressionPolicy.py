@@ -0,0 +1,191 @@
+from dataclasses import dataclass
+import fnmatch
+import logging
+import os
+from pathlib import Path
+import sqlite3
+from threading import Lock
+import zipfile
+import zlib
+
+import humanize
+
+from PrepareBackup import ParseSize
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+PolicyCacheFileName: str = "CompressionPolicy.sqlite3"
+CompressionRulesFileName: str = "CompressionRules.txt"
+SampleSize: int = 64 * 1024
+MinimumSampleSize: int = 512
+IncompressibleRatio: float = 0.9
+LargeFileThreshold: int = 64 * 1024 * 1024
+ZstdLevels: dict[str, int] = {"fast": 3, "high": 9}
+DeflateLevels: dict[str, int] = {"fast": 6, "high": 9}
+LongDistanceWindowLog: int = 27
+CompressedFileExtensions: tuple[str, ...] = (
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif", ".heic", ".ico",
+    ".woff", ".woff2", ".mp3", ".m4a", ".ogg", ".opus", ".mp4", ".mkv", ".webm", ".mov", ".avi",
+    ".zip", ".gz", ".tgz", ".br", ".zst", ".xz", ".bz2", ".7z", ".rar", ".jar", ".apk", ".docx", ".xlsx", ".pptx")
+
+@dataclass(frozen=True)
+class CompressionDecision:
+    Tier: str
+    Method: int
+    Level: int
+    LongDistance: bool = False
+
+@dataclass
+class CompressionRule:
+    Pattern: str
+    Tier: str
+    MinimumSize: int = 0
+
+def ZstdLongDistanceOptions(Level: int) -> dict:
+    # zipfile解压zstd时使用默认的窗口上限（2^27），窗口不能再大，否则备份文件无法用标准库解压
+    assert zstd is not None
+    return {
+        zstd.CompressionParameter.compression_level: Level,
+        zstd.CompressionParameter.enable_long_distance_matching: 1,
+        zstd.CompressionParameter.window_log: LongDistanceWindowLog }
+
+def ReadCompressionRules(RulesPath: Path) -> list[CompressionRule]:
+    if RulesPath.exists() == False:
+        return []
+    Rules: list[CompressionRule] = []
+    with open(RulesPath, "rt", encoding="utf-8") as RulesFile:
+        for LineNumber, Line in enumerate(RulesFile, 1):
+            Fields = Line.split("#", 1)[0].split()
+            if len(Fields) == 0:
+                continue
+            if len(Fields) not in (2, 3) or Fields[1] not in ("stored", "fast", "high"):
+                logging.warning(f"{RulesPath} 第{LineNumber}行的压缩规则无效，格式应为：<路径匹配模式> <stored|fast|high> [最小文件大小]")
+                continue
+            Rules.append(CompressionRule(Fields[0], Fields[1], ParseSize(Fields[2]) if len(Fields) == 3 else 0))
+    logging.info(f"已读取 {len(Rules)} 条压缩规则：{RulesPath}")
+    return Rules
+
+def IsUnderDirectories(FilePath: str, Directories: set[str]) -> bool:
+    Directory = os.path.dirname(FilePath)
+    while Directory not in Directories:
+        if os.path.dirname(Directory) == Directory:
+            return False
+        Directory = os.path.dirname(Directory)
+    return True
+
+def SampleCompressionRatio(FilePath: str) -> float:
+    # 用最快的Deflate压缩文件开头的一块数据来估计整个文件的可压缩程度
+    with open(FilePath, "rb") as DataFile:
+        Sample = DataFile.read(SampleSize)
+    if len(Sample) == 0:
+        return 1
+    return len(zlib.compress(Sample, 1)) / len(Sample)
+
+class CompressionPolicy:
+    def __init__(self, CachePath: Path, Rules: list[CompressionRule]):
+        self.Rules = Rules
+        self.Lock = Lock()
+        self.Connection = sqlite3.connect(CachePath, check_same_thread=False)
+        self.Connection.execute("""
+            CREATE TABLE IF NOT EXISTS Samples (
+                Path TEXT PRIMARY KEY,
+                Size INTEGER NOT NULL,
+                ModifiedTime INTEGER NOT NULL,
+                Ratio REAL NOT NULL)""")
+        self.Connection.commit()
+        # 缓存的是采样得到的压缩率而不是最终的决定，修改规则后不需要重新采样
+        self.Samples: dict[str, tuple[int, int, float]] = {Row[0]: Row[1:] for Row in self.Connection.execute("SELECT Path, Size, ModifiedTime, Ratio FROM Samples")}
+        self.PendingSamples: list[tuple[str, int, int, float]] = []
+        self.TierStatistics: dict[str, list[int]] = {}
+        self.ArchivedDirectories: set[str] = set()
+
+    def Ratio(self, FilePath: str, Status: os.stat_result) -> float:
+        with self.Lock:
+            Known = self.Samples.get(FilePath)
+        if Known is not None and Known[:2] == (Status.st_size, Status.st_mtime_ns):
+            return Known[2]
+        Ratio = SampleCompressionRatio(FilePath)
+        with self.Lock:
+            self.Samples[FilePath] = (Status.st_size, Status.st_mtime_ns, Ratio)
+            self.PendingSamples.append((FilePath, Status.st_size, Status.st_mtime_ns, Ratio))
+        return Ratio
+
+    def ChooseTier(self, FilePath: str, Status: os.stat_result) -> str:
+        for Rule in self.Rules:
+            if Status.st_size >= Rule.MinimumSize and fnmatch.fnmatch(FilePath, Rule.Pattern):
+                return Rule.Tier
+        if FilePath.lower().endswith(CompressedFileExtensions):
+            return "stored"
+        if Status.st_size < MinimumSampleSize:
+            return "fast"
+        if self.Ratio(FilePath, Status) > IncompressibleRatio:
+            return "stored"
+        return "high" if Status.st_size >= LargeFileThreshold else "fast"
+
+    def Choose(self, FilePath: str, Status: os.stat_result, DefaultMethod: int) -> CompressionDecision:
+        AbsolutePath = os.path.abspath(FilePath)
+        Tier = self.ChooseTier(AbsolutePath, Status)
+        with self.Lock:
+            self.ArchivedDirectories.add(os.path.dirname(AbsolutePath))
+            Statistics = self.TierStatistics.setdefault(Tier, [0, 0])
+            Statistics[0] += 1
+            Statistics[1] += Status.st_size
+        return Decide(Tier, DefaultMethod, Status.st_size)
+
+    def ChooseStream(self, ArcName: str, DefaultMethod: int, SizeHint: int) -> CompressionDecision:
+        # 数据流（例如数据库导出）无法事先采样，只按规则和调用者给出的大小估计选择；导出的SQL文本压缩率很高，通常都很大
+        Tier = next((Rule.Tier for Rule in self.Rules if SizeHint >= Rule.MinimumSize and fnmatch.fnmatch(ArcName, Rule.Pattern)), "high" if SizeHint >= LargeFileThreshold else "fast")
+        with self.Lock:
+            Statistics = self.TierStatistics.setdefault(Tier, [0, 0])
+            Statistics[0] += 1
+            Statistics[1] += SizeHint
+        return Decide(Tier, DefaultMethod, SizeHint)
+
+    def Save(self):
+        with self.Lock:
+            PendingSamples, self.PendingSamples = self.PendingSamples, []
+            TierStatistics, self.TierStatistics = self.TierStatistics, {}
+            ArchivedDirectories, self.ArchivedDirectories = self.ArchivedDirectories, set()
+            # 每次备份的临时文件（例如导出的.sql）在备份结束后就不存在了，不再保留它们的采样结果；只检查本次打包过的目录下的路径，其他来源的缓存原样保留
+            MissingPaths = [FilePath for FilePath in self.Samples if IsUnderDirectories(FilePath, ArchivedDirectories) and os.path.exists(FilePath) == False]
+            for FilePath in MissingPaths:
+                del self.Samples[FilePath]
+            self.Connection.executemany("INSERT OR REPLACE INTO Samples VALUES (?, ?, ?, ?)", PendingSamples)
+            self.Connection.executemany("DELETE FROM Samples WHERE Path = ?", [(FilePath,) for FilePath in MissingPaths])
+            self.Connection.commit()
+        for Tier, (Count, Size) in sorted(TierStatistics.items()):
+            logging.info(f"压缩策略：{Tier} {Count} 个文件，共 {humanize.naturalsize(Size)}")
+        logging.debug(f"本次新采样了 {len(PendingSamples)} 个文件。")
+
+def Decide(Tier: str, DefaultMethod: int, Size: int) -> CompressionDecision:
+    if Tier == "stored":
+        return CompressionDecision(Tier, zipfile.ZIP_STORED, 0)
+    if DefaultMethod == getattr(zipfile, "ZIP_ZSTANDARD", None):
+        return CompressionDecision(Tier, DefaultMethod, ZstdLevels[Tier], Tier == "high" and Size >= LargeFileThreshold)
+    return CompressionDecision(Tier, DefaultMethod, DeflateLevels[Tier])
+
+Policy: CompressionPolicy | None = None
+
+def ConfigureCompressionPolicy(CachePath: Path, RulesPath: Path):
+    global Policy
+    Policy = CompressionPolicy(CachePath, ReadCompressionRules(RulesPath))
+    logging.info(f"已启用按内容选择压缩方式，采样结果缓存在：{CachePath}")
+
+def ChooseCompression(FilePath: str, Status: os.stat_result, DefaultMethod: int, DontCompressFileExtensions: tuple[str, ...]) -> CompressionDecision:
+    if Policy is not None:
+        return Policy.Choose(FilePath, Status, DefaultMethod)
+    if FilePath.endswith(DontCompressFileExtensions):
+        return CompressionDecision("stored", zipfile.ZIP_STORED, 0)
+    return CompressionDecision("fast", DefaultMethod, 6)
+
+def ChooseStreamCompression(ArcName: str, DefaultMethod: int, SizeHint: int = LargeFileThreshold) -> CompressionDecision:
+    if Policy is not None:
+        return Policy.ChooseStream(ArcName, DefaultMethod, SizeHint)
+    return CompressionDecision("fast", DefaultMethod, 6)
+
+def SaveCompressionPolicy():
+    if Policy is not None:
+        Policy.Save()
@@ -0,0 +1,172 @@
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+import fcntl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+from pathlib import Path
+from threading import Lock, Thread
+import time
+from typing import IO
+
+import humanize
+import psutil
+import schedule
+
+from Upload import Bucket
+
+LockFileName: str = "Backup.lock"
+SchedulerPollInterval: float = 1
+IOPriorityClasses: dict[str, int] = {
+    "idle": psutil.IOPRIO_CLASS_IDLE,
+    "best-effort": psutil.IOPRIO_CLASS_BE }
+
+@dataclass
+class BackupJob:
+    Name: str
+    Sources: frozenset[str]
+    IntervalSeconds: int
+    Running: bool = False
+    Runs: int = 0
+    Failures: int = 0
+    LastStartTime: float | None = None
+    LastEndTime: float | None = None
+    LastSucceeded: bool | None = None
+    LastError: str | None = None
+    NextRunTime: float | None = None
+
+class RunLock:
+    # 使用flock，进程退出（包括被杀死）时内核会自动释放，不会留下需要手动清理的锁文件
+    def __init__(self, LockPath: Path):
+        self.LockPath = LockPath
+        self.LockFile: IO[str] | None = None
+
+    def Acquire(self, Wait: bool) -> bool:
+        self.LockFile = open(self.LockPath, "a+", encoding="utf-8")
+        try:
+            fcntl.flock(self.LockFile, fcntl.LOCK_EX | (0 if Wait == True else fcntl.LOCK_NB))
+        except BlockingIOError:
+            self.LockFile.seek(0)
+            logging.warning(f"另一个备份任务（PID {self.LockFile.read().strip() or '未知'}）正在运行。")
+            self.LockFile.close()
+            self.LockFile = None
+            return False
+        self.LockFile.truncate(0)
+        self.LockFile.write(str(os.getpid()))
+        self.LockFile.flush()
+        return True
+
+    def Release(self):
+        if self.LockFile is not None:
+            self.LockFile.truncate(0)
+            fcntl.flock(self.LockFile, fcntl.LOCK_UN)
+            self.LockFile.close()
+            self.LockFile = None
+
+def ConfigureProcessPriority(Niceness: int, IOPriority: str | None):
+    # 需要在创建线程池和子进程之前调用，之后创建的线程和数据库备份进程都会继承这里的优先级
+    if Niceness != 0:
+        os.nice(Niceness)
+        logging.info(f"已将进程的nice值调整为：{os.nice(0)}")
+    if IOPriority is not None:
+        ClassName, _, Level = IOPriority.partition(":")
+        if ClassName not in IOPriorityClasses:
+            logging.warning(f"不支持的IO优先级：{IOPriority}，可选值为idle或best-effort[:0-7]")
+            return
+        if ClassName == "best-effort":
+            psutil.Process().ionice(IOPriorityClasses[ClassName], int(Level or "7"))
+        else:
+            psutil.Process().ionice(IOPriorityClasses[ClassName])
+        logging.info(f"已将进程的IO优先级调整为：{IOPriority}")
+
+class BackupDaemon:
+    def __init__(self, Jobs: list[BackupJob], RunJob: Callable[[BackupJob], None], BackupLock: RunLock, BucketRefreshInterval: int):
+        self.Jobs = Jobs
+        self.RunJob = RunJob
+        self.RunLock = BackupLock
+        self.StatusLock = Lock()
+        self.StartTime = time.time()
+        # Upload.py的上传进度报告使用schedule的默认调度器并会在上传结束时清空它，这里必须使用独立的调度器
+        self.Scheduler = schedule.Scheduler()
+        for Job in Jobs:
+            self.Scheduler.every(Job.IntervalSeconds).seconds.do(self.Run, Job).tag(Job.Name)
+            logging.info(f"已添加定时备份任务：{Job.Name}，备份内容：{'、'.join(sorted(Job.Sources))}，间隔：{humanize.naturaldelta(Job.IntervalSeconds)}")
+        if BucketRefreshInterval > 0:
+            self.Scheduler.every(BucketRefreshInterval).seconds.do(self.RefreshBucketIndex)
+
+    def Run(self, Job: BackupJob):
+        logging.info(f"等待备份锁：{Job.Name}")
+        self.RunLock.Acquire(Wait=True)
+        with self.StatusLock:
+            Job.Running = True
+            Job.LastStartTime = time.time()
+        logging.info(f"开始执行定时备份任务：{Job.Name}")
+        try:
+            self.RunJob(Job)
+            Succeeded, ErrorText = True, None
+        except Exception as Error:
+            logging.exception(f"定时备份任务 {Job.Name} 失败：{Error}")
+            Succeeded, ErrorText = False, f"{type(Error).__name__}: {Error}"
+        finally:
+            self.RunLock.Release()
+        with self.StatusLock:
+            Job.Running = False
+            Job.Runs += 1
+            Job.Failures += int(Succeeded == False)
+            Job.LastEndTime = time.time()
+            Job.LastSucceeded = Succeeded
+            Job.LastError = ErrorText
+        logging.info(f"定时备份任务 {Job.Name} 已结束，耗时：{humanize.naturaldelta(Job.LastEndTime - Job.LastStartTime)}") # type: ignore
+
+    def RefreshBucketIndex(self):
+        # 存储桶的对象列表在两次备份之间保留在内存中，定期重新获取一次以发现其他途径对存储桶的修改
+        if Bucket.BucketName == "":
+            return
+        try:
+            Bucket.Refresh()
+        except Exception as Error:
+            logging.warning(f"刷新存储桶对象列表失败：{Error}")
+
+    def Status(self) -> dict:
+        with self.StatusLock:
+            for Job in self.Jobs:
+                NextRun = next((ScheduledJob.next_run for ScheduledJob in self.Scheduler.get_jobs(Job.Name)), None)
+                Job.NextRunTime = NextRun.timestamp() if NextRun is not None else None
+            Jobs = [asdict(Job) | {"Sources": sorted(Job.Sources)} for Job in self.Jobs]
+        with Bucket.Lock:
+            BucketStatus = {"Loaded": Bucket.Loaded, "Objects": len(Bucket.Objects), "TotalSize": sum(Object.Size for Object in Bucket.Objects.values())}
+        return {
+            "PID": os.getpid(),
+            "StartTime": self.StartTime,
+            "Jobs": Jobs,
+            "BucketIndex": BucketStatus }
+
+    def StartStatusServer(self, Port: int) -> ThreadingHTTPServer:
+        Daemon = self
+        class StatusHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/status"):
+                    self.send_error(404)
+                    return
+                Body = json.dumps(Daemon.Status(), ensure_ascii=False, indent=2).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(Body)))
+                self.end_headers()
+                self.wfile.write(Body)
+
+            def log_message(self, format, *args):
+                logging.debug(f"状态接口：{format % args}")
+        # 只监听本机地址，状态接口没有任何认证
+        Server = ThreadingHTTPServer(("127.0.0.1", Port), StatusHandler)
+        Thread(target=Server.serve_forever, daemon=True).start()
+        logging.info(f"状态接口已启动：http://127.0.0.1:{Server.server_port}/status")
+        return Server
+
+    def Serve(self, RunOnStart: bool):
+        if RunOnStart == True:
+            self.Scheduler.run_all()
+        while True:
+            self.Scheduler.run_pending()
+            time.sleep(SchedulerPollInterval)
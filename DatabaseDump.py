@@ -0,0 +1,110 @@
+from concurrent.futures import Future
+import logging
+from pathlib import Path
+import pwd
+import subprocess
+import tempfile
+
+from Archive import ArchiveBuilder
+from Backup import BackupDatabase
+from ProcessTimer import InstrumentedThreadPoolExecutor, MeasureExecutionTime
+
+MySQLDirectoryName: str = "MySQL"
+PostgreSQLDirectoryName: str = "PostgreSQL"
+PostgreSQLGlobalsFileName: str = "globals.sql"
+MySQLSystemDatabases = ("information_schema", "performance_schema", "sys")
+# 启用--split-large-tables时，超过这个大小的MySQL表单独使用一个mysqldump进程，避免一个大表拖住整个数据库的备份
+LargeTableThreshold: int = 1024 ** 3 # 1 GiB
+
+def QueryLines(ShellCommand: list[str], RunAsUser: str | None = None) -> list[str]:
+    # 列不出数据库时不能当作没有数据库，否则一个数据库都没有备份，本次运行却算作成功
+    try:
+        Result = subprocess.run(args=ShellCommand, capture_output=True, text=True, user=RunAsUser)
+    except FileNotFoundError as Exception:
+        logging.error(f"由于可执行文件{ShellCommand[0]}不存在，无法列出数据库。")
+        logging.debug(f"异常信息：{Exception}")
+        raise
+    except PermissionError as Exception:
+        logging.error(f"由于权限不足，无法执行{ShellCommand[0]}。请切换到root或使用sudo重试。")
+        logging.debug(f"异常信息：{Exception}")
+        raise
+    if Result.returncode != 0:
+        logging.error(f"{ShellCommand}执行失败：{Result.stderr.strip()}")
+        raise RuntimeError(f"{ShellCommand[0]}的返回值为{Result.returncode}：{Result.stderr.strip()}")
+    return [Line for Line in Result.stdout.splitlines() if Line != ""]
+
+def RaiseFailedDumps(Futures: list[Future], Kind: str):
+    # 等所有数据库都备份完再汇总失败的任务，一个数据库失败不影响其余数据库
+    Errors = [DumpFuture.exception() for DumpFuture in Futures if DumpFuture.exception() is not None]
+    if len(Errors) > 0:
+        raise RuntimeError(f"{len(Errors)} 个{Kind}数据库备份失败：{'；'.join(str(Error) for Error in Errors)}")
+
+def ListMySQLDatabases() -> list[str]:
+    return [Name for Name in QueryLines(["mysql", "-N", "-B", "-e", "SHOW DATABASES"]) if Name not in MySQLSystemDatabases]
+
+def ListMySQLLargeTables() -> dict[str, list[str]]:
+    LargeTables: dict[str, list[str]] = {}
+    for Line in QueryLines(["mysql", "-N", "-B", "-e",
+            "SELECT TABLE_SCHEMA, TABLE_NAME FROM information_schema.TABLES "
+            f"WHERE TABLE_TYPE = 'BASE TABLE' AND DATA_LENGTH + INDEX_LENGTH >= {LargeTableThreshold} "
+            "ORDER BY DATA_LENGTH + INDEX_LENGTH DESC"]):
+        DatabaseName, TableName = Line.split("\t", 1)
+        LargeTables.setdefault(DatabaseName, []).append(TableName)
+    return LargeTables
+
+def ListPostgreSQLDatabases() -> list[str]:
+    return QueryLines(["psql", "-At", "-c",
+        "SELECT datname FROM pg_database WHERE datallowconn AND NOT datistemplate ORDER BY pg_database_size(datname) DESC"], "postgres")
+
+@MeasureExecutionTime("并行备份MySQL数据库")
+def BackupMySQLDatabases(OutputDirectory: Path, Jobs: int, SplitLargeTables: bool = False):
+    Databases = ListMySQLDatabases()
+    if len(Databases) == 0:
+        logging.warning("没有找到需要备份的MySQL数据库。")
+        return
+    # 单独备份的大表与所在数据库的其余部分不在同一个事务中，两者之间不再保证一致
+    LargeTables = ListMySQLLargeTables() if SplitLargeTables == True else {}
+    OutputDirectory.mkdir(exist_ok=True)
+    DumpCommand = ["mysqldump", "--single-transaction", "--quick", "--routines", "--events", "--triggers"]
+    # 大表排在前面先开始，耗时最长的任务不会最后才启动
+    Tasks: list[tuple[list[str], str, str]] = []
+    for DatabaseName in Databases:
+        for TableName in LargeTables.get(DatabaseName, []):
+            Tasks.append((DumpCommand + [DatabaseName, TableName], f"{DatabaseName}.{TableName}", f"MySQL {DatabaseName}.{TableName}"))
+    for DatabaseName in Databases:
+        IgnoreTables = [f"--ignore-table={DatabaseName}.{TableName}" for TableName in LargeTables.get(DatabaseName, [])]
+        Tasks.append((DumpCommand + IgnoreTables + ["--databases", DatabaseName], DatabaseName, f"MySQL {DatabaseName}"))
+    logging.info(f"共有 {len(Databases)} 个MySQL数据库，{sum(len(Tables) for Tables in LargeTables.values())} 个大表单独备份，并行数：{Jobs}")
+    with InstrumentedThreadPoolExecutor(max_workers=Jobs, thread_name_prefix="MySQLDump") as DumpWorker:
+        Futures = [DumpWorker.submit(BackupDatabase, ShellCommand, str(OutputDirectory / f"{FileName}.sql"), str(OutputDirectory / f"{FileName}.error.log"), DatabaseName) for ShellCommand, FileName, DatabaseName in Tasks]
+    RaiseFailedDumps(Futures, "MySQL")
+
+@MeasureExecutionTime("并行备份PostgreSQL数据库")
+def BackupPostgreSQLDatabases(OutputDirectory: Path, Jobs: int):
+    try:
+        pwd.getpwnam("postgres")
+    except KeyError:
+        logging.error("系统中不存在postgres用户，故跳过PostgreSQL备份。")
+        return
+    OutputDirectory.mkdir(exist_ok=True)
+    # pg_dump以postgres用户运行，无法写入root的目录（例如/root下的备份目录），所以每个数据库都输出到标准输出，由本进程写入文件；每个pg_dump进程内部使用同一个快照
+    Databases = ListPostgreSQLDatabases()
+    logging.info(f"共有 {len(Databases)} 个PostgreSQL数据库，并行数：{Jobs}")
+    with InstrumentedThreadPoolExecutor(max_workers=Jobs, thread_name_prefix="PostgreSQLDump") as DumpWorker:
+        Futures = [DumpWorker.submit(BackupDatabase, ["pg_dumpall", "--globals-only"], str(OutputDirectory / PostgreSQLGlobalsFileName), str(OutputDirectory / "globals.error.log"), "PostgreSQL全局对象", "postgres")]
+        Futures += [DumpWorker.submit(BackupDatabase, ["pg_dump", "--format=plain", DatabaseName], str(OutputDirectory / f"{DatabaseName}.sql"), str(OutputDirectory / f"{DatabaseName}.error.log"), f"PostgreSQL {DatabaseName}", "postgres") for DatabaseName in Databases]
+    RaiseFailedDumps(Futures, "PostgreSQL")
+
+def BackupDatabasesIntoArchive(Builder: ArchiveBuilder, Jobs: int, SplitLargeTables: bool = False):
+    # 归档只有一个写入线程，直接流式写入会让各个备份进程排队，所以先并行备份到临时目录再加入归档
+    with tempfile.TemporaryDirectory(prefix="DatabaseDump-", dir=".") as TemporaryDirectory:
+        with InstrumentedThreadPoolExecutor(max_workers=2) as DumpWorker:
+            Futures = [
+                DumpWorker.submit(BackupMySQLDatabases, Path(TemporaryDirectory) / MySQLDirectoryName, Jobs, SplitLargeTables),
+                DumpWorker.submit(BackupPostgreSQLDatabases, Path(TemporaryDirectory) / PostgreSQLDirectoryName, Jobs)]
+        # 失败的数据库已经删除了不完整的导出，其余数据库照常加入归档，之后再把失败传给备份任务
+        for DirectoryName in (MySQLDirectoryName, PostgreSQLDirectoryName):
+            if (Path(TemporaryDirectory) / DirectoryName).exists():
+                Builder.AddDirectory(Path(TemporaryDirectory) / DirectoryName, DirectoryName).result()
+        for DumpFuture in Futures:
+            DumpFuture.result()
@@ -0,0 +1,202 @@
+from datetime import datetime, timedelta
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+import sys
+from threading import Lock
+from typing import IO
+import zipfile
+
+import humanize
+
+from CompressionPolicy import ChooseCompression
+from ProcessTimer import RecordStageBytes
+
+IncrementalManifestName: str = ".BackupManifest.json"
+IndexFileName: str = "FileIndex.sqlite3"
+
+class FileIndex:
+    def __init__(self, IndexPath: Path):
+        self.IndexPath = IndexPath
+        self.Lock = Lock()
+        self.Connection = sqlite3.connect(IndexPath, check_same_thread=False)
+        self.Connection.execute("PRAGMA journal_mode=WAL")
+        self.Connection.execute("""
+            CREATE TABLE IF NOT EXISTS Files (
+                Source TEXT NOT NULL,
+                Path TEXT NOT NULL,
+                Size INTEGER NOT NULL,
+                ModifiedTime INTEGER NOT NULL,
+                Inode INTEGER NOT NULL,
+                SHA256 TEXT NOT NULL,
+                Archive TEXT NOT NULL,
+                PRIMARY KEY (Source, Path))""")
+        self.Connection.execute("""
+            CREATE TABLE IF NOT EXISTS Backups (
+                Archive TEXT PRIMARY KEY,
+                Type TEXT NOT NULL,
+                CreatedTime TEXT NOT NULL)""")
+        # 增量备份中未变化的文件存放在之前的备份里，清理旧备份时必须知道哪些备份仍被引用
+        self.Connection.execute("""
+            CREATE TABLE IF NOT EXISTS ArchiveReferences (
+                Archive TEXT NOT NULL,
+                ReferencedArchive TEXT NOT NULL,
+                PRIMARY KEY (Archive, ReferencedArchive))""")
+        self.Connection.commit()
+
+    def ForgetMissingArchives(self, BackupRootDirectory: Path):
+        with self.Lock:
+            Archives = [Row[0] for Row in self.Connection.execute("SELECT DISTINCT Archive FROM Files UNION SELECT Archive FROM Backups UNION SELECT Archive FROM ArchiveReferences")]
+            for Archive in Archives:
+                if (BackupRootDirectory / Archive).exists() == False:
+                    # 保留策略不会删除仍被引用的备份，走到这里说明备份是被手动删除的
+                    logging.warning(f"索引中引用的备份 {Archive} 已不存在，其中的文件将在本次备份中重新打包。")
+                    for Row in self.Connection.execute("SELECT Archive FROM ArchiveReferences WHERE ReferencedArchive = ?", (Archive,)).fetchall():
+                        logging.error(f"增量备份 {Row[0]} 引用的 {Archive} 已不存在，{Row[0]} 已无法完整恢复。")
+                    self.Connection.execute("DELETE FROM Files WHERE Archive = ?", (Archive,))
+                    self.Connection.execute("DELETE FROM Backups WHERE Archive = ?", (Archive,))
+                    self.Connection.execute("DELETE FROM ArchiveReferences WHERE Archive = ?", (Archive,))
+            self.Connection.commit()
+
+    def IsFullBackupDue(self, Interval: timedelta) -> bool:
+        with self.Lock:
+            Row = self.Connection.execute("SELECT MAX(CreatedTime) FROM Backups WHERE Type = 'full'").fetchone()
+        if Row[0] is None:
+            return True
+        return datetime.now() - datetime.fromisoformat(Row[0]) >= Interval
+
+    def RecordBackup(self, Archive: str, Type: str):
+        with self.Lock:
+            self.Connection.execute("INSERT OR REPLACE INTO Backups VALUES (?, ?, ?)", (Archive, Type, datetime.now().isoformat()))
+            self.Connection.commit()
+
+    def RecordReferences(self, Archive: str, ReferencedArchives: set[str]):
+        with self.Lock:
+            self.Connection.executemany("INSERT OR IGNORE INTO ArchiveReferences VALUES (?, ?)", [(Archive, ReferencedArchive) for ReferencedArchive in ReferencedArchives if ReferencedArchive != Archive])
+            self.Connection.commit()
+
+    def LoadReferences(self) -> dict[str, set[str]]:
+        References: dict[str, set[str]] = {}
+        with self.Lock:
+            for Archive, ReferencedArchive in self.Connection.execute("SELECT Archive, ReferencedArchive FROM ArchiveReferences"):
+                References.setdefault(Archive, set()).add(ReferencedArchive)
+        return References
+
+    def LoadSource(self, Source: str) -> dict[str, tuple[int, int, int, str, str]]:
+        with self.Lock:
+            return {
+                Row[0]: Row[1:]
+                for Row in self.Connection.execute("SELECT Path, Size, ModifiedTime, Inode, SHA256, Archive FROM Files WHERE Source = ?", (Source,)) }
+
+    def ReplaceSource(self, Source: str, Rows: list[tuple[str, int, int, int, str, str]]):
+        with self.Lock:
+            self.Connection.execute("DELETE FROM Files WHERE Source = ?", (Source,))
+            self.Connection.executemany("INSERT INTO Files VALUES (?, ?, ?, ?, ?, ?, ?)", [(Source, *Row) for Row in Rows])
+            self.Connection.commit()
+
+    def Close(self):
+        with self.Lock:
+            self.Connection.close()
+
+def ComputeFileSHA256(FilePath: str) -> str:
+    SHA256 = hashlib.sha256()
+    with open(FilePath, "rb") as DataFile:
+        while DataChunk := DataFile.read(65536):
+            SHA256.update(DataChunk)
+    return SHA256.hexdigest()
+
+def IncrementalZipDirectoryTree(ZipFileName: str, TargetDirectory: Path, Index: FileIndex, ArchiveName: str, FullBackup: bool, CompressAlgorithm: int, DontCompressFileExtensions: tuple[str, ...], OutputFile: IO[bytes] | None = None):
+    Source = os.path.basename(ZipFileName)
+    Previous = Index.LoadSource(Source)
+    Rows: list[tuple[str, int, int, int, str, str]] = []
+    Manifest: dict[str, str] = {}
+    ChangedSize = UnchangedSize = 0
+    with zipfile.ZipFile(OutputFile or ZipFileName, "w", CompressAlgorithm) as ZipFile:
+        for FolderName, SubFolders, FileNames in os.walk(TargetDirectory):
+            for FileName in FileNames:
+                FilePath = os.path.join(FolderName, FileName)
+                ArcName = os.path.relpath(FilePath, TargetDirectory)
+                Status = os.stat(FilePath)
+                Known = Previous.get(ArcName)
+                if FullBackup == False and Known is not None and Known[:3] == (Status.st_size, Status.st_mtime_ns, Status.st_ino):
+                    SHA256, StoredIn = Known[3], Known[4]
+                else:
+                    SHA256 = ComputeFileSHA256(FilePath)
+                    if FullBackup == False and Known is not None and Known[0] == Status.st_size and Known[3] == SHA256:
+                        StoredIn = Known[4]
+                    else:
+                        Decision = ChooseCompression(FilePath, Status, CompressAlgorithm, DontCompressFileExtensions)
+                        ZipFile.write(FilePath, arcname=ArcName, compress_type=Decision.Method, compresslevel=Decision.Level)
+                        StoredIn = ArchiveName
+                if StoredIn == ArchiveName:
+                    ChangedSize += Status.st_size
+                else:
+                    UnchangedSize += Status.st_size
+                Manifest[ArcName] = StoredIn
+                Rows.append((ArcName, Status.st_size, Status.st_mtime_ns, Status.st_ino, SHA256, StoredIn))
+        ZipFile.writestr(IncrementalManifestName, json.dumps({
+            "Type": "full" if FullBackup else "incremental",
+            "Archive": ArchiveName,
+            "Source": Source,
+            "Files": Manifest }, ensure_ascii=False))
+    RecordStageBytes(sum(Info.file_size for Info in ZipFile.infolist()), sum(Info.compress_size for Info in ZipFile.infolist()))
+    Index.ReplaceSource(Source, Rows)
+    Index.RecordReferences(ArchiveName, set(Manifest.values()))
+    logging.info(f"{Source}：本次打包 {humanize.naturalsize(ChangedSize)}，引用之前备份中未变化的文件 {humanize.naturalsize(UnchangedSize)}")
+
+def LoadArchiveReferences(IndexPath: Path) -> dict[str, set[str]]:
+    # 没有使用过增量备份时不创建索引文件
+    if IndexPath.exists() == False:
+        return {}
+    Index = FileIndex(IndexPath)
+    try:
+        return Index.LoadReferences()
+    finally:
+        Index.Close()
+
+def ReferencedArchives(Archives: set[str], References: dict[str, set[str]]) -> set[str]:
+    # 被引用的备份本身也可能引用更早的备份，一直追溯到完整备份
+    Referenced: set[str] = set()
+    Pending = list(Archives)
+    while len(Pending) > 0:
+        for ReferencedArchive in References.get(Pending.pop(), set()):
+            if ReferencedArchive not in Referenced:
+                Referenced.add(ReferencedArchive)
+                Pending.append(ReferencedArchive)
+    return Referenced
+
+def DependentArchives(Archive: str, References: dict[str, set[str]]) -> set[str]:
+    return {Dependent for Dependent in References if Archive in ReferencedArchives({Dependent}, References)}
+
+def OpenSourceArchive(BackupRootDirectory: Path, ArchiveName: str, Source: str) -> zipfile.ZipFile:
+    OuterArchive = zipfile.ZipFile(BackupRootDirectory / ArchiveName)
+    return zipfile.ZipFile(OuterArchive.open(Source))
+
+def RestoreIncremental(BackupRootDirectory: Path, ArchiveName: str, Source: str, OutputDirectory: Path):
+    with OpenSourceArchive(BackupRootDirectory, ArchiveName, Source) as SourceArchive:
+        Manifest = json.loads(SourceArchive.read(IncrementalManifestName))
+    FilesByArchive: dict[str, list[str]] = {}
+    for ArcName, StoredIn in Manifest["Files"].items():
+        FilesByArchive.setdefault(StoredIn, []).append(ArcName)
+    logging.info(f"{ArchiveName} 中的 {Source} 依赖 {len(FilesByArchive)} 个备份：{sorted(FilesByArchive)}")
+    for StoredIn, ArcNames in sorted(FilesByArchive.items()):
+        if (BackupRootDirectory / StoredIn).exists() == False:
+            logging.error(f"备份 {StoredIn} 不存在，无法恢复其中的 {len(ArcNames)} 个文件。")
+            continue
+        with OpenSourceArchive(BackupRootDirectory, StoredIn, Source) as SourceArchive:
+            for ArcName in ArcNames:
+                SourceArchive.extract(ArcName, OutputDirectory)
+        logging.info(f"已从 {StoredIn} 恢复 {len(ArcNames)} 个文件。")
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S')
+    if len(sys.argv) != 5:
+        logging.fatal("用法：uv run Incremental.py <备份目录> <备份文件名> <来源压缩包名，如WebsiteRoot.zip> <恢复到的目录>")
+        sys.exit(1)
+    RestoreIncremental(Path(sys.argv[1]), sys.argv[2], sys.argv[3], Path(sys.argv[4]))
@@ -1,3 +1,4 @@
+import atexit
 import logging
 
 logging.basicConfig(
@@ -8,8 +9,9 @@ logging.basicConfig(
 import os
 from pathlib import Path
 import shutil
-from datetime import datetime
+from datetime import datetime, timedelta
 import sys
+from typing import IO
 
 import humanize.i18n
 Original_naturalsize = humanize.naturalsize
@@ -21,120 +23,320 @@ def New_naturalsize(
     return Original_naturalsize(value=value, binary=binary, gnu=gnu, format=format)
 humanize.naturalsize = New_naturalsize
 
-from Backup import BackupCertbot, BackupCustomPath, BackupDatabase, BackupWebsite, GenerateSHA256Checksum, LogDirectoryTree, PackAllFiles, ZipWorker
-from PrepareBackup import GetDirectorySize, ParsePassArguments
-from Upload import GetBucketTotalSize, R2_Access_Key, R2_Bucket_Name, R2_Endpoint, R2_Secret_Key, UploadFile
+from Archive import AddDirectoryIntoArchive, ArchiveBuilder, BackupCustomPathIntoArchive, BackupDatabaseIntoArchive
+from Backup import BackupCertbot, BackupCustomPath, ConfigureCompressionWorkers, ConfigureIncrementalBackup, ConfigureTaskScheduler, BackupDatabase, BackupDatabaseStream, BackupWebsite, GenerateSHA256Checksum, LogDirectoryTree, PackAllFiles, SubmitBackupTask, WaitForBackupTasks
+from Checksum import ConfigureFastHash, Manifest
+from CompressionPolicy import CompressionRulesFileName, ConfigureCompressionPolicy, PolicyCacheFileName, SaveCompressionPolicy
+from ChunkStore import UploadFileToChunkStore, WarnIfChunkingIsSlow
+from Daemon import BackupDaemon, BackupJob, ConfigureProcessPriority, LockFileName, RunLock
+from DatabaseDump import BackupDatabasesIntoArchive, BackupMySQLDatabases, BackupPostgreSQLDatabases, MySQLDirectoryName, PostgreSQLDirectoryName
+from Incremental import FileIndex, IndexFileName, LoadArchiveReferences
+from Retention import EnforceRetention, ParseRetentionPolicy
+from ResumableUpload import ResumePendingUploads, ResumableUploadFile
+from ProcessTimer import ResetRunRecords, WriteRunReport
+from PrepareBackup import GetDirectorySize, GetIntegerArgumentValue, GetPassArgumentValue, HasPassArgument, ParseDuration, ParsePassArguments, ParseSize
+from Upload import ConfigureArchiveReferences, ConfigureTransferController, GetBucketTotalSize, R2_Access_Key, R2_Bucket_Name, R2_Endpoint, R2_Secret_Key, StreamingUpload, TeeWriter, UploadFile
 
-CurrentTime: str = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
 MySQLDumpCommand: list[str] = ["mysqldump", "-A"]
 MySQLDumpedFileName: str = "MySQL.sql"
 MySQLDumpErrorLogFileName: str = "MySQLError.log"
 PostgreSQLDumpCommand: list[str] = ["pg_dumpall"]
 PostgreSQLDumpedFileName: str = "PostgreSQL.sql"
 PostgreSQLDumpErrorLogFileName: str = "PostgreSQLError.log"
+DatabaseStreamArchiveSuffix: str = ".zip"
 WebsiteLocation: Path = Path("/var/www").resolve()
 WebsiteZipFileName: str = "WebsiteRoot.zip"
 CertbotLocation: Path = Path("/etc/letsencrypt").resolve()
 CertbotZipFileName: str = "Certbot.zip"
 BackupRootDirectory: Path = Path("Backup").resolve()    
 BackupDirectorySizeLimit: int = 20 * (1024 ** 3)  # 20 GiB
-ArchiveZipFileName: str = f"{CurrentTime}.zip"
 ChecksumFileName: Path = Path("sha256.txt")
 CustomPathListFileName: Path = Path("CustomPathList.txt")
 SkipDatabaseBackup, SkipWebsiteBackup, SkipCertbotBackup, SkipCustomPathBackup, SkipUpload =  ParsePassArguments()
+StreamDatabaseDump: bool = HasPassArgument("--stream-database-dump")
+ParallelDatabaseDump: bool = HasPassArgument("--parallel-database-dump")
+SplitLargeTables: bool = HasPassArgument("--split-large-tables")
+DatabaseDumpJobs: int = GetIntegerArgumentValue("--database-dump-jobs", min(os.cpu_count() or 1, 4), 1) # type: ignore
+SinglePassArchive: bool = HasPassArgument("--single-pass-archive")
+CompressionWorkers: int = GetIntegerArgumentValue("--compression-workers", 1, 1) # type: ignore
+IncrementalBackup: bool = HasPassArgument("--incremental")
+ForceFullBackup: bool = HasPassArgument("--full-backup")
+UseChunkStore: bool = HasPassArgument("--chunk-store")
+StreamUpload: bool = HasPassArgument("--stream-upload")
+ResumableUpload: bool = HasPassArgument("--resumable-upload")
+AdaptiveUpload: bool = HasPassArgument("--adaptive-upload")
+BandwidthLimit: int = ParseSize(GetPassArgumentValue("--bandwidth-limit", "0")) # type: ignore
+RetentionPolicyConfig = ParseRetentionPolicy(BackupDirectorySizeLimit)
+RetentionDryRun: bool = HasPassArgument("--retention-dry-run")
+RunReportFileName: Path = Path(GetPassArgumentValue("--run-report", str(BackupRootDirectory.parent / "RunReport.json"))).resolve() # type: ignore
+PrometheusTextfileValue: str | None = GetPassArgumentValue("--prometheus-textfile")
+PrometheusTextfile: Path | None = Path(PrometheusTextfileValue).resolve() if PrometheusTextfileValue is not None else None
+RunSucceeded: bool = False
+FastHash: str | None = GetPassArgumentValue("--fast-hash")
+FullBackupInterval: timedelta = timedelta(days=GetIntegerArgumentValue("--full-backup-interval", 7, 1)) # type: ignore
+BackupSources: tuple[str, ...] = ("database", "website", "certbot", "custom-path")
+DaemonMode: bool = HasPassArgument("--daemon")
+DefaultInterval: int = ParseDuration(GetPassArgumentValue("--interval", "1d")) # type: ignore
+SourceIntervals: dict[str, str | None] = {Source: GetPassArgumentValue(f"--{Source}-interval") for Source in BackupSources}
+RunOnStart: bool = HasPassArgument("--run-on-start")
+StatusPort: int | None = GetIntegerArgumentValue("--status-port", None, 1, 65535)
+BucketRefreshInterval: int = ParseDuration(GetPassArgumentValue("--bucket-refresh-interval", "1d")) # type: ignore
+Niceness: int = GetIntegerArgumentValue("--nice", 0, -20, 19) # type: ignore
+IOPriority: str | None = GetPassArgumentValue("--ionice")
+LockPath: Path = BackupRootDirectory.parent / LockFileName
+UseCompressionPolicy: bool = HasPassArgument("--compression-policy")
+CompressionRulesPath: Path = Path(GetPassArgumentValue("--compression-rules", str(BackupRootDirectory.parent / CompressionRulesFileName))).resolve() # type: ignore
+CPUJobs: int = GetIntegerArgumentValue("--cpu-jobs", os.cpu_count() or 1, 1) # type: ignore
+IOJobs: int = GetIntegerArgumentValue("--io-jobs", 4, 1) # type: ignore
+DeviceJobs: int | None = GetIntegerArgumentValue("--device-jobs", None, 0)
 
 humanize.i18n.activate("zh_CN")
-logging.info(f"MySQL保存命令：{MySQLDumpCommand}")
-logging.info(f"PostgreSQL保存命令：{PostgreSQLDumpCommand}")
-logging.info(f"网站根目录：{WebsiteLocation}")
-logging.info(f"当前时间：{CurrentTime}")
-
-if (sys.platform.startswith("linux") == False):
-    logging.fatal("本程序仅支持Linux平台。")
-    sys.exit(1)
-
-logging.info("备份开始。")
-
-if BackupRootDirectory.exists() == False:
-    logging.info(f"备份根目录 {BackupRootDirectory} 不存在，正在创建。")
-    BackupRootDirectory.mkdir()
-else:
-    logging.info(f"备份目录体积限制：{humanize.naturalsize(BackupDirectorySizeLimit)}")
-    while True:
-        TotalSize, TotalSizeHumanize = GetDirectorySize(BackupRootDirectory)
-        logging.info(f"当前备份目录体积：{TotalSizeHumanize}")
-        if TotalSize <= BackupDirectorySizeLimit:
-            logging.info("备份目录体积在限制范围内，备份继续。")
-            break
-        Files = [File.name for File in BackupRootDirectory.iterdir() if File.is_file()]
-        if len(Files) == 0:
-            break
-        Files.sort()
-        Oldest = Files[0]
-        OldestPath = os.path.join(BackupRootDirectory, Oldest)
-        logging.warning(f"备份目录已超出体积限制，正在删除最旧的备份：{OldestPath}，文件大小：{humanize.naturalsize(os.path.getsize(OldestPath))}")
-        os.remove(OldestPath)
-os.chdir(BackupRootDirectory)
-
-os.mkdir(CurrentTime)
-os.chdir(CurrentTime)
-
-logging.info("开始数据库备份。")
-if SkipDatabaseBackup == True:
-    logging.warning("由于传入了跳过数据库备份的参数，故跳过数据库备份。")
-else:
-    ZipWorker.submit(BackupDatabase, MySQLDumpCommand, MySQLDumpedFileName, MySQLDumpErrorLogFileName, "MySQL")
-    ZipWorker.submit(BackupDatabase, PostgreSQLDumpCommand, PostgreSQLDumpedFileName, PostgreSQLDumpErrorLogFileName, "PostgreSQL", "postgres")
-
-if SkipWebsiteBackup == True:
-    logging.warning("由于传入了跳过网站备份的参数，故跳过网站备份。")
-else:
-    logging.info(f"开始备份网站根目录：{WebsiteLocation}")
-    BackupWebsite(WebsiteLocation, WebsiteZipFileName)
-
-if SkipCertbotBackup == True:
-    logging.warning("由于传入了跳过Certbot备份的参数，故跳过Certbot备份。")
-else:
-    logging.info(f"开始备份Certbot目录：{CertbotLocation}")
-    BackupCertbot(CertbotLocation, CertbotZipFileName)
-
-if SkipCustomPathBackup == True:
-    logging.warning("由于传入了跳过自定义路径备份的参数，故跳过自定义路径备份。")
-else:
-    logging.info("开始备份自定义路径。")
-    BackupCustomPath(BackupRootDirectory.parent / CustomPathListFileName)
-
-ZipWorker.shutdown(wait=True)
-for File in os.listdir("."):
-    logging.info(f"{File} 的大小为：{ humanize.naturalsize( os.path.getsize(File) ) }")
-
-logging.info("开始计算备份文件的SHA256校验和。")
-GenerateSHA256Checksum(ChecksumFileName)
-logging.info("备份文件的SHA256校验和计算完成。")
-logging.info(f"SHA256校验和已保存：{ChecksumFileName}")
-
-logging.info("所有备份操作已完成。")
-os.chdir("..")
-
-logging.info(f"开始打包备份文件夹为：{ArchiveZipFileName}")
-PackAllFiles(ArchiveZipFileName, Path(CurrentTime))
-logging.info(f"备份文件夹已经打包完成，压缩文件大小：{humanize.naturalsize(os.path.getsize(ArchiveZipFileName))}")
-
-logging.info(f"即将删除备份文件夹，内容如下：")
-LogDirectoryTree(Path(CurrentTime))
-shutil.rmtree(CurrentTime)
-logging.info(f"已删除原始备份文件夹：{CurrentTime}")
-
-if SkipUpload == True:
-    logging.warning("由于传入了跳过上传备份的参数，故跳过上传备份。")
-else:
-    if all( S3_Config is not None for S3_Config in (R2_Endpoint, R2_Access_Key, R2_Secret_Key, R2_Bucket_Name) ) == True:
-        logging.info("开始上传压缩文件到R2存储桶。")
-        UploadFile(ArchiveZipFileName)
-        logging.info(f"已上传备份文件：{ArchiveZipFileName}，文件大小：{humanize.naturalsize(os.path.getsize(ArchiveZipFileName))}。")
-        logging.info(f"当前存储桶内的所有文件总共占用了：{GetBucketTotalSize(ForceFetch=True)[1]} 的空间。")
+
+def RunBackup(Sources: frozenset[str]):
+    global RunSucceeded
+    RunSucceeded = False
+    ResetRunRecords()
+    Manifest.Clear()
+    CurrentTime: str = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
+    # 守护进程中单独调度的来源各自生成一个备份文件，文件名开头仍然是时间，保留策略可以照常解析
+    BackupName: str = CurrentTime if Sources == frozenset(BackupSources) else f"{CurrentTime}-{'-'.join(Source for Source in BackupSources if Source in Sources)}"
+    ArchiveZipFileName: str = f"{BackupName}.zip"
+    logging.info(f"MySQL保存命令：{MySQLDumpCommand}")
+    logging.info(f"PostgreSQL保存命令：{PostgreSQLDumpCommand}")
+    logging.info(f"网站根目录：{WebsiteLocation}")
+    logging.info(f"当前时间：{CurrentTime}")
+
+    logging.info("备份开始。")
+
+    if BackupRootDirectory.exists() == False:
+        logging.info(f"备份根目录 {BackupRootDirectory} 不存在，正在创建。")
+        BackupRootDirectory.mkdir()
+    else:
+        logging.info(f"备份目录体积限制：{humanize.naturalsize(RetentionPolicyConfig.SizeLimit)}")
+        Plan = EnforceRetention(BackupRootDirectory, RetentionPolicyConfig)
+        logging.info(f"当前备份目录体积：{humanize.naturalsize(sum(Backup.Size for Backup, _ in Plan.Keep))}")
+    os.chdir(BackupRootDirectory)
+
+    Index: FileIndex | None = None
+    FullBackup: bool = True
+    if IncrementalBackup == True and SinglePassArchive == True:
+        logging.warning("单次打包模式暂不支持增量备份，本次将进行完整备份。")
+    elif IncrementalBackup == True:
+        Index = FileIndex(BackupRootDirectory.parent / IndexFileName)
+        Index.ForgetMissingArchives(BackupRootDirectory)
+        FullBackup = ForceFullBackup or Index.IsFullBackupDue(FullBackupInterval)
+        ConfigureIncrementalBackup(Index, ArchiveZipFileName, FullBackup)
+
+    UploadAvailable: bool = all( S3_Config is not None for S3_Config in (R2_Endpoint, R2_Access_Key, R2_Secret_Key, R2_Bucket_Name) )
+    StreamArchiveUpload: bool = StreamUpload
+    if StreamArchiveUpload == True and (SkipUpload == True or UploadAvailable == False or UseChunkStore == True):
+        logging.warning("流式上传需要可用的存储桶且不能与分块存储模式同时使用，本次将在打包完成后再上传。")
+        StreamArchiveUpload = False
+    if UploadAvailable == True and SkipUpload == False:
+        ConfigureTransferController(AdaptiveUpload, BandwidthLimit)
+    ArchiveUpload: StreamingUpload | None = None
+
+    Builder: ArchiveBuilder | None = None
+    ArchiveFile: IO[bytes] | None = None
+    # 流式上传从创建起就已经在存储桶中开始了分块上传，之后任何一步失败（包括Ctrl+C）都要中止上传并关闭文件，否则未完成的分块会一直占用存储空间
+    try:
+        if SinglePassArchive == True:
+            logging.info(f"以单次打包模式直接生成压缩文件：{ArchiveZipFileName}")
+            if StreamArchiveUpload == True:
+                PreviousArchives = sorted(File for File in BackupRootDirectory.iterdir() if File.is_file() and File.suffix == ".zip")
+                ArchiveUpload = StreamingUpload(ArchiveZipFileName, PreviousArchives[-1].stat().st_size if len(PreviousArchives) > 0 else 0)
+                ArchiveFile = open(ArchiveZipFileName, "wb")
+                Builder = ArchiveBuilder(ArchiveZipFileName, OutputFile=TeeWriter(ArchiveFile, ArchiveUpload))
+            else:
+                Builder = ArchiveBuilder(ArchiveZipFileName)
+        else:
+            os.mkdir(BackupName)
+            os.chdir(BackupName)
+
+        logging.info("开始数据库备份。")
+        if "database" not in Sources:
+            logging.info("本次备份任务不包含数据库备份。")
+        elif SkipDatabaseBackup == True:
+            logging.warning("由于传入了跳过数据库备份的参数，故跳过数据库备份。")
+        elif ParallelDatabaseDump == True:
+            logging.info(f"以并行模式逐个数据库备份，并行数：{DatabaseDumpJobs}")
+            if Builder is not None:
+                SubmitBackupTask("数据库", "io", None, BackupDatabasesIntoArchive, Builder, DatabaseDumpJobs, SplitLargeTables)
+            else:
+                SubmitBackupTask("MySQL", "io", None, BackupMySQLDatabases, Path(MySQLDirectoryName), DatabaseDumpJobs, SplitLargeTables)
+                SubmitBackupTask("PostgreSQL", "io", None, BackupPostgreSQLDatabases, Path(PostgreSQLDirectoryName), DatabaseDumpJobs)
+        elif Builder is not None:
+            SubmitBackupTask("MySQL", "io", None, BackupDatabaseIntoArchive, Builder, MySQLDumpCommand, MySQLDumpedFileName, MySQLDumpErrorLogFileName, "MySQL")
+            SubmitBackupTask("PostgreSQL", "io", None, BackupDatabaseIntoArchive, Builder, PostgreSQLDumpCommand, PostgreSQLDumpedFileName, PostgreSQLDumpErrorLogFileName, "PostgreSQL", "postgres")
+        elif StreamDatabaseDump == True:
+            logging.info("数据库备份将直接流式写入压缩文件。")
+            SubmitBackupTask("MySQL", "io", None, BackupDatabaseStream, MySQLDumpCommand, MySQLDumpedFileName + DatabaseStreamArchiveSuffix, MySQLDumpedFileName, MySQLDumpErrorLogFileName, "MySQL")
+            SubmitBackupTask("PostgreSQL", "io", None, BackupDatabaseStream, PostgreSQLDumpCommand, PostgreSQLDumpedFileName + DatabaseStreamArchiveSuffix, PostgreSQLDumpedFileName, PostgreSQLDumpErrorLogFileName, "PostgreSQL", "postgres")
+        else:
+            SubmitBackupTask("MySQL", "io", None, BackupDatabase, MySQLDumpCommand, MySQLDumpedFileName, MySQLDumpErrorLogFileName, "MySQL")
+            SubmitBackupTask("PostgreSQL", "io", None, BackupDatabase, PostgreSQLDumpCommand, PostgreSQLDumpedFileName, PostgreSQLDumpErrorLogFileName, "PostgreSQL", "postgres")
+
+        if "website" not in Sources:
+            logging.info("本次备份任务不包含网站备份。")
+        elif SkipWebsiteBackup == True:
+            logging.warning("由于传入了跳过网站备份的参数，故跳过网站备份。")
+        else:
+            logging.info(f"开始备份网站根目录：{WebsiteLocation}")
+            if Builder is not None:
+                SubmitBackupTask(WebsiteZipFileName, "io", WebsiteLocation, AddDirectoryIntoArchive, Builder, WebsiteLocation, Path(WebsiteZipFileName).stem)
+            else:
+                BackupWebsite(WebsiteLocation, WebsiteZipFileName)
+
+        if "certbot" not in Sources:
+            logging.info("本次备份任务不包含Certbot备份。")
+        elif SkipCertbotBackup == True:
+            logging.warning("由于传入了跳过Certbot备份的参数，故跳过Certbot备份。")
+        else:
+            logging.info(f"开始备份Certbot目录：{CertbotLocation}")
+            if Builder is not None:
+                SubmitBackupTask(CertbotZipFileName, "io", CertbotLocation, AddDirectoryIntoArchive, Builder, CertbotLocation, Path(CertbotZipFileName).stem)
+            else:
+                BackupCertbot(CertbotLocation, CertbotZipFileName)
+
+        if "custom-path" not in Sources:
+            logging.info("本次备份任务不包含自定义路径备份。")
+        elif SkipCustomPathBackup == True:
+            logging.warning("由于传入了跳过自定义路径备份的参数，故跳过自定义路径备份。")
+        else:
+            logging.info("开始备份自定义路径。")
+            if Builder is not None:
+                BackupCustomPathIntoArchive(Builder, BackupRootDirectory.parent / CustomPathListFileName)
+            else:
+                BackupCustomPath(BackupRootDirectory.parent / CustomPathListFileName)
+
+        FailedTasks = WaitForBackupTasks()
+        if Builder is not None:
+            Builder.Close(ChecksumFileName)
+            if ArchiveUpload is not None:
+                ArchiveFile.close() # type: ignore
+                ArchiveUpload.Complete()
+    except BaseException:
+        if ArchiveFile is not None:
+            ArchiveFile.close()
+        if ArchiveUpload is not None:
+            ArchiveUpload.Abort()
+        raise
+    if Builder is not None:
+        logging.info("所有备份操作已完成。")
+    else:
+        for File in os.listdir("."):
+            logging.info(f"{File} 的大小为：{ humanize.naturalsize( os.path.getsize(File) ) }")
+
+        logging.info("开始写出备份文件的SHA256校验和清单。")
+        GenerateSHA256Checksum(ChecksumFileName)
+        logging.info("备份文件的SHA256校验和清单写出完成。")
+        logging.info(f"SHA256校验和已保存：{ChecksumFileName}")
+
+        logging.info("所有备份操作已完成。")
+        os.chdir("..")
+
+        logging.info(f"开始打包备份文件夹为：{ArchiveZipFileName}")
+        if StreamArchiveUpload == True:
+            ArchiveUpload = StreamingUpload(ArchiveZipFileName, GetDirectorySize(Path(BackupName))[0])
+            try:
+                with open(ArchiveZipFileName, "wb") as ArchiveFile:
+                    PackAllFiles(TeeWriter(ArchiveFile, ArchiveUpload), Path(BackupName))
+                ArchiveUpload.Complete()
+            except BaseException:
+                ArchiveUpload.Abort()
+                raise
+        else:
+            PackAllFiles(ArchiveZipFileName, Path(BackupName))
+        logging.info(f"备份文件夹已经打包完成，压缩文件大小：{humanize.naturalsize(os.path.getsize(ArchiveZipFileName))}")
+        if Index is not None:
+            Index.RecordBackup(ArchiveZipFileName, "full" if FullBackup else "incremental")
+            Index.Close()
+
+        logging.info(f"即将删除备份文件夹，内容如下：")
+        LogDirectoryTree(Path(BackupName))
+        shutil.rmtree(BackupName)
+        logging.info(f"已删除原始备份文件夹：{BackupName}")
+
+    SaveCompressionPolicy()
+    ConfigureArchiveReferences(LoadArchiveReferences(BackupRootDirectory.parent / IndexFileName))
+
+    if SkipUpload == True:
+        logging.warning("由于传入了跳过上传备份的参数，故跳过上传备份。")
     else:
-        logging.warning("由于缺少访问存储桶所需的必要信息，故跳过上传备份")
-        logging.warning("具体情况请查看程序开始运行时打印的WARNING日志。")
+        if ArchiveUpload is not None:
+            logging.info(f"已在打包的同时上传备份文件：{ArchiveZipFileName}，文件大小：{humanize.naturalsize(os.path.getsize(ArchiveZipFileName))}。")
+            logging.info(f"当前存储桶内的所有文件总共占用了：{GetBucketTotalSize()[1]} 的空间。")
+        elif UploadAvailable == True:
+            logging.info("开始上传压缩文件到R2存储桶。")
+            if UseChunkStore == True:
+                UploadFileToChunkStore(ArchiveZipFileName)
+            elif ResumableUpload == True or AdaptiveUpload == True or BandwidthLimit > 0:
+                ResumePendingUploads(BackupRootDirectory)
+                ResumableUploadFile(Path(ArchiveZipFileName))
+            else:
+                UploadFile(ArchiveZipFileName)
+            logging.info(f"已上传备份文件：{ArchiveZipFileName}，文件大小：{humanize.naturalsize(os.path.getsize(ArchiveZipFileName))}。")
+            logging.info(f"当前存储桶内的所有文件总共占用了：{GetBucketTotalSize()[1]} 的空间。")
+        else:
+            logging.warning("由于缺少访问存储桶所需的必要信息，故跳过上传备份")
+            logging.warning("具体情况请查看程序开始运行时打印的WARNING日志。")
+
+    # 失败的任务不影响其余内容的打包和上传，但本次运行仍然算作失败，单次运行时返回值不为0
+    if len(FailedTasks) > 0:
+        raise RuntimeError(f"{len(FailedTasks)} 个备份任务失败：{'；'.join(f'{Task.Name}（{Task.Error}）' for Task in FailedTasks)}")
+    RunSucceeded = True
+    logging.info("备份过程全部完成。")
 
-logging.info("备份过程全部完成。")
\ No newline at end of file
+def RunDaemonJob(Job: BackupJob):
+    # 每次备份都会切换工作目录，结束后回到原来的目录，下一次备份中的相对路径才不会出错
+    WorkingDirectory = os.getcwd()
+    try:
+        RunBackup(Job.Sources)
+    finally:
+        os.chdir(WorkingDirectory)
+        WriteRunReport(RunReportFileName, PrometheusTextfile, RunSucceeded)
+
+def BuildDaemonJobs() -> list[BackupJob]:
+    # 单独指定了间隔的来源各自成为一个任务，其余来源按--interval合并为一个任务
+    Jobs: list[BackupJob] = []
+    for Source, Interval in SourceIntervals.items():
+        if Interval is not None:
+            Jobs.append(BackupJob(Source, frozenset({Source}), ParseDuration(Interval)))
+    RemainingSources = frozenset(Source for Source, Interval in SourceIntervals.items() if Interval is None)
+    if len(RemainingSources) > 0:
+        Jobs.append(BackupJob("all" if len(RemainingSources) == len(BackupSources) else "default", RemainingSources, DefaultInterval))
+    return Jobs
+
+if __name__ == "__main__":
+    if (sys.platform.startswith("linux") == False):
+        logging.fatal("本程序仅支持Linux平台。")
+        sys.exit(1)
+
+    ConfigureProcessPriority(Niceness, IOPriority)
+    ConfigureCompressionWorkers(CompressionWorkers)
+    ConfigureTaskScheduler(CPUJobs, IOJobs, DeviceJobs, BackupRootDirectory)
+    ConfigureFastHash(FastHash)
+    if UseCompressionPolicy == True:
+        ConfigureCompressionPolicy(BackupRootDirectory.parent / PolicyCacheFileName, CompressionRulesPath)
+    if UseChunkStore == True:
+        WarnIfChunkingIsSlow()
+
+    if RetentionDryRun == True:
+        if BackupRootDirectory.exists() == True:
+            EnforceRetention(BackupRootDirectory, RetentionPolicyConfig, DryRun=True)
+        logging.info("由于传入了保留策略试运行的参数，本次不进行备份。")
+        sys.exit(0)
+
+    BackupLock = RunLock(LockPath)
+    if DaemonMode == True:
+        Daemon = BackupDaemon(BuildDaemonJobs(), RunDaemonJob, BackupLock, BucketRefreshInterval)
+        if StatusPort is not None:
+            Daemon.StartStatusServer(StatusPort)
+        logging.info("已进入守护进程模式。")
+        Daemon.Serve(RunOnStart)
+    else:
+        if BackupLock.Acquire(Wait=False) == False:
+            logging.fatal("为避免同时进行的备份互相争用磁盘和CPU，本次运行已退出。")
+            sys.exit(1)
+        atexit.register(lambda: WriteRunReport(RunReportFileName, PrometheusTextfile, RunSucceeded))
+        RunBackup(frozenset(BackupSources))
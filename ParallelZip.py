@@ -0,0 +1,276 @@
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+import os
+from pathlib import Path
+import struct
+import tempfile
+import time
+from typing import IO
+import zipfile
+import zlib
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+from CompressionPolicy import ChooseCompression, ZstdLongDistanceOptions
+
+# Python 3.14之前的zipfile没有ZIP_ZSTANDARD，此时也没有compression.zstd，不会选择zstd
+ZIP_ZSTANDARD: int | None = getattr(zipfile, "ZIP_ZSTANDARD", None)
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+ParallelZipChunkSize: int = 8 * 1024 * 1024
+DeflateWindowSize: int = 32 * 1024
+
+@dataclass
+class ZipEntry:
+    FilePath: str
+    ArcName: bytes
+    Method: int
+    Level: int
+    FileSize: int
+    ModifiedTime: float
+    Mode: int
+    Flags: int = 0
+    CRC: int = 0
+    CompressSize: int = 0
+    HeaderOffset: int = 0
+    Zip64: bool = False
+    UseDataDescriptor: bool = False
+    LongDistance: bool = False
+
+@dataclass
+class CompressedBlock:
+    Entry: ZipEntry
+    IsFirst: bool
+    IsLast: bool
+    Data: bytes | IO[bytes]
+    CRC: int
+    Size: int
+    CompressSize: int
+
+def GF2MatrixTimes(Matrix: list[int], Vector: int) -> int:
+    Sum = 0
+    Index = 0
+    while Vector:
+        if Vector & 1:
+            Sum ^= Matrix[Index]
+        Vector >>= 1
+        Index += 1
+    return Sum
+
+def GF2MatrixSquare(Matrix: list[int]) -> list[int]:
+    return [GF2MatrixTimes(Matrix, Row) for Row in Matrix]
+
+def CRC32Combine(CRC1: int, CRC2: int, Length2: int) -> int:
+    # 与zlib的crc32_combine相同的GF(2)矩阵算法，用于把各分块独立计算的CRC合并成整个文件的CRC
+    if Length2 == 0:
+        return CRC1
+    Odd = [0xEDB88320] + [1 << Index for Index in range(31)]
+    Even = GF2MatrixSquare(Odd)
+    Odd = GF2MatrixSquare(Even)
+    while True:
+        Even = GF2MatrixSquare(Odd)
+        if Length2 & 1:
+            CRC1 = GF2MatrixTimes(Even, CRC1)
+        Length2 >>= 1
+        if Length2 == 0:
+            break
+        Odd = GF2MatrixSquare(Even)
+        if Length2 & 1:
+            CRC1 = GF2MatrixTimes(Odd, CRC1)
+        Length2 >>= 1
+        if Length2 == 0:
+            break
+    return CRC1 ^ CRC2
+
+def DOSDateTime(ModifiedTime: float) -> tuple[int, int]:
+    Year, Month, Day, Hour, Minute, Second = time.localtime(ModifiedTime)[:6]
+    if Year < 1980:
+        Year, Month, Day, Hour, Minute, Second = 1980, 1, 1, 0, 0, 0
+    return (Year - 1980) << 9 | Month << 5 | Day, Hour << 11 | Minute << 5 | Second // 2
+
+def CompressWholeFile(Entry: ZipEntry) -> CompressedBlock:
+    if Entry.Method == ZIP_ZSTANDARD and Entry.FileSize > ParallelZipChunkSize:
+        return CompressLargeFileZstd(Entry)
+    with open(Entry.FilePath, "rb") as DataFile:
+        Data = DataFile.read()
+    if Entry.Method == zipfile.ZIP_DEFLATED:
+        Compressor = zlib.compressobj(Entry.Level, zlib.DEFLATED, -15)
+        Compressed = Compressor.compress(Data) + Compressor.flush()
+    elif Entry.Method == ZIP_ZSTANDARD:
+        assert zstd is not None
+        Compressed = zstd.compress(Data, level=Entry.Level)
+    else:
+        Compressed = Data
+    return CompressedBlock(Entry, True, True, Compressed, zlib.crc32(Data), len(Data), len(Compressed))
+
+def CompressLargeFileZstd(Entry: ZipEntry) -> CompressedBlock:
+    # zipfile只能解压单个zstd帧，因此大文件不能像Deflate那样拆成多个独立压缩的分块，只能由一个工作线程流式压缩
+    assert zstd is not None
+    Compressor = zstd.ZstdCompressor(options=ZstdLongDistanceOptions(Entry.Level)) if Entry.LongDistance else zstd.ZstdCompressor(level=Entry.Level)
+    Output = tempfile.TemporaryFile()
+    CRC = 0
+    Size = 0
+    with open(Entry.FilePath, "rb") as DataFile:
+        while DataChunk := DataFile.read(ParallelZipChunkSize):
+            CRC = zlib.crc32(DataChunk, CRC)
+            Size += len(DataChunk)
+            Output.write(Compressor.compress(DataChunk))
+    Output.write(Compressor.flush())
+    CompressSize = Output.tell()
+    Output.seek(0)
+    return CompressedBlock(Entry, True, True, Output, CRC, Size, CompressSize)
+
+def CompressFileChunk(Entry: ZipEntry, Offset: int, IsLast: bool) -> CompressedBlock:
+    with open(Entry.FilePath, "rb") as DataFile:
+        Dictionary = b""
+        if Entry.Method == zipfile.ZIP_DEFLATED and Offset > 0:
+            DataFile.seek(Offset - DeflateWindowSize)
+            Dictionary = DataFile.read(DeflateWindowSize)
+        else:
+            DataFile.seek(Offset)
+        Data = DataFile.read(ParallelZipChunkSize)
+    if Entry.Method == zipfile.ZIP_DEFLATED:
+        # 以前一块末尾的32KiB作为预设字典，非最后一块以Z_SYNC_FLUSH结尾，拼接后仍是一个合法的Deflate流
+        Compressor = zlib.compressobj(Entry.Level, zlib.DEFLATED, -15, zdict=Dictionary) if Dictionary else zlib.compressobj(Entry.Level, zlib.DEFLATED, -15)
+        Compressed = Compressor.compress(Data) + Compressor.flush(zlib.Z_FINISH if IsLast else zlib.Z_SYNC_FLUSH)
+    else:
+        Compressed = Data
+    return CompressedBlock(Entry, Offset == 0, IsLast, Compressed, zlib.crc32(Data), len(Data), len(Compressed))
+
+class ParallelZipWriter:
+    def __init__(self, OutputFile: IO[bytes], CompressionPool: ThreadPoolExecutor, Window: int):
+        self.OutputFile = OutputFile
+        self.CompressionPool = CompressionPool
+        self.Window = Window
+        self.Offset = 0
+        self.Entries: list[ZipEntry] = []
+
+    def Write(self, Data: bytes):
+        self.OutputFile.write(Data)
+        self.Offset += len(Data)
+
+    def SubmitEntry(self, Entry: ZipEntry) -> Iterator[Future]:
+        if Entry.FileSize <= ParallelZipChunkSize or Entry.Method == ZIP_ZSTANDARD:
+            yield self.CompressionPool.submit(CompressWholeFile, Entry)
+            return
+        FileSize = Entry.FileSize
+        Entry.UseDataDescriptor = True
+        Entry.Zip64 = True
+        Entry.Flags |= 0x08
+        for Offset in range(0, FileSize, ParallelZipChunkSize):
+            yield self.CompressionPool.submit(CompressFileChunk, Entry, Offset, Offset + ParallelZipChunkSize >= FileSize)
+
+    def WriteEntries(self, Entries: Iterator[ZipEntry]):
+        Pending: deque[Future] = deque()
+        for Entry in Entries:
+            for Task in self.SubmitEntry(Entry):
+                Pending.append(Task)
+                while len(Pending) >= self.Window:
+                    self.WriteBlock(Pending.popleft().result())
+        while Pending:
+            self.WriteBlock(Pending.popleft().result())
+        self.WriteCentralDirectory()
+
+    def WriteBlock(self, Block: CompressedBlock):
+        Entry = Block.Entry
+        if Block.IsFirst:
+            Entry.HeaderOffset = self.Offset
+            Entry.CRC = Block.CRC
+            Entry.CompressSize = Block.CompressSize
+            Entry.FileSize = Block.Size
+            if Entry.UseDataDescriptor == False:
+                Entry.Zip64 = Entry.FileSize > ZIP64_LIMIT or Entry.CompressSize > ZIP64_LIMIT
+            self.WriteLocalHeader(Entry)
+            self.Entries.append(Entry)
+        else:
+            Entry.CRC = CRC32Combine(Entry.CRC, Block.CRC, Block.Size)
+            Entry.CompressSize += Block.CompressSize
+            Entry.FileSize += Block.Size
+        if isinstance(Block.Data, bytes):
+            self.Write(Block.Data)
+        else:
+            with Block.Data:
+                while DataChunk := Block.Data.read(ParallelZipChunkSize):
+                    self.Write(DataChunk)
+        if Entry.UseDataDescriptor and Block.IsLast:
+            self.Write(struct.pack("<LLQQ", 0x08074B50, Entry.CRC, Entry.CompressSize, Entry.FileSize))
+
+    def VersionNeeded(self, Entry: ZipEntry) -> int:
+        if Entry.Method == ZIP_ZSTANDARD:
+            return 63
+        return 45 if Entry.Zip64 else 20
+
+    def WriteLocalHeader(self, Entry: ZipEntry):
+        Date, Time = DOSDateTime(Entry.ModifiedTime)
+        Extra = b""
+        CRC, CompressSize, FileSize = Entry.CRC, Entry.CompressSize, Entry.FileSize
+        if Entry.UseDataDescriptor:
+            CRC = CompressSize = FileSize = 0
+        if Entry.Zip64:
+            Extra = struct.pack("<HHQQ", 1, 16, FileSize, CompressSize)
+            CompressSize = FileSize = 0xFFFFFFFF
+        self.Write(struct.pack("<LHHHHHLLLHH",
+            0x04034B50, self.VersionNeeded(Entry), Entry.Flags, Entry.Method, Time, Date,
+            CRC, CompressSize, FileSize, len(Entry.ArcName), len(Extra)) + Entry.ArcName + Extra)
+
+    def WriteCentralDirectory(self):
+        CentralDirectoryOffset = self.Offset
+        for Entry in self.Entries:
+            Date, Time = DOSDateTime(Entry.ModifiedTime)
+            Zip64Fields: list[int] = []
+            FileSize, CompressSize, HeaderOffset = Entry.FileSize, Entry.CompressSize, Entry.HeaderOffset
+            if FileSize > ZIP64_LIMIT or Entry.Zip64:
+                Zip64Fields.append(FileSize)
+                FileSize = 0xFFFFFFFF
+            if CompressSize > ZIP64_LIMIT or Entry.Zip64:
+                Zip64Fields.append(CompressSize)
+                CompressSize = 0xFFFFFFFF
+            if HeaderOffset > ZIP64_LIMIT:
+                Zip64Fields.append(HeaderOffset)
+                HeaderOffset = 0xFFFFFFFF
+            Extra = struct.pack(f"<HH{len(Zip64Fields)}Q", 1, 8 * len(Zip64Fields), *Zip64Fields) if Zip64Fields else b""
+            VersionNeeded = max(self.VersionNeeded(Entry), 45 if Zip64Fields else 20)
+            self.Write(struct.pack("<LHHHHHHLLLHHHHHLL",
+                0x02014B50, 3 << 8 | VersionNeeded, VersionNeeded, Entry.Flags, Entry.Method, Time, Date,
+                Entry.CRC, CompressSize, FileSize, len(Entry.ArcName), len(Extra), 0, 0, 0, Entry.Mode << 16, HeaderOffset) + Entry.ArcName + Extra)
+        CentralDirectorySize = self.Offset - CentralDirectoryOffset
+        EntryCount = len(self.Entries)
+        if EntryCount > ZIP_FILECOUNT_LIMIT or CentralDirectoryOffset > ZIP64_LIMIT or CentralDirectorySize > ZIP64_LIMIT:
+            Zip64EndRecordOffset = self.Offset
+            self.Write(struct.pack("<LQHHLLQQQQ", 0x06064B50, 44, 45, 45, 0, 0, EntryCount, EntryCount, CentralDirectorySize, CentralDirectoryOffset))
+            self.Write(struct.pack("<LLQL", 0x07064B50, 0, Zip64EndRecordOffset, 1))
+            EntryCount = min(EntryCount, ZIP_FILECOUNT_LIMIT)
+            CentralDirectorySize = min(CentralDirectorySize, ZIP64_LIMIT)
+            CentralDirectoryOffset = min(CentralDirectoryOffset, ZIP64_LIMIT)
+        self.Write(struct.pack("<LHHHHLLH", 0x06054B50, 0, 0, EntryCount, EntryCount, CentralDirectorySize, CentralDirectoryOffset, 0))
+
+def WalkDirectoryTree(TargetDirectory: Path, CompressMethod: int, DontCompressFileExtensions: tuple[str, ...]) -> Iterator[ZipEntry]:
+    for FolderName, SubFolders, FileNames in os.walk(TargetDirectory):
+        for FileName in FileNames:
+            FilePath = os.path.join(FolderName, FileName)
+            Status = os.stat(FilePath)
+            ArcName = os.path.relpath(FilePath, TargetDirectory).replace(os.sep, "/")
+            try:
+                EncodedArcName, Flags = ArcName.encode("ascii"), 0
+            except UnicodeEncodeError:
+                EncodedArcName, Flags = ArcName.encode("utf-8"), 0x800
+            Decision = ChooseCompression(FilePath, Status, CompressMethod, DontCompressFileExtensions)
+            yield ZipEntry(FilePath, EncodedArcName, Decision.Method, Decision.Level, Status.st_size, Status.st_mtime, Status.st_mode & 0xFFFF, Flags, LongDistance=Decision.LongDistance)
+
+def ParallelZipDirectoryTree(ZipFileName: str | IO[bytes], TargetDirectory: Path, CompressionPool: ThreadPoolExecutor, Workers: int, CompressMethod: int, DontCompressFileExtensions: tuple[str, ...]) -> list[ZipEntry]:
+    if CompressMethod == ZIP_ZSTANDARD and zstd is None:
+        CompressMethod = zipfile.ZIP_DEFLATED
+    Entries = WalkDirectoryTree(TargetDirectory, CompressMethod, DontCompressFileExtensions)
+    if isinstance(ZipFileName, str):
+        with open(ZipFileName, "wb") as OutputFile:
+            Writer = ParallelZipWriter(OutputFile, CompressionPool, Workers * 4)
+            Writer.WriteEntries(Entries)
+    else:
+        Writer = ParallelZipWriter(ZipFileName, CompressionPool, Workers * 4)
+        Writer.WriteEntries(Entries)
+    return Writer.Entries
@@ -1,3 +1,4 @@
+import logging
 import os
 import sys
 from pathlib import Path
@@ -28,4 +29,42 @@ def ParsePassArguments() -> tuple[bool, bool, bool, bool, bool]:
         SkipCustomPathBackup = True
     if "--skip-upload" in sys.argv:
         SkipUpload = True
-    return SkipDatabaseBackup, SkipWebsiteBackup, SkipCertbotBackup, SkipCustomPathBackup, SkipUpload
\ No newline at end of file
+    return SkipDatabaseBackup, SkipWebsiteBackup, SkipCertbotBackup, SkipCustomPathBackup, SkipUpload
+
+def HasPassArgument(Name: str) -> bool:
+    return Name in sys.argv
+
+def GetPassArgumentValue(Name: str, Default: str | None = None) -> str | None:
+    for Index, Argument in enumerate(sys.argv):
+        if Argument.startswith(f"{Name}="):
+            return Argument.split("=", 1)[1]
+        if Argument == Name and Index + 1 < len(sys.argv):
+            return sys.argv[Index + 1]
+    return Default
+
+def GetIntegerArgumentValue(Name: str, Default: int | None, Minimum: int, Maximum: int | None = None) -> int | None:
+    Value = GetPassArgumentValue(Name)
+    if Value is None:
+        return Default
+    try:
+        Number = int(Value)
+    except ValueError:
+        Number = None
+    if Number is None or Number < Minimum or (Maximum is not None and Number > Maximum):
+        logging.fatal(f"用法：{Name}=N，N应为{f'{Minimum}到{Maximum}之间' if Maximum is not None else f'不小于{Minimum}'}的整数，当前值为：{Value}")
+        sys.exit(1)
+    return Number
+
+def ParseSize(Text: str) -> int:
+    Units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    Text = Text.strip().upper().removesuffix("B").removesuffix("I")
+    if Text[-1:] in Units:
+        return int(float(Text[:-1]) * Units[Text[-1]])
+    return int(Text)
+
+def ParseDuration(Text: str) -> int:
+    Units = {"S": 1, "M": 60, "H": 3600, "D": 86400}
+    Text = Text.strip().upper()
+    if Text[-1:] in Units:
+        return int(float(Text[:-1]) * Units[Text[-1]])
+    return int(Text)
@@ -1,16 +1,179 @@
 from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from dataclasses import asdict, dataclass
+import json
 import logging
-from time import time
+import os
+from pathlib import Path
+import resource
+import subprocess
+from threading import Lock, get_ident
+from time import thread_time, time
 
 import humanize
 
-def MeasureExecutionTime(StageName: str) -> Callable:
+@dataclass
+class StageRecord:
+    Name: str
+    Label: str
+    StartTime: float
+    WallSeconds: float = 0
+    ThreadCPUSeconds: float = 0
+    ProcessCPUSeconds: float = 0
+    ChildCPUSeconds: float = 0
+    QueueWaitSeconds: float = 0
+    BytesIn: int = 0
+    BytesOut: int = 0
+    PeakRSS: int = 0
+    Succeeded: bool = False
+
+RunStartTime: float = time()
+StageRecords: list[StageRecord] = []
+StageRecordsLock = Lock()
+ActiveStages: ContextVar[tuple[StageRecord, ...]] = ContextVar("ActiveStages", default=())
+QueueWait: ContextVar[float] = ContextVar("QueueWait", default=0)
+
+def ProcessCPUTime(Who: int) -> float:
+    Usage = resource.getrusage(Who)
+    return Usage.ru_utime + Usage.ru_stime
+
+def PeakRSS() -> int:
+    # Linux上ru_maxrss的单位是KiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def RecordStageBytes(BytesIn: int, BytesOut: int):
+    # 嵌套的阶段（例如打包所有文件里的压缩目录）会同时计入外层阶段
+    with StageRecordsLock:
+        for Stage in ActiveStages.get():
+            Stage.BytesIn += BytesIn
+            Stage.BytesOut += BytesOut
+
+def WaitForChildProcess(Process: subprocess.Popen) -> int:
+    # RUSAGE_CHILDREN是整个进程所有已回收子进程的总和，多个阶段同时等待各自的子进程时无法区分；用wait4回收，只把这一个子进程的CPU时间计入当前阶段
+    _, Status, Usage = os.wait4(Process.pid, 0)
+    Process.returncode = os.waitstatus_to_exitcode(Status)
+    with StageRecordsLock:
+        for Stage in ActiveStages.get():
+            Stage.ChildCPUSeconds += Usage.ru_utime + Usage.ru_stime
+    return Process.returncode
+
+class InstrumentedThreadPoolExecutor(ThreadPoolExecutor):
+    # 记录任务在线程池队列中等待的时间，并把提交时的阶段上下文带进工作线程
+    def submit(self, Function: Callable, /, *args, **kwargs) -> Future:
+        SubmitTime = time()
+        def Run():
+            QueueWait.set(time() - SubmitTime)
+            return Function(*args, **kwargs)
+        return super().submit(copy_context().run, Run)
+
+def ResetRunRecords():
+    # 守护进程模式下每次备份单独生成一份运行报告
+    global RunStartTime
+    with StageRecordsLock:
+        StageRecords.clear()
+        RunStartTime = time()
+
+class StageMeasurement:
+    # 跨越多个函数调用的阶段（例如流式上传）无法用装饰器包住，由调用者在开始和结束时分别调用
+    def __init__(self, StageName: str, Label: str = ""):
+        self.Stage = StageRecord(StageName, Label, time(), QueueWaitSeconds=QueueWait.get())
+        QueueWait.set(0)
+        self.StartThread = get_ident()
+        self.StartThreadCPU, self.StartProcessCPU = thread_time(), ProcessCPUTime(resource.RUSAGE_SELF)
+        self.Finished = False
+
+    def Finish(self, Succeeded: bool):
+        if self.Finished == True:
+            return
+        self.Finished = True
+        Stage = self.Stage
+        Stage.Succeeded = Succeeded
+        Stage.WallSeconds = time() - Stage.StartTime
+        # 在其他线程中结束时线程CPU时间没有意义，只记录进程CPU时间
+        if get_ident() == self.StartThread:
+            Stage.ThreadCPUSeconds = thread_time() - self.StartThreadCPU
+        Stage.ProcessCPUSeconds = ProcessCPUTime(resource.RUSAGE_SELF) - self.StartProcessCPU
+        Stage.PeakRSS = PeakRSS()
+        with StageRecordsLock:
+            StageRecords.append(Stage)
+        logging.info(f"{Stage.Name}{f'（{Stage.Label}）' if Stage.Label else ''}耗时：{humanize.naturaldelta(Stage.WallSeconds)}")
+
+def MeasureExecutionTime(StageName: str, Label: Callable[..., object] | None = None) -> Callable:
     def Decorator(Function: Callable) -> Callable:
         def Wrapper(*args, **kwargs):
-            StartTime = time()
-            Result = Function(*args, **kwargs)
-            EndTime = time()
-            logging.info(f"{StageName}耗时：{humanize.naturaldelta(EndTime - StartTime)}")
-            return Result
+            Measurement = StageMeasurement(StageName, str(Label(*args, **kwargs)) if Label is not None else "")
+            Token = ActiveStages.set(ActiveStages.get() + (Measurement.Stage,))
+            Succeeded = False
+            try:
+                Result = Function(*args, **kwargs)
+                Succeeded = True
+                return Result
+            finally:
+                ActiveStages.reset(Token)
+                Measurement.Finish(Succeeded)
         return Wrapper
     return Decorator
+
+def BuildRunReport(Succeeded: bool) -> dict:
+    with StageRecordsLock:
+        Stages = [asdict(Stage) | {"CompressionRatio": round(Stage.BytesOut / Stage.BytesIn, 4) if Stage.BytesIn > 0 and Stage.BytesOut > 0 else None} for Stage in StageRecords]
+    EndTime = time()
+    return {
+        "StartTime": RunStartTime,
+        "EndTime": EndTime,
+        "WallSeconds": EndTime - RunStartTime,
+        "ProcessCPUSeconds": ProcessCPUTime(resource.RUSAGE_SELF),
+        "ChildCPUSeconds": ProcessCPUTime(resource.RUSAGE_CHILDREN),
+        "PeakRSS": PeakRSS(),
+        "Succeeded": Succeeded,
+        "Stages": Stages }
+
+def EscapePrometheusLabel(Value: str) -> str:
+    return Value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def FormatPrometheusTextfile(Report: dict) -> str:
+    Lines: list[str] = []
+    def Metric(Name: str, Help: str, Samples: list[tuple[str, float]]):
+        Lines.append(f"# HELP {Name} {Help}")
+        Lines.append(f"# TYPE {Name} gauge")
+        Lines.extend(f"{Name}{Labels} {Value}" for Labels, Value in Samples)
+    Metric("backup_run_success", "Whether the last backup run finished successfully.", [("", int(Report["Succeeded"]))])
+    Metric("backup_run_timestamp_seconds", "Unix time when the last backup run ended.", [("", Report["EndTime"])])
+    Metric("backup_run_duration_seconds", "Wall time of the last backup run.", [("", Report["WallSeconds"])])
+    Metric("backup_run_cpu_seconds", "CPU time of the backup process and its child processes.", [("", Report["ProcessCPUSeconds"] + Report["ChildCPUSeconds"])])
+    Metric("backup_run_peak_rss_bytes", "Peak resident set size of the backup process.", [("", Report["PeakRSS"])])
+    # 同一个阶段可能执行多次（例如多个数据库），按阶段和标签汇总，避免出现重复的时间序列
+    Totals: dict[str, dict[str, float]] = {}
+    for Stage in Report["Stages"]:
+        Labels = f'{{stage="{EscapePrometheusLabel(Stage["Name"])}",label="{EscapePrometheusLabel(Stage["Label"])}"}}'
+        Total = Totals.setdefault(Labels, {"WallSeconds": 0, "CPUSeconds": 0, "QueueWaitSeconds": 0, "BytesIn": 0, "BytesOut": 0, "Failed": 0})
+        Total["WallSeconds"] += Stage["WallSeconds"]
+        Total["CPUSeconds"] += Stage["ThreadCPUSeconds"] + Stage["ChildCPUSeconds"]
+        Total["QueueWaitSeconds"] += Stage["QueueWaitSeconds"]
+        Total["BytesIn"] += Stage["BytesIn"]
+        Total["BytesOut"] += Stage["BytesOut"]
+        Total["Failed"] += int(Stage["Succeeded"] == False)
+    for Key, Name, Help in (
+            ("WallSeconds", "backup_stage_duration_seconds", "Wall time spent in a backup stage."),
+            ("CPUSeconds", "backup_stage_cpu_seconds", "CPU time of the stage thread and the child processes it waited for."),
+            ("QueueWaitSeconds", "backup_stage_queue_wait_seconds", "Time a stage waited in a thread pool queue before starting."),
+            ("BytesIn", "backup_stage_bytes_in", "Bytes read by a backup stage."),
+            ("BytesOut", "backup_stage_bytes_out", "Bytes written by a backup stage."),
+            ("Failed", "backup_stage_failures", "Number of failed executions of a backup stage.")):
+        Metric(Name, Help, [(Labels, Total[Key]) for Labels, Total in Totals.items()])
+    return "\n".join(Lines) + "\n"
+
+def WriteAtomically(FilePath: Path, Contents: str):
+    TemporaryPath = FilePath.with_name(FilePath.name + ".tmp")
+    with open(TemporaryPath, "wt", encoding="utf-8") as OutputFile:
+        OutputFile.write(Contents)
+    os.replace(TemporaryPath, FilePath)
+
+def WriteRunReport(ReportPath: Path, PrometheusTextfilePath: Path | None, Succeeded: bool):
+    Report = BuildRunReport(Succeeded)
+    WriteAtomically(ReportPath, json.dumps(Report, ensure_ascii=False, indent=2))
+    logging.info(f"运行报告已保存：{ReportPath}")
+    if PrometheusTextfilePath is not None:
+        WriteAtomically(PrometheusTextfilePath, FormatPrometheusTextfile(Report))
+        logging.info(f"Prometheus指标已保存：{PrometheusTextfilePath}")
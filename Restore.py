@@ -0,0 +1,295 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import fnmatch
+import io
+import json
+import logging
+import os
+from pathlib import Path
+import posixpath
+import sys
+from threading import Lock
+import zipfile
+
+import humanize
+from botocore.exceptions import ClientError
+
+from Checksum import ChecksumReadSize, IsHashAvailable, NewHash
+from Incremental import IncrementalManifestName
+from PrepareBackup import GetIntegerArgumentValue, GetPassArgumentValue
+from Upload import R2_Bucket_Name, S3
+
+RemoteArchivePrefix: str = "r2://"
+RemoteBlockSize: int = 1024 * 1024
+RemoteCachedBlocks: int = 8
+ChecksumManifestNames: tuple[str, ...] = ("xxh3.txt", "blake3.txt", "sha256.txt")
+
+class RemoteObjectReader(io.RawIOBase):
+    # 用Range请求按块读取存储桶里的对象，zipfile只需要读中央目录和被请求的成员，不必下载整个压缩文件
+    def __init__(self, Key: str):
+        self.Key = Key
+        self.Size: int = S3.head_object(Bucket=R2_Bucket_Name, Key=Key)["ContentLength"] # type: ignore
+        self.Position = 0
+        self.Blocks: OrderedDict[int, bytes] = OrderedDict()
+        self.BytesFetched = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.Position
+
+    def seek(self, Offset: int, Whence: int = os.SEEK_SET) -> int:
+        if Whence == os.SEEK_CUR:
+            Offset += self.Position
+        elif Whence == os.SEEK_END:
+            Offset += self.Size
+        self.Position = max(Offset, 0)
+        return self.Position
+
+    def FetchBlock(self, Index: int) -> bytes:
+        if Index in self.Blocks:
+            self.Blocks.move_to_end(Index)
+            return self.Blocks[Index]
+        Start = Index * RemoteBlockSize
+        End = min(Start + RemoteBlockSize, self.Size) - 1
+        Block = S3.get_object(Bucket=R2_Bucket_Name, Key=self.Key, Range=f"bytes={Start}-{End}")["Body"].read() # type: ignore
+        self.BytesFetched += len(Block)
+        self.Blocks[Index] = Block
+        if len(self.Blocks) > RemoteCachedBlocks:
+            self.Blocks.popitem(last=False)
+        return Block
+
+    def read(self, Size: int = -1) -> bytes:
+        End = self.Size if Size < 0 else min(self.Position + Size, self.Size)
+        Parts: list[bytes] = []
+        while self.Position < End:
+            Block = self.FetchBlock(self.Position // RemoteBlockSize)
+            Offset = self.Position % RemoteBlockSize
+            Data = Block[Offset:Offset + End - self.Position]
+            Parts.append(Data)
+            self.Position += len(Data)
+        return b"".join(Parts)
+
+    def readinto(self, Buffer) -> int:
+        Data = self.read(len(Buffer))
+        Buffer[:len(Data)] = Data
+        return len(Data)
+
+def OpenArchive(Location: str) -> zipfile.ZipFile:
+    if Location.startswith(RemoteArchivePrefix):
+        return zipfile.ZipFile(RemoteObjectReader(Location.removeprefix(RemoteArchivePrefix)))
+    return zipfile.ZipFile(Location)
+
+def SiblingLocation(Location: str, ArchiveName: str) -> str:
+    # 增量备份引用的备份与它位于同一个目录（或存储桶中的同一个前缀）下
+    if Location.startswith(RemoteArchivePrefix):
+        return RemoteArchivePrefix + posixpath.join(posixpath.dirname(Location.removeprefix(RemoteArchivePrefix)), ArchiveName)
+    return os.path.join(os.path.dirname(Location), ArchiveName)
+
+def FetchedBytes(Archive: zipfile.ZipFile) -> int:
+    return Archive.fp.BytesFetched if isinstance(Archive.fp, RemoteObjectReader) else 0 # type: ignore
+
+@dataclass
+class MemberResult:
+    Name: str
+    Size: int
+    Status: str
+    Detail: str = ""
+
+class BackupArchive:
+    # 成员名中的“/”如果前一段是压缩文件里的一个.zip成员（例如WebsiteRoot.zip/index.php），就进入这个嵌套压缩文件继续查找
+    def __init__(self, Location: str):
+        self.Location = Location
+        self.Archive = OpenArchive(Location)
+        self.Names = set(self.Archive.namelist())
+        self.Nested: dict[str, zipfile.ZipFile] = {}
+        self.IncrementalManifests: dict[str, dict[str, str] | None] = {}
+
+    def OpenNested(self, Name: str) -> zipfile.ZipFile:
+        if Name not in self.Nested:
+            self.Nested[Name] = zipfile.ZipFile(self.Archive.open(Name))
+        return self.Nested[Name]
+
+    def Resolve(self, Name: str) -> tuple[zipfile.ZipFile, str] | None:
+        if Name in self.Names:
+            return self.Archive, Name
+        for Position in range(len(Name)):
+            if Name[Position] == "/" and Name[:Position] in self.Names and Name[:Position].endswith(".zip"):
+                Nested = self.OpenNested(Name[:Position])
+                if Name[Position + 1:] in Nested.namelist():
+                    return Nested, Name[Position + 1:]
+        return None
+
+    def IncrementalFiles(self, Source: str) -> dict[str, str] | None:
+        # 增量备份的来源压缩包只包含变化的文件，.BackupManifest.json记录了每个文件实际保存在哪个备份中
+        if Source not in self.IncrementalManifests:
+            Nested = self.OpenNested(Source)
+            self.IncrementalManifests[Source] = json.loads(Nested.read(IncrementalManifestName))["Files"] if IncrementalManifestName in Nested.namelist() else None
+        return self.IncrementalManifests[Source]
+
+    def StoredIn(self, Name: str) -> str | None:
+        Source, _, Inner = Name.partition("/")
+        if Source not in self.Names or Source.endswith(".zip") == False:
+            return None
+        Files = self.IncrementalFiles(Source)
+        return Files.get(Inner) if Files is not None else None
+
+    def List(self, Patterns: list[str], IncludeReferenced: bool = False) -> list[str]:
+        Names = sorted(self.Names)
+        for Name in Names:
+            if Name.endswith(".zip") and any(Pattern.startswith(f"{Name}/") for Pattern in Patterns):
+                Inners = set(self.OpenNested(Name).namelist())
+                if IncludeReferenced == True and (Files := self.IncrementalFiles(Name)) is not None:
+                    Inners = (Inners - {IncrementalManifestName}) | set(Files)
+                Names += [f"{Name}/{Inner}" for Inner in sorted(Inners)]
+        return [Name for Name in Names if any(fnmatch.fnmatchcase(Name, Pattern) for Pattern in Patterns)]
+
+    def ReadChecksums(self) -> tuple[str, dict[str, str]]:
+        # 优先使用已安装的更快的校验算法
+        for ManifestName in ChecksumManifestNames:
+            Algorithm = ManifestName.removesuffix(".txt")
+            if ManifestName in self.Names and IsHashAvailable(Algorithm):
+                Lines = self.Archive.read(ManifestName).decode("utf-8").splitlines()
+                return Algorithm, dict(Line.rsplit(": ", 1) for Line in Lines if ": " in Line)
+        return "sha256", {}
+
+    def Close(self):
+        for Nested in self.Nested.values():
+            Nested.close()
+        self.Archive.close()
+
+def CopyMember(Archive: BackupArchive, Name: str, Algorithm: str, Expected: str | None, Output: io.BufferedIOBase | None) -> MemberResult:
+    Resolved = Archive.Resolve(Name)
+    if Resolved is None:
+        return MemberResult(Name, 0, "缺失", "压缩文件中不存在该成员")
+    ZipFile, MemberName = Resolved
+    Hash = NewHash(Algorithm)
+    Size = 0
+    try:
+        # 读到成员末尾时zipfile会校验CRC32，没有校验和清单的成员至少也能发现损坏
+        with ZipFile.open(MemberName) as Member:
+            while DataChunk := Member.read(ChecksumReadSize):
+                Hash.update(DataChunk)
+                Size += len(DataChunk)
+                if Output is not None:
+                    Output.write(DataChunk)
+    except (zipfile.BadZipFile, OSError) as Error:
+        return MemberResult(Name, Size, "损坏", str(Error))
+    if Expected is None:
+        return MemberResult(Name, Size, "CRC正确", "校验和清单中没有该成员")
+    if Hash.hexdigest() != Expected:
+        return MemberResult(Name, Size, "不匹配", f"{Algorithm}应为{Expected}，实际为{Hash.hexdigest()}")
+    return MemberResult(Name, Size, "正确")
+
+def VerifyMembers(Location: str, Names: list[str], Algorithm: str, Checksums: dict[str, str], Results: list[MemberResult], ResultsLock: Lock):
+    # 每个线程使用自己的文件句柄（或远程读取器），互不争用读取位置
+    Archive = BackupArchive(Location)
+    try:
+        for Name in Names:
+            Result = CopyMember(Archive, Name, Algorithm, Checksums.get(Name), None)
+            with ResultsLock:
+                Results.append(Result)
+            if Result.Status in ("缺失", "损坏", "不匹配"):
+                logging.error(f"{Location}：{Name} {Result.Status}，{Result.Detail}")
+            else:
+                logging.debug(f"{Location}：{Name} {Result.Status}")
+    finally:
+        Archive.Close()
+
+def VerifyArchive(Location: str, Patterns: list[str], Jobs: int) -> bool:
+    Archive = BackupArchive(Location)
+    Algorithm, Checksums = Archive.ReadChecksums()
+    Names = Archive.List(Patterns) if len(Patterns) > 0 else sorted(set(Checksums) | {Name for Name in Archive.Names if Name.endswith("/") == False and Name not in ChecksumManifestNames})
+    Archive.Close()
+    if len(Checksums) == 0:
+        logging.warning(f"{Location} 中没有校验和清单，只能校验CRC32。")
+    Results: list[MemberResult] = []
+    ResultsLock = Lock()
+    Batches = [Names[Index::Jobs] for Index in range(Jobs)]
+    with ThreadPoolExecutor(max_workers=Jobs) as VerifyWorker:
+        for Verification in [VerifyWorker.submit(VerifyMembers, Location, Batch, Algorithm, Checksums, Results, ResultsLock) for Batch in Batches if len(Batch) > 0]:
+            Verification.result()
+    Failed = [Result for Result in Results if Result.Status in ("缺失", "损坏", "不匹配")]
+    logging.info(f"{Location}：校验了 {len(Results)} 个成员（{humanize.naturalsize(sum(Result.Size for Result in Results))}），使用{Algorithm}，失败 {len(Failed)} 个。")
+    return len(Failed) == 0 and len(Results) == len(Names)
+
+def VerifyArchives(Locations: list[str], Patterns: list[str], Jobs: int) -> bool:
+    with ThreadPoolExecutor(max_workers=len(Locations)) as ArchiveWorker:
+        return all(ArchiveWorker.map(lambda Location: VerifyArchive(Location, Patterns, max(Jobs // len(Locations), 1)), Locations))
+
+def OpenReferencedArchive(Location: str, ArchiveName: str, Referenced: dict[str, BackupArchive | None]) -> BackupArchive | None:
+    if ArchiveName not in Referenced:
+        try:
+            Referenced[ArchiveName] = BackupArchive(SiblingLocation(Location, ArchiveName))
+        except (OSError, ClientError) as Error:
+            logging.error(f"增量备份 {Location} 依赖的 {ArchiveName} 无法打开：{Error}")
+            Referenced[ArchiveName] = None
+    return Referenced[ArchiveName]
+
+def RestoreMembers(Location: str, Patterns: list[str], OutputDirectory: Path) -> bool:
+    Archive = BackupArchive(Location)
+    Algorithm, Checksums = Archive.ReadChecksums()
+    Names = [Name for Name in Archive.List(Patterns, IncludeReferenced=True) if Name.endswith("/") == False]
+    if len(Names) == 0:
+        logging.error(f"{Location} 中没有与 {Patterns} 匹配的成员。")
+        return False
+    ArchiveName = posixpath.basename(Location.removeprefix(RemoteArchivePrefix)) if Location.startswith(RemoteArchivePrefix) else os.path.basename(Location)
+    Referenced: dict[str, BackupArchive | None] = {}
+    Succeeded = True
+    for Name in Names:
+        OutputPath = (OutputDirectory / Name).resolve()
+        if OutputPath.is_relative_to(OutputDirectory.resolve()) == False:
+            logging.error(f"跳过不安全的成员路径：{Name}")
+            Succeeded = False
+            continue
+        # 增量备份中未变化的文件保存在更早的备份里，从那个备份中读取
+        SourceArchive, SourceAlgorithm, SourceChecksums = Archive, Algorithm, Checksums
+        StoredIn = Archive.StoredIn(Name)
+        if StoredIn is not None and StoredIn != ArchiveName:
+            ReferencedArchive = OpenReferencedArchive(Location, StoredIn, Referenced)
+            if ReferencedArchive is None:
+                logging.error(f"{Name} 保存在 {StoredIn} 中，该备份不存在，没有恢复该文件。")
+                Succeeded = False
+                continue
+            SourceArchive = ReferencedArchive
+            SourceAlgorithm, SourceChecksums = ReferencedArchive.ReadChecksums()
+        OutputPath.parent.mkdir(parents=True, exist_ok=True)
+        TemporaryPath = OutputPath.with_name(OutputPath.name + ".partial")
+        with open(TemporaryPath, "wb") as OutputFile:
+            Result = CopyMember(SourceArchive, Name, SourceAlgorithm, SourceChecksums.get(Name), OutputFile)
+        if Result.Status in ("缺失", "损坏", "不匹配"):
+            TemporaryPath.unlink()
+            logging.error(f"{Name} {Result.Status}，{Result.Detail}，没有恢复该文件。")
+            Succeeded = False
+            continue
+        os.replace(TemporaryPath, OutputPath)
+        logging.info(f"已恢复：{OutputPath}（{humanize.naturalsize(Result.Size)}，{Result.Status}）")
+    if Location.startswith(RemoteArchivePrefix):
+        logging.info(f"从存储桶读取了 {humanize.naturalsize(FetchedBytes(Archive.Archive) + sum(FetchedBytes(ReferencedArchive.Archive) for ReferencedArchive in Referenced.values() if ReferencedArchive is not None))}。")
+    Archive.Close()
+    for ReferencedArchive in Referenced.values():
+        if ReferencedArchive is not None:
+            ReferencedArchive.Close()
+    return Succeeded
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        force=True)
+    Arguments = [Argument for Index, Argument in enumerate(sys.argv[1:]) if Argument.startswith("--") == False and sys.argv[Index] not in ("--jobs", "--only")]
+    Jobs: int = GetIntegerArgumentValue("--jobs", min(os.cpu_count() or 1, 8), 1) # type: ignore
+    Only = GetPassArgumentValue("--only")
+    if len(Arguments) >= 2 and Arguments[0] == "verify":
+        sys.exit(0 if VerifyArchives(Arguments[1:], [Only] if Only is not None else [], Jobs) else 1)
+    if len(Arguments) >= 4 and Arguments[0] == "restore":
+        sys.exit(0 if RestoreMembers(Arguments[1], Arguments[3:], Path(Arguments[2])) else 1)
+    logging.fatal("用法：uv run Restore.py verify <备份文件或r2://对象名>... [--only=成员匹配模式] [--jobs=N]")
+    logging.fatal("　　　uv run Restore.py restore <备份文件或r2://对象名> <恢复到的目录> <成员匹配模式>...")
+    sys.exit(1)
@@ -0,0 +1,191 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import math
+import os
+from pathlib import Path
+import sys
+from threading import Event, Lock
+
+import humanize
+from botocore.exceptions import ClientError
+
+from ProcessTimer import MeasureExecutionTime, RecordStageBytes
+from Upload import Bucket, Controller, MaxConcurrency, OptimizeStorage, R2_Bucket_Name, S3, StartProgressReport, StopProgressReport, WriteProgress
+
+UploadJournalSuffix: str = ".upload.json"
+
+class UploadJournal:
+    def __init__(self, FilePath: Path):
+        self.FilePath = FilePath
+        self.JournalPath = FilePath.with_name(FilePath.name + UploadJournalSuffix)
+        self.Lock = Lock()
+        self.Key = FilePath.name
+        self.UploadId = ""
+        self.PartSize = 0
+        self.Parts: dict[int, dict] = {}
+
+    def Load(self) -> bool:
+        if self.JournalPath.exists() == False:
+            return False
+        with open(self.JournalPath, "rt", encoding="utf-8") as JournalFile:
+            Journal = json.load(JournalFile)
+        # 即使无法续传也先记下旧的上传任务，由调用者中止，不在存储桶里留下未完成的分块
+        self.Key = Journal["Key"]
+        self.UploadId = Journal["UploadId"]
+        Status = self.FilePath.stat()
+        if Journal["FileSize"] != Status.st_size or Journal["ModifiedTime"] != Status.st_mtime_ns:
+            logging.warning(f"{self.FilePath} 在上次上传中断后发生了变化，将重新上传。")
+            return False
+        if "PartSize" not in Journal:
+            logging.warning(f"{self.JournalPath} 是旧版本的上传日志，分块大小不一致，将重新上传。")
+            return False
+        self.PartSize = Journal["PartSize"]
+        self.Parts = {int(PartNumber): Part for PartNumber, Part in Journal["Parts"].items()}
+        return True
+
+    def Save(self):
+        Status = self.FilePath.stat()
+        with self.Lock:
+            Journal = {
+                "Key": self.Key,
+                "UploadId": self.UploadId,
+                "PartSize": self.PartSize,
+                "FileSize": Status.st_size,
+                "ModifiedTime": Status.st_mtime_ns,
+                "Parts": {str(PartNumber): Part for PartNumber, Part in sorted(self.Parts.items())} }
+            TemporaryPath = self.JournalPath.with_name(self.JournalPath.name + ".tmp")
+            with open(TemporaryPath, "wt", encoding="utf-8") as JournalFile:
+                json.dump(Journal, JournalFile)
+                JournalFile.flush()
+                os.fsync(JournalFile.fileno())
+            os.replace(TemporaryPath, self.JournalPath)
+
+    def RecordPart(self, PartNumber: int, Part: dict):
+        with self.Lock:
+            self.Parts[PartNumber] = Part
+        self.Save()
+
+    def Remove(self):
+        self.JournalPath.unlink(missing_ok=True)
+
+def ListUploadedParts(Key: str, UploadId: str) -> dict[int, str]:
+    Paginator = S3.get_paginator("list_parts")
+    return {
+        Part["PartNumber"]: Part["ETag"] # type: ignore
+        for Page in Paginator.paginate(Bucket=R2_Bucket_Name, Key=Key, UploadId=UploadId) # type: ignore
+        for Part in Page.get("Parts", []) }
+
+def AbortMultipartUpload(Key: str, UploadId: str):
+    try:
+        S3.abort_multipart_upload(Bucket=R2_Bucket_Name, Key=Key, UploadId=UploadId) # type: ignore
+    except ClientError as Error:
+        logging.debug(f"中止分块上传任务失败：{Error}")
+
+def PartMatchesFile(Journal: UploadJournal, Part: dict) -> bool:
+    # 文件大小和修改时间相同也不能保证内容没有被改写，续传前重新读取每个已上传分块对应的文件范围核对SHA256
+    with open(Journal.FilePath, "rb") as DataFile:
+        DataFile.seek(Part["Offset"])
+        return hashlib.sha256(DataFile.read(Part["Size"])).hexdigest() == Part["SHA256"]
+
+def UploadPart(Journal: UploadJournal, PartNumber: int, Offset: int, Size: int):
+    try:
+        with open(Journal.FilePath, "rb") as DataFile:
+            DataFile.seek(Offset)
+            Data = DataFile.read(Size)
+        Controller.Throttle(Size)
+        Response = S3.upload_part(Bucket=R2_Bucket_Name, Key=Journal.Key, UploadId=Journal.UploadId, PartNumber=PartNumber, Body=Data) # type: ignore
+        Journal.RecordPart(PartNumber, {
+            "ETag": Response["ETag"],
+            "SHA256": hashlib.sha256(Data).hexdigest(),
+            "Offset": Offset,
+            "Size": Size })
+        WriteProgress(Size)
+    finally:
+        Controller.Release()
+
+def PrepareJournal(Journal: UploadJournal) -> bool:
+    if Journal.Load() == True:
+        try:
+            UploadedParts = ListUploadedParts(Journal.Key, Journal.UploadId)
+        except ClientError as Error:
+            logging.warning(f"无法继续上次的上传任务 {Journal.UploadId}：{Error}，将重新上传。")
+        else:
+            Journal.Parts = {PartNumber: Part for PartNumber, Part in Journal.Parts.items() if UploadedParts.get(PartNumber) == Part.get("ETag")}
+            ChangedParts = [PartNumber for PartNumber, Part in Journal.Parts.items() if PartMatchesFile(Journal, Part) == False]
+            if len(ChangedParts) > 0:
+                logging.warning(f"{Journal.FilePath} 中有 {len(ChangedParts)} 个已上传分块的内容与上传时不同，将重新上传这些分块。")
+                for PartNumber in ChangedParts:
+                    del Journal.Parts[PartNumber]
+            logging.info(f"继续上次中断的上传：{Journal.Key}，已上传 {len(Journal.Parts)} 个分块。")
+            return True
+    if Journal.UploadId != "":
+        logging.info(f"正在中止无法继续的上传任务：{Journal.UploadId}")
+        AbortMultipartUpload(Journal.Key, Journal.UploadId)
+    Journal.Key = Journal.FilePath.name
+    Journal.Parts = {}
+    Journal.PartSize = Controller.ChoosePartSize(Journal.FilePath.stat().st_size)
+    Journal.UploadId = S3.create_multipart_upload(Bucket=R2_Bucket_Name, Key=Journal.Key)["UploadId"] # type: ignore
+    Journal.Save()
+    return False
+
+@MeasureExecutionTime("可续传上传备份文件")
+def ResumableUploadFile(FilePath: Path):
+    assert R2_Bucket_Name is not None
+
+    FileSize = FilePath.stat().st_size
+    Journal = UploadJournal(FilePath)
+    if PrepareJournal(Journal) == False:
+        OptimizeStorage(FileSize)
+    # 分块大小在上传开始时就已确定并记录在上传日志中，第N个分块的偏移总是(N-1)*分块大小，续传时只需要补上缺失的编号
+    PartCount = max(math.ceil(FileSize / Journal.PartSize), 1)
+    UploadedPartNumbers = set(Journal.Parts)
+    PendingParts = [PartNumber for PartNumber in range(1, PartCount + 1) if PartNumber not in UploadedPartNumbers]
+    UploadedSize = sum(Part["Size"] for Part in Journal.Parts.values())
+    logging.info(f"最大上传并发数：{MaxConcurrency}，分块大小：{humanize.naturalsize(Journal.PartSize)}，需要上传 {humanize.naturalsize(FileSize - UploadedSize)}。")
+    TaskThread = StartProgressReport(FileSize)
+    WriteProgress(UploadedSize)
+    UploadWorker = ThreadPoolExecutor(max_workers=MaxConcurrency)
+    UploadFailed = Event()
+    try:
+        Uploads: list[Future] = []
+        for PartNumber in PendingParts:
+            Controller.Acquire()
+            if UploadFailed.is_set():
+                Controller.Release()
+                break
+            Offset = (PartNumber - 1) * Journal.PartSize
+            Upload = UploadWorker.submit(UploadPart, Journal, PartNumber, Offset, min(Journal.PartSize, FileSize - Offset))
+            Upload.add_done_callback(lambda Upload: UploadFailed.set() if Upload.cancelled() == False and Upload.exception() is not None else None)
+            Uploads.append(Upload)
+        for Upload in Uploads:
+            Upload.result()
+    except KeyboardInterrupt:
+        logging.error("检测到用户中断，上传任务已暂停，下次运行时将从上传日志继续。")
+        sys.exit(0)
+    finally:
+        UploadWorker.shutdown(wait=False, cancel_futures=True)
+        StopProgressReport(TaskThread)
+    S3.complete_multipart_upload(
+        Bucket=R2_Bucket_Name,
+        Key=Journal.Key,
+        UploadId=Journal.UploadId,
+        MultipartUpload={"Parts": [{"PartNumber": PartNumber, "ETag": Part["ETag"]} for PartNumber, Part in sorted(Journal.Parts.items())]})
+    Bucket.RecordUpload(Journal.Key, FileSize)
+    RecordStageBytes(FileSize - UploadedSize, FileSize - UploadedSize)
+    Journal.Remove()
+    logging.info(f"已完成上传：{Journal.Key}，文件大小：{humanize.naturalsize(FileSize)}。")
+
+def ResumePendingUploads(BackupRootDirectory: Path):
+    for JournalPath in sorted(BackupRootDirectory.glob(f"*{UploadJournalSuffix}")):
+        FilePath = JournalPath.with_name(JournalPath.name.removesuffix(UploadJournalSuffix))
+        if FilePath.exists() == False:
+            with open(JournalPath, "rt", encoding="utf-8") as JournalFile:
+                Journal = json.load(JournalFile)
+            logging.warning(f"未完成上传的 {FilePath.name} 已不存在，正在中止对应的分块上传任务。")
+            AbortMultipartUpload(Journal["Key"], Journal["UploadId"])
+            JournalPath.unlink()
+            continue
+        logging.info(f"发现上次未完成的上传：{FilePath.name}")
+        ResumableUploadFile(FilePath)
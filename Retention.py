@@ -0,0 +1,184 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+import logging
+import os
+from pathlib import Path
+import shutil
+import sys
+
+import humanize
+
+from Incremental import IndexFileName, LoadArchiveReferences, ReferencedArchives
+from PrepareBackup import GetIntegerArgumentValue, GetPassArgumentValue, HasPassArgument, ParseDuration, ParseSize
+
+BackupTimeFormat: str = "%Y-%m-%d %H-%M-%S"
+CompanionSuffixes: tuple[str, ...] = (".upload.json", ".sha256", ".sha256.txt")
+
+@dataclass
+class BackupEntry:
+    Name: str
+    Path: Path
+    Size: int
+    CreatedTime: datetime
+    IsDirectory: bool
+    Companions: list[Path] = field(default_factory=list)
+
+@dataclass
+class RetentionPolicy:
+    KeepLast: int = 0
+    KeepDaily: int = 0
+    KeepWeekly: int = 0
+    KeepMonthly: int = 0
+    KeepWithin: timedelta | None = None
+    SizeLimit: int = 0
+
+@dataclass
+class RetentionPlan:
+    Keep: list[tuple[BackupEntry, str]]
+    Delete: list[tuple[BackupEntry, str]]
+
+def ScanDirectorySize(Directory: str) -> int:
+    Total = 0
+    with os.scandir(Directory) as Entries:
+        for Entry in Entries:
+            if Entry.is_dir(follow_symlinks=False):
+                Total += ScanDirectorySize(Entry.path)
+            elif Entry.is_file(follow_symlinks=False):
+                Total += Entry.stat(follow_symlinks=False).st_size
+    return Total
+
+def ParseBackupTime(Name: str, ModifiedTime: float) -> datetime:
+    try:
+        return datetime.strptime(Name[:19], BackupTimeFormat)
+    except ValueError:
+        return datetime.fromtimestamp(ModifiedTime)
+
+def ScanBackupDirectory(BackupRootDirectory: Path) -> list[BackupEntry]:
+    # 只做一次scandir，DirEntry.stat()的结果会被缓存，之后的规划不再访问文件系统
+    with os.scandir(BackupRootDirectory) as Entries:
+        Scanned = {Entry.name: Entry for Entry in Entries}
+    Backups: dict[str, BackupEntry] = {}
+    Companions: list[tuple[str, os.DirEntry]] = []
+    for Name, Entry in Scanned.items():
+        # 上传日志等附属文件（例如 xxx.zip.upload.json）计入对应备份的体积，不单独作为备份参与保留规则；只认已知的后缀，同名的残留目录不能把 xxx.zip 当作自己的附属文件
+        Owner = next((Name.removesuffix(Suffix) for Suffix in CompanionSuffixes if Name.endswith(Suffix) and Name.removesuffix(Suffix) in Scanned), None)
+        if Owner is not None:
+            Companions.append((Owner, Entry))
+            continue
+        Status = Entry.stat(follow_symlinks=False)
+        IsDirectory = Entry.is_dir(follow_symlinks=False)
+        Size = ScanDirectorySize(Entry.path) if IsDirectory else Status.st_size
+        Backups[Name] = BackupEntry(Name, Path(Entry.path), Size, ParseBackupTime(Name, Status.st_mtime), IsDirectory)
+    for Owner, Entry in Companions:
+        Backups[Owner].Size += Entry.stat(follow_symlinks=False).st_size
+        Backups[Owner].Companions.append(Path(Entry.path))
+    return sorted(Backups.values(), key=lambda Backup: (Backup.CreatedTime, Backup.Name), reverse=True)
+
+def SelectByPeriod(Backups: list[BackupEntry], Count: int, Period) -> set[str]:
+    Selected: set[str] = set()
+    SeenPeriods: set = set()
+    for Backup in Backups:
+        if len(SeenPeriods) >= Count:
+            break
+        Key = Period(Backup.CreatedTime)
+        if Key not in SeenPeriods:
+            SeenPeriods.add(Key)
+            Selected.add(Backup.Name)
+    return Selected
+
+def PlanRetention(Backups: list[BackupEntry], Policy: RetentionPolicy, Now: datetime | None = None, References: dict[str, set[str]] | None = None) -> RetentionPlan:
+    Now = Now or datetime.now()
+    Reasons: dict[str, list[str]] = {Backup.Name: [] for Backup in Backups}
+    Rules = [
+        ("最近", Policy.KeepLast, lambda Time: Time),
+        ("每日", Policy.KeepDaily, lambda Time: Time.date()),
+        ("每周", Policy.KeepWeekly, lambda Time: Time.isocalendar()[:2]),
+        ("每月", Policy.KeepMonthly, lambda Time: (Time.year, Time.month)) ]
+    for RuleName, Count, Period in Rules:
+        if Count > 0:
+            for Name in SelectByPeriod(Backups, Count, Period):
+                Reasons[Name].append(RuleName)
+    if Policy.KeepWithin is not None:
+        for Backup in Backups:
+            if Now - Backup.CreatedTime <= Policy.KeepWithin:
+                Reasons[Backup.Name].append("时间范围内")
+    HasKeepRule = any(Count > 0 for _, Count, _ in Rules) or Policy.KeepWithin is not None
+    Plan = RetentionPlan([], [])
+    TotalSize = 0
+    # 备份从新到旧排列，体积限制从最新的备份开始累计，超出部分的旧备份全部删除
+    for Backup in Backups:
+        if HasKeepRule == True and len(Reasons[Backup.Name]) == 0:
+            Plan.Delete.append((Backup, "不符合任何保留规则"))
+        elif Policy.SizeLimit > 0 and TotalSize + Backup.Size > Policy.SizeLimit:
+            Plan.Delete.append((Backup, "超出备份目录体积限制"))
+            TotalSize = Policy.SizeLimit
+        else:
+            TotalSize += Backup.Size
+            Plan.Keep.append((Backup, "、".join(Reasons[Backup.Name]) or "体积限制内"))
+    # 保留的增量备份中未变化的文件存放在更早的备份里，这些备份即使超出保留规则或体积限制也不能删除，否则增量备份无法恢复
+    Needed = ReferencedArchives({Backup.Name for Backup, _ in Plan.Keep}, References or {})
+    for Backup, Reason in [(Backup, Reason) for Backup, Reason in Plan.Delete if Backup.Name in Needed]:
+        logging.warning(f"{Backup.Name} {Reason}，但仍被保留的增量备份引用，暂不删除。")
+        Plan.Delete.remove((Backup, Reason))
+        Plan.Keep.append((Backup, "被保留的增量备份引用"))
+    return Plan
+
+def LogRetentionPlan(Plan: RetentionPlan):
+    KeepSize = sum(Backup.Size for Backup, _ in Plan.Keep)
+    DeleteSize = sum(Backup.Size for Backup, _ in Plan.Delete)
+    Items = [("保留", Backup, Reason) for Backup, Reason in Plan.Keep] + [("删除", Backup, Reason) for Backup, Reason in Plan.Delete]
+    for Action, Backup, Reason in sorted(Items, key=lambda Item: Item[1].CreatedTime, reverse=True):
+        logging.info(f"{Action}：{Backup.Name}，{Backup.CreatedTime.strftime('%Y-%m-%d %H:%M:%S')}，{humanize.naturalsize(Backup.Size)}（{Reason}）")
+    logging.info(f"共保留 {len(Plan.Keep)} 个备份（{humanize.naturalsize(KeepSize)}），删除 {len(Plan.Delete)} 个备份（{humanize.naturalsize(DeleteSize)}）")
+
+def ApplyRetentionPlan(Plan: RetentionPlan):
+    for Backup, Reason in Plan.Delete:
+        logging.warning(f"{Reason}，正在删除备份：{Backup.Path}，大小：{humanize.naturalsize(Backup.Size)}")
+        if Backup.IsDirectory == True:
+            shutil.rmtree(Backup.Path)
+        else:
+            Backup.Path.unlink(missing_ok=True)
+        # 附属的上传日志不在这里删除，下次续传时ResumePendingUploads会据此中止存储桶里未完成的分块上传并清理日志
+
+def ParseKeepWithin(Text: str) -> timedelta:
+    # 不带单位的数字按天计算，也可以带上单位，例如12h、30d
+    try:
+        KeepWithin = timedelta(days=float(Text))
+    except ValueError:
+        try:
+            KeepWithin = timedelta(seconds=ParseDuration(Text))
+        except ValueError:
+            KeepWithin = None
+    if KeepWithin is None or KeepWithin < timedelta(0):
+        logging.fatal(f"用法：--keep-within=天数或带单位的时长（例如30、12h、30d），当前值为：{Text}")
+        sys.exit(1)
+    return KeepWithin
+
+def ParseRetentionPolicy(DefaultSizeLimit: int) -> RetentionPolicy:
+    KeepWithin = GetPassArgumentValue("--keep-within")
+    return RetentionPolicy(
+        KeepLast=GetIntegerArgumentValue("--keep-last", 0, 0), # type: ignore
+        KeepDaily=GetIntegerArgumentValue("--keep-daily", 0, 0), # type: ignore
+        KeepWeekly=GetIntegerArgumentValue("--keep-weekly", 0, 0), # type: ignore
+        KeepMonthly=GetIntegerArgumentValue("--keep-monthly", 0, 0), # type: ignore
+        KeepWithin=ParseKeepWithin(KeepWithin) if KeepWithin is not None else None,
+        SizeLimit=ParseSize(GetPassArgumentValue("--backup-size-limit", str(DefaultSizeLimit)))) # type: ignore
+
+def EnforceRetention(BackupRootDirectory: Path, Policy: RetentionPolicy, DryRun: bool = False) -> RetentionPlan:
+    Plan = PlanRetention(ScanBackupDirectory(BackupRootDirectory), Policy, References=LoadArchiveReferences(BackupRootDirectory.parent / IndexFileName))
+    if DryRun == True:
+        logging.info("保留策略试运行，不会删除任何文件：")
+        LogRetentionPlan(Plan)
+    else:
+        ApplyRetentionPlan(Plan)
+    return Plan
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S')
+    if len(sys.argv) < 2 or sys.argv[1].startswith("--"):
+        logging.fatal("用法：uv run Retention.py <备份目录> [--keep-last=N] [--keep-daily=N] [--keep-weekly=N] [--keep-monthly=N] [--keep-within=天数] [--backup-size-limit=大小] [--apply]")
+        sys.exit(1)
+    EnforceRetention(Path(sys.argv[1]), ParseRetentionPolicy(20 * (1024 ** 3)), DryRun=HasPassArgument("--apply") == False)
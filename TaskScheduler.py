@@ -0,0 +1,186 @@
+from collections.abc import Callable
+from contextvars import Context, copy_context
+from dataclasses import dataclass, field
+import logging
+import os
+from pathlib import Path
+from threading import Condition, Event, Thread
+from time import time
+
+import humanize
+
+from ProcessTimer import QueueWait
+
+ProgressReportInterval: float = 30
+TaskLanes: tuple[str, ...] = ("cpu", "io")
+
+@dataclass
+class BackupTask:
+    Name: str
+    Lane: str
+    Function: Callable = field(repr=False)
+    Arguments: tuple = field(repr=False)
+    Context: Context = field(repr=False)
+    Devices: tuple[int, ...] = ()
+    EstimatedSize: int | None = None
+    State: str = "queued"
+    SubmitTime: float = 0
+    StartTime: float | None = None
+    EndTime: float | None = None
+    Error: str | None = None
+
+    def Describe(self) -> str:
+        Details = [f"{self.Lane}通道"]
+        if len(self.Devices) > 0:
+            Details.append(f"设备{'、'.join(f'{os.major(Device)}:{os.minor(Device)}' for Device in self.Devices)}")
+        if self.EstimatedSize is not None:
+            Details.append(f"预计{humanize.naturalsize(self.EstimatedSize)}")
+        return f"{self.Name}（{'，'.join(Details)}）"
+
+def EstimateSize(SourcePath: Path) -> int:
+    # 只读取元数据，每个文件一次lstat，顺便预热了随后压缩时要用到的目录项缓存
+    if SourcePath.is_dir() == False:
+        return SourcePath.stat().st_size
+    Total = 0
+    Directories = [SourcePath]
+    while len(Directories) > 0:
+        try:
+            with os.scandir(Directories.pop()) as Entries:
+                for Entry in Entries:
+                    if Entry.is_dir(follow_symlinks=False):
+                        Directories.append(Path(Entry.path))
+                    elif Entry.is_file(follow_symlinks=False):
+                        Total += Entry.stat(follow_symlinks=False).st_size
+        except OSError as Error:
+            logging.debug(f"估计目录大小时无法读取：{Error}")
+    return Total
+
+def ExistingDevice(TargetPath: Path) -> int:
+    # 备份根目录在调度器创建时可能还不存在，用最近的已存在的上级目录所在的设备
+    while TargetPath.exists() == False and TargetPath != TargetPath.parent:
+        TargetPath = TargetPath.parent
+    return TargetPath.stat().st_dev
+
+def IsRotationalDevice(Device: int) -> bool:
+    # /sys/dev/block下的分区没有queue目录，需要到所属的整块磁盘下查找；tmpfs、overlay等虚拟文件系统找不到时按固态处理
+    BlockDevice = Path(f"/sys/dev/block/{os.major(Device)}:{os.minor(Device)}")
+    for QueueDirectory in (BlockDevice / "queue", BlockDevice.resolve().parent / "queue"):
+        try:
+            return (QueueDirectory / "rotational").read_text().strip() == "1"
+        except OSError:
+            continue
+    return False
+
+class BackupTaskScheduler:
+    def __init__(self, LaneWorkers: dict[str, int], DeviceJobs: int | None, Destination: Path | None = None):
+        self.LaneWorkers = LaneWorkers
+        self.DeviceJobs = DeviceJobs
+        self.Destination = Destination
+        self.DeviceLimits: dict[int, int] = {}
+        self.DeviceRunning: dict[int, int] = {}
+        self.Tasks: list[BackupTask] = []
+        self.Condition = Condition()
+        self.Workers: list[Thread] = []
+        self.ProgressStopped = Event()
+
+    def DeviceLimit(self, Device: int) -> int:
+        # 0表示不限制；未指定--device-jobs时机械硬盘同时只读一个任务，避免多个压缩任务来回寻道
+        if Device not in self.DeviceLimits:
+            if self.DeviceJobs is not None:
+                self.DeviceLimits[Device] = self.DeviceJobs
+            else:
+                self.DeviceLimits[Device] = 1 if IsRotationalDevice(Device) else 0
+            if self.DeviceLimits[Device] > 0:
+                logging.info(f"设备{os.major(Device)}:{os.minor(Device)}上同时运行的备份任务数上限：{self.DeviceLimits[Device]}")
+        return self.DeviceLimits[Device]
+
+    def Submit(self, Name: str, Lane: str, Source: Path | None, Function: Callable, *args) -> BackupTask:
+        assert Lane in TaskLanes
+        Task = BackupTask(Name, Lane, Function, args, copy_context(), SubmitTime=time())
+        Devices: set[int] = set()
+        if Source is not None and Source.exists() == False:
+            Task.EstimatedSize = 0
+        elif Source is not None:
+            Devices.add(Source.stat().st_dev)
+            Task.EstimatedSize = EstimateSize(Source)
+        # 每个任务都要把结果写到备份根目录，没有来源路径的数据库备份也一样，所以目标设备同样计入并发限制
+        if self.Destination is not None:
+            Devices.add(ExistingDevice(self.Destination))
+        Task.Devices = tuple(sorted(Devices))
+        for Device in Task.Devices:
+            self.DeviceLimit(Device)
+        with self.Condition:
+            self.Tasks.append(Task)
+            self.Condition.notify_all()
+        logging.debug(f"已加入备份任务队列：{Task.Describe()}")
+        return Task
+
+    def HasCapacity(self, Task: BackupTask) -> bool:
+        return all(self.DeviceLimits[Device] == 0 or self.DeviceRunning.get(Device, 0) < self.DeviceLimits[Device] for Device in Task.Devices)
+
+    def NextTask(self, Lane: str) -> BackupTask | None:
+        # 预计耗时最长的任务最先开始，整体结束得更早；大小未知的任务（数据库备份）通常最慢，排在最前
+        with self.Condition:
+            while True:
+                Queued = [Task for Task in self.Tasks if Task.Lane == Lane and Task.State == "queued"]
+                if len(Queued) == 0:
+                    return None
+                Ready = [Task for Task in Queued if self.HasCapacity(Task)]
+                if len(Ready) > 0:
+                    Task = max(Ready, key=lambda Task: (Task.EstimatedSize is None, Task.EstimatedSize or 0))
+                    Task.State = "running"
+                    Task.StartTime = time()
+                    for Device in Task.Devices:
+                        self.DeviceRunning[Device] = self.DeviceRunning.get(Device, 0) + 1
+                    return Task
+                self.Condition.wait()
+
+    def Execute(self, Task: BackupTask):
+        assert Task.StartTime is not None
+        QueueWait.set(Task.StartTime - Task.SubmitTime)
+        logging.info(f"开始备份任务：{Task.Describe()}，排队：{humanize.naturaldelta(Task.StartTime - Task.SubmitTime)}")
+        try:
+            Task.Function(*Task.Arguments)
+            Task.State = "succeeded"
+        except Exception as Error:
+            logging.exception(f"备份任务 {Task.Name} 失败：{Error}")
+            Task.State = "failed"
+            Task.Error = f"{type(Error).__name__}: {Error}"
+
+    def RunWorker(self, Lane: str):
+        while (Task := self.NextTask(Lane)) is not None:
+            Task.Context.run(self.Execute, Task)
+            with self.Condition:
+                Task.EndTime = time()
+                for Device in Task.Devices:
+                    self.DeviceRunning[Device] -= 1
+                self.Condition.notify_all()
+            logging.info(f"备份任务 {Task.Name} {'已完成' if Task.State == 'succeeded' else '失败'}，耗时：{humanize.naturaldelta(Task.EndTime - Task.StartTime)}") # type: ignore
+
+    def ReportProgress(self):
+        while self.ProgressStopped.wait(ProgressReportInterval) == False:
+            Now = time()
+            with self.Condition:
+                Finished = sum(Task.State in ("succeeded", "failed") for Task in self.Tasks)
+                Failed = sum(Task.State == "failed" for Task in self.Tasks)
+                Running = [f"{Task.Name}（已运行{humanize.naturaldelta(Now - Task.StartTime)}）" for Task in self.Tasks if Task.State == "running"] # type: ignore
+                Queued = [Task.Name for Task in self.Tasks if Task.State == "queued"]
+            logging.info(f"备份任务进度：已结束 {Finished}/{len(self.Tasks)}，失败 {Failed}；正在运行：{'、'.join(Running) or '无'}；排队中：{'、'.join(Queued) or '无'}")
+
+    def Wait(self) -> list[BackupTask]:
+        # 提交阶段只排队不执行，等全部任务都提交后才开始调度，最长任务优先才能对所有任务生效
+        for Lane in TaskLanes:
+            for Index in range(max(self.LaneWorkers[Lane], 1)):
+                Worker = Thread(target=self.RunWorker, args=(Lane,), name=f"BackupTask-{Lane}-{Index}", daemon=True)
+                Worker.start()
+                self.Workers.append(Worker)
+        ProgressThread = Thread(target=self.ReportProgress, daemon=True)
+        ProgressThread.start()
+        for Worker in self.Workers:
+            Worker.join()
+        self.ProgressStopped.set()
+        ProgressThread.join()
+        FailedTasks = [Task for Task in self.Tasks if Task.State == "failed"]
+        if len(self.Tasks) > 0:
+            logging.info(f"全部 {len(self.Tasks)} 个备份任务已结束，失败 {len(FailedTasks)} 个。")
+        return FailedTasks
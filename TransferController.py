@@ -0,0 +1,92 @@
+from collections import deque
+import logging
+import math
+from threading import Condition, Lock
+import time
+
+import humanize
+
+MinPartSize: int = 5 * 1024 * 1024
+MaxPartCount: int = 10000
+TargetPartSeconds: float = 8
+MeasureWindowSeconds: int = 10
+
+class TransferController:
+    def __init__(self, MaxConcurrency: int, MaxPartSize: int):
+        self.MaxConcurrency = MaxConcurrency
+        self.MaxPartSize = MaxPartSize
+        self.Adaptive = False
+        self.BandwidthLimit = 0
+        self.Limit = MaxConcurrency
+        self.InFlight = 0
+        self.Slots = Condition()
+        self.Samples: deque[int] = deque(maxlen=MeasureWindowSeconds)
+        self.PreviousRate = 0.0
+        self.Direction = 1
+        self.Rate = 0.0
+        self.TokenLock = Lock()
+        self.Tokens = 0.0
+        self.TokenTime = time.monotonic()
+
+    def Configure(self, Adaptive: bool, BandwidthLimit: int):
+        self.Adaptive = Adaptive
+        self.BandwidthLimit = BandwidthLimit
+        with self.Slots:
+            self.Limit = min(4, self.MaxConcurrency) if Adaptive else self.MaxConcurrency
+            self.Slots.notify_all()
+
+    def Acquire(self):
+        with self.Slots:
+            self.Slots.wait_for(lambda: self.InFlight < self.Limit)
+            self.InFlight += 1
+
+    def Release(self):
+        with self.Slots:
+            self.InFlight -= 1
+            self.Slots.notify_all()
+
+    def Observe(self, BytesPastSecond: int):
+        self.Samples.append(BytesPastSecond)
+        if self.Adaptive == False or len(self.Samples) < MeasureWindowSeconds:
+            return
+        self.Rate = sum(self.Samples) / len(self.Samples)
+        self.Samples.clear()
+        # 简单的爬山法：吞吐量明显上升就沿当前方向继续调整，明显下降就反向；吞吐量持平时减少连接数，用更少的连接达到同样的速度
+        if self.Rate >= self.PreviousRate * 1.05:
+            Direction = self.Direction
+        elif self.Rate <= self.PreviousRate * 0.95:
+            Direction = -self.Direction
+        else:
+            Direction = -1
+        if Direction > 0 and self.BandwidthLimit > 0 and self.Rate >= self.BandwidthLimit * 0.9:
+            Direction = 0
+        self.PreviousRate = self.Rate
+        self.Direction = Direction or self.Direction
+        with self.Slots:
+            NewLimit = min(max(self.Limit + Direction, 1), self.MaxConcurrency)
+            if NewLimit != self.Limit:
+                logging.info(f"最近{MeasureWindowSeconds}秒平均速度：{humanize.naturalsize(self.Rate)}/秒，上传并发数调整为：{NewLimit}")
+            self.Limit = NewLimit
+            self.Slots.notify_all()
+
+    def ChoosePartSize(self, TotalSize: int) -> int:
+        # R2要求同一个分块上传中除最后一块外的所有分块大小相同，所以每次上传只在开始时决定一次分块大小，之后只调整并发数和限速
+        PartSize = self.MaxPartSize
+        if self.Adaptive == True and self.Rate > 0:
+            PartSize = min(math.ceil(self.Rate / self.Limit * TargetPartSeconds / (1024 ** 2)) * (1024 ** 2), self.MaxPartSize)
+        if self.BandwidthLimit > 0:
+            PartSize = min(PartSize, max(math.ceil(self.BandwidthLimit * 2 / (1024 ** 2)) * (1024 ** 2), MinPartSize))
+        return max(PartSize, MinPartSize, math.ceil(TotalSize / MaxPartCount / (1024 ** 2)) * (1024 ** 2))
+
+    def Throttle(self, Size: int):
+        # 以分块为单位的令牌桶：平均速度不超过上限，桶容量为一个分块
+        if self.BandwidthLimit <= 0:
+            return
+        with self.TokenLock:
+            Now = time.monotonic()
+            self.Tokens = min(self.Tokens + (Now - self.TokenTime) * self.BandwidthLimit, Size)
+            self.TokenTime = Now
+            self.Tokens -= Size
+            WaitSeconds = -self.Tokens / self.BandwidthLimit if self.Tokens < 0 else 0
+        if WaitSeconds > 0:
+            time.sleep(WaitSeconds)
@@ -1,11 +1,10 @@
-import datetime
 import logging
 import math
 import os
 import sys
+from queue import Queue
 from threading import Lock, Thread
 import time
-from typing import Optional
 from urllib.parse import urlparse
 
 import boto3
@@ -15,9 +14,11 @@ import schedule
 from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
 from types_boto3_s3 import S3Client
-from types_boto3_s3.type_defs import ListObjectsV2OutputTypeDef
 
-from ProcessTimer import MeasureExecutionTime
+from BucketIndex import BucketIndex, BucketObject
+from Incremental import DependentArchives
+from ProcessTimer import MeasureExecutionTime, RecordStageBytes, StageMeasurement
+from TransferController import MaxPartCount, TransferController
 
 R2_Endpoint = os.getenv("R2_Endpoint")
 if R2_Endpoint is None:
@@ -46,57 +47,70 @@ S3: S3Client = boto3.client(
     endpoint_url=R2_Endpoint,
     config=BotoClientConfig,
     region_name="auto")
-AllObjectsInBucket: Optional[ListObjectsV2OutputTypeDef] = None
+Bucket = BucketIndex(S3, R2_Bucket_Name or "")
 R2_Free_Space = 10 * (1000 ** 3) # 10GB
+# 流式上传开始时只知道估计的大小，按估计值的若干倍决定分块大小，压缩文件比估计的大时也不会超出分块数量上限
+StreamingSizeHeadroom: int = 4
 BytesHasBeenTransferred: int = 0
 BytesHasBeenTransferredPast1Second: int = 0
 ProgressLock = Lock()
 TaskHasEnded = False
 FileSize: int
+Controller = TransferController(MaxConcurrency, ChunkSize)
+ArchiveReferences: dict[str, set[str]] = {}
+
+def ConfigureTransferController(Adaptive: bool, BandwidthLimit: int):
+    Controller.Configure(Adaptive, BandwidthLimit)
+    if Adaptive == True:
+        logging.info(f"已启用自适应上传，初始上传并发数：{Controller.Limit}，最大上传并发数：{MaxConcurrency}")
+    if BandwidthLimit > 0:
+        logging.info(f"上传带宽上限：{humanize.naturalsize(BandwidthLimit)}/秒")
+
+def ConfigureArchiveReferences(References: dict[str, set[str]]):
+    global ArchiveReferences
+    ArchiveReferences = References
 
 def GetBucketTotalSize(ForceFetch: bool = False) -> tuple[int, str]:
     assert S3 is not None
     assert R2_Bucket_Name is not None
 
-    global AllObjectsInBucket
-    Total_Size = 0
-    if AllObjectsInBucket is None:
-        AllObjectsInBucket = S3.list_objects_v2(Bucket=R2_Bucket_Name)
-        if "Contents" not in AllObjectsInBucket:
-            logging.info("存储桶内没有任何文件。")
-            return 0, humanize.naturalsize(0)
     if ForceFetch == True:
-        AllObjectsInBucket = S3.list_objects_v2(Bucket=R2_Bucket_Name)
-    try:
-        for Object in AllObjectsInBucket["Contents"]: # type: ignore
-            Total_Size += Object["Size"] # type: ignore
-    except KeyError:
-        return 0, humanize.naturalsize(0)
-    Size_Humanize = humanize.naturalsize(Total_Size)
-    return Total_Size, Size_Humanize
-
-def OptimizeStorage(FileSize: int):
+        Bucket.Refresh()
+    Total_Size = Bucket.TotalSize()
+    if Total_Size == 0:
+        logging.info("存储桶内没有任何文件。")
+    return Total_Size, humanize.naturalsize(Total_Size)
+
+def IsArchiveKey(Key: str) -> bool:
+    # 分块存储的chunks/和manifests/由ChunkStore.py按清单的引用关系单独清理，分块被多个备份共享，不能按时间删除
+    return "/" not in Key
+
+def OptimizeStorage(FileSize: int, ExcludeKeys: frozenset[str] = frozenset()):
     assert S3 is not None
     assert R2_Bucket_Name is not None
-    
-    if GetBucketTotalSize()[0] == 0:
+
+    # 免费额度由存储桶中的所有对象共享，但这里只删除顶层的备份文件
+    Total_Size = GetBucketTotalSize()[0]
+    # ExcludeKeys中的对象（例如刚上传完成的备份）计入已用空间，但不会被删除
+    Archives = [Object for Object in Bucket.SortedByAge() if IsArchiveKey(Object.Key) and Object.Key not in ExcludeKeys]
+    ObjectsByKey = {Object.Key: Object for Object in Archives}
+    DeleteObjects: list[BucketObject] = []
+    for Object in Archives:
+        if FileSize + Total_Size <= R2_Free_Space:
+            break
+        if Object in DeleteObjects:
+            continue
+        # 增量备份依赖更早的完整备份，删除被引用的备份时把引用它的增量备份一起删除，不在存储桶里留下无法恢复的增量备份
+        for Dependent in [Object] + [ObjectsByKey[Key] for Key in sorted(DependentArchives(Object.Key, ArchiveReferences)) if Key in ObjectsByKey]:
+            if Dependent not in DeleteObjects:
+                DeleteObjects.append(Dependent)
+                Total_Size -= Dependent.Size
+    if len(DeleteObjects) == 0:
         return
-    ObjectNameToLastModifiedDict = {
-        Name: LastModifiedDate
-        for Name, LastModifiedDate in sorted( (
-                ( Object.get("Key"), Object.get("LastModified") or datetime.datetime.now() )
-                for Object in AllObjectsInBucket["Contents"]), # type: ignore
-            key=lambda item: item[1],
-            reverse=True ) }
-    while FileSize + GetBucketTotalSize()[0] > R2_Free_Space:
-        DeleteFileName, DeleteFileLastModifiedDate = ObjectNameToLastModifiedDict.popitem()
-        assert DeleteFileName is not None
-        S3.delete_object(Bucket=R2_Bucket_Name, Key=DeleteFileName)
-        AllObjectsInBucket["Contents"] = [ # type: ignore
-            Object for Object in AllObjectsInBucket["Contents"] # type: ignore
-            if Object.get("Key") != DeleteFileName ]
-        logging.warning("存储空间不足，已删除最旧的备份文件：{0}，最后修改时间：{1}。".format(DeleteFileName, DeleteFileLastModifiedDate.strftime("%Y-%m-%d %H:%M:%S")))
-    GetBucketTotalSize(ForceFetch=True)
+    DeletedKeys = set(Bucket.Delete([Object.Key for Object in DeleteObjects]))
+    for Object in DeleteObjects:
+        if Object.Key in DeletedKeys:
+            logging.warning("存储空间不足，已删除最旧的备份文件：{0}，最后修改时间：{1}。".format(Object.Key, Object.LastModified.strftime("%Y-%m-%d %H:%M:%S")))
 
 def WriteProgress(TransferredBytes: int):
     global BytesHasBeenTransferredPast1Second, BytesHasBeenTransferred, ProgressLock, FileSize
@@ -107,15 +121,29 @@ def ShowProgress():
     global BytesHasBeenTransferredPast1Second, BytesHasBeenTransferred, ProgressLock
     with ProgressLock:
         logging.info(f"已上传：{humanize.naturalsize(BytesHasBeenTransferred)}，当前速度：{humanize.naturalsize(BytesHasBeenTransferredPast1Second)}/秒")
+        Controller.Observe(BytesHasBeenTransferredPast1Second)
         BytesHasBeenTransferredPast1Second = 0
 def RunTask():
     while TaskHasEnded == False:
         schedule.run_pending()
         time.sleep(0.3)
+def StartProgressReport(TotalSize: int) -> Thread:
+    global TaskHasEnded, FileSize, BytesHasBeenTransferred, BytesHasBeenTransferredPast1Second
+    FileSize = TotalSize
+    BytesHasBeenTransferred = BytesHasBeenTransferredPast1Second = 0
+    TaskHasEnded = False
+    schedule.every(1).seconds.do(ShowProgress)
+    TaskThread = Thread(target=RunTask, daemon=True)
+    TaskThread.start()
+    return TaskThread
+def StopProgressReport(TaskThread: Thread):
+    global TaskHasEnded
+    schedule.clear()
+    TaskHasEnded = True
+    TaskThread.join()
 
 @MeasureExecutionTime("上传备份文件")
 def UploadFile(FilePath: str):
-    global TaskHasEnded, FileSize
     assert S3 is not None
     assert R2_Bucket_Name is not None
 
@@ -123,9 +151,7 @@ def UploadFile(FilePath: str):
     FileSize = os.path.getsize(FilePath)
     OptimizeStorage(FileSize)
     logging.info(f"上传并发数：{MaxConcurrency}，分块大小：{humanize.naturalsize(ChunkSize)}。")
-    schedule.every(1).seconds.do(ShowProgress)
-    TaskThread = Thread(target=RunTask, daemon=True)
-    TaskThread.start()
+    TaskThread = StartProgressReport(FileSize)
     CustomTransferConfig = TransferConfig(
         multipart_threshold=ChunkSize,
         max_concurrency=MaxConcurrency,
@@ -137,14 +163,125 @@ def UploadFile(FilePath: str):
                        os.path.basename(FilePath),
                        Config=CustomTransferConfig,
                        Callback=WriteProgress)
+        Bucket.RecordUpload(os.path.basename(FilePath), FileSize)
+        RecordStageBytes(FileSize, FileSize)
     except KeyboardInterrupt as e:
         logging.error("检测到用户中断，上传任务被取消。")
         CleanupFailedMultipartUploads(FilePath)
         sys.exit(0)
     finally:
-        schedule.clear()
-        TaskHasEnded = True
-        TaskThread.join()
+        StopProgressReport(TaskThread)
+
+class StreamingUpload:
+    def __init__(self, Key: str, EstimatedSize: int):
+        assert S3 is not None
+        assert R2_Bucket_Name is not None
+
+        self.Key = Key
+        self.EstimatedSize = EstimatedSize
+        self.Measurement = StageMeasurement("流式上传备份文件", Key)
+        logging.info(f"当前存储桶内的所有文件总共占用了：{GetBucketTotalSize()[1]} 的空间。")
+        OptimizeStorage(EstimatedSize)
+        self.UploadId = S3.create_multipart_upload(Bucket=R2_Bucket_Name, Key=Key)["UploadId"]
+        self.Buffer = bytearray()
+        self.PartSize = Controller.ChoosePartSize(EstimatedSize * StreamingSizeHeadroom)
+        logging.info(f"已开始流式上传：{Key}，上传并发数：{MaxConcurrency}，分块大小：{humanize.naturalsize(self.PartSize)}。")
+        self.PartNumber = 0
+        self.UploadedSize = 0
+        self.Parts: dict[int, str] = {}
+        self.PartsLock = Lock()
+        self.Error: BaseException | None = None
+        self.PartQueue: Queue[tuple[int, bytes] | None] = Queue(maxsize=MaxConcurrency)
+        self.ProgressThread = StartProgressReport(sys.maxsize)
+        self.Uploaders = [Thread(target=self.RunUploader, daemon=True) for _ in range(MaxConcurrency)]
+        for Uploader in self.Uploaders:
+            Uploader.start()
+
+    def write(self, Data: bytes) -> int:
+        if self.Error is not None:
+            raise self.Error
+        self.Buffer += Data
+        while len(self.Buffer) >= self.PartSize:
+            self.SubmitPart(bytes(self.Buffer[:self.PartSize]))
+            del self.Buffer[:self.PartSize]
+        return len(Data)
+
+    def flush(self):
+        pass
+
+    def SubmitPart(self, Data: bytes):
+        if self.PartNumber >= MaxPartCount:
+            raise RuntimeError(f"流式上传的分块数超过了{MaxPartCount}个的上限，压缩文件远大于估计的{humanize.naturalsize(self.EstimatedSize)}")
+        self.PartNumber += 1
+        self.UploadedSize += len(Data)
+        self.PartQueue.put((self.PartNumber, Data))
+
+    def RunUploader(self):
+        while (Part := self.PartQueue.get()) is not None:
+            PartNumber, Data = Part
+            if self.Error is not None:
+                continue
+            Controller.Acquire()
+            try:
+                Controller.Throttle(len(Data))
+                Response = S3.upload_part(Bucket=R2_Bucket_Name, Key=self.Key, UploadId=self.UploadId, PartNumber=PartNumber, Body=Data) # type: ignore
+                with self.PartsLock:
+                    self.Parts[PartNumber] = Response["ETag"]
+                WriteProgress(len(Data))
+            except BaseException as Error:
+                logging.error(f"上传分块 {PartNumber} 失败：{Error}")
+                self.Error = Error
+            finally:
+                Controller.Release()
+
+    def StopUploaders(self):
+        for _ in self.Uploaders:
+            self.PartQueue.put(None)
+        for Uploader in self.Uploaders:
+            Uploader.join()
+        StopProgressReport(self.ProgressThread)
+
+    def Complete(self):
+        if len(self.Buffer) > 0 or self.PartNumber == 0:
+            self.SubmitPart(bytes(self.Buffer))
+            self.Buffer.clear()
+        self.StopUploaders()
+        if self.Error is not None:
+            raise self.Error
+        S3.complete_multipart_upload(
+            Bucket=R2_Bucket_Name, # type: ignore
+            Key=self.Key,
+            UploadId=self.UploadId,
+            MultipartUpload={"Parts": [{"PartNumber": PartNumber, "ETag": ETag} for PartNumber, ETag in sorted(self.Parts.items())]})
+        Bucket.RecordUpload(self.Key, self.UploadedSize)
+        self.Measurement.Stage.BytesIn = self.Measurement.Stage.BytesOut = self.UploadedSize
+        self.Measurement.Finish(True)
+        logging.info(f"流式上传完成：{self.Key}，共 {self.PartNumber} 个分块，{humanize.naturalsize(self.UploadedSize)}。")
+        OptimizeStorage(0, frozenset({self.Key}))
+
+    def Abort(self):
+        logging.error(f"流式上传失败，正在中止：{self.Key}")
+        self.Error = self.Error or RuntimeError("上传已中止")
+        while self.PartQueue.empty() == False:
+            self.PartQueue.get_nowait()
+        self.StopUploaders()
+        self.Measurement.Stage.BytesIn = self.Measurement.Stage.BytesOut = self.UploadedSize
+        self.Measurement.Finish(False)
+        CleanupFailedMultipartUploads(self.Key)
+
+class TeeWriter:
+    # 没有tell和seek，zipfile会把它当作不可寻址的流，改用数据描述符而不是回头改写文件头
+    def __init__(self, *Outputs):
+        self.Outputs = Outputs
+
+    def write(self, Data: bytes) -> int:
+        for Output in self.Outputs:
+            Output.write(Data)
+        return len(Data)
+
+    def flush(self):
+        for Output in self.Outputs:
+            Output.flush()
 
 def CleanupFailedMultipartUploads(FileName: str):
     Response = S3.list_multipart_uploads(Bucket=R2_Bucket_Name)
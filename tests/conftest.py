@@ -0,0 +1,22 @@
+import os
+from pathlib import Path
+import sys
+
+# Upload.py在导入时就读取环境变量并创建S3客户端，必须在导入任何项目模块之前设置好
+os.environ.setdefault("R2_Endpoint", "https://s3.us-east-1.amazonaws.com")
+os.environ.setdefault("R2_Access_Key", "testing")
+os.environ.setdefault("R2_Secret_Key", "testing")
+os.environ.setdefault("R2_Bucket_Name", "backup-test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from moto import mock_aws
+import pytest
+
+@pytest.fixture
+def Bucket():
+    with mock_aws():
+        import Upload
+        Upload.S3.create_bucket(Bucket=Upload.R2_Bucket_Name)
+        Upload.Bucket.Objects = {}
+        Upload.Bucket.Loaded = False
+        yield Upload.Bucket
@@ -0,0 +1,53 @@
+from pathlib import Path
+from threading import Event, Thread
+import zipfile
+
+from Archive import ArchiveBuilder, BackupCustomPathIntoArchive, BackupDatabaseIntoArchive
+from Backup import SubmitBackupTask, WaitForBackupTasks
+
+def test_StreamsDoNotWaitForEachOther(tmp_path):
+    Builder = ArchiveBuilder(str(tmp_path / "archive.zip"))
+    SecondStarted = Event()
+    def FirstStream():
+        yield b"first"
+        # 旧实现中写入线程在读完第一个数据流之前不会开始读取第二个，这里会一直等不到
+        assert SecondStarted.wait(5)
+        yield b"done"
+    def SecondStream():
+        SecondStarted.set()
+        yield b"second"
+    Producers = [Thread(target=lambda: Builder.AddStream("first.sql", FirstStream()).result()), Thread(target=lambda: Builder.AddStream("second.sql", SecondStream()).result())]
+    for Producer in Producers:
+        Producer.start()
+    for Producer in Producers:
+        Producer.join()
+    Builder.Close(Path("sha256.txt"))
+    with zipfile.ZipFile(tmp_path / "archive.zip") as ZipFile:
+        assert ZipFile.testzip() is None
+        assert ZipFile.read("first.sql") == b"firstdone"
+        assert ZipFile.read("second.sql") == b"second"
+
+def test_CustomPathFailuresAreReported(tmp_path, monkeypatch):
+    Directory = tmp_path / "data"
+    Directory.mkdir()
+    (Directory / "file.txt").write_text("data")
+    PathListFile = tmp_path / "CustomPathList.txt"
+    PathListFile.write_text(f"{Directory}\n")
+    Builder = ArchiveBuilder(str(tmp_path / "archive.zip"))
+    def FailingWriteDirectory(*args):
+        raise OSError("磁盘错误")
+    monkeypatch.setattr(Builder, "WriteDirectory", FailingWriteDirectory)
+    BackupCustomPathIntoArchive(Builder, PathListFile)
+    FailedTasks = WaitForBackupTasks()
+    Builder.Close(Path("sha256.txt"))
+    assert [(Task.Name, Task.Error) for Task in FailedTasks] == [("data", "OSError: 磁盘错误")]
+
+def test_FailedDumpIsNotWrittenIntoArchive(tmp_path):
+    Builder = ArchiveBuilder(str(tmp_path / "archive.zip"))
+    SubmitBackupTask("MySQL", "io", None, BackupDatabaseIntoArchive, Builder, ["sh", "-c", "echo partial; echo boom >&2; exit 2"], "MySQL.sql", "MySQL.error.log", "MySQL")
+    FailedTasks = WaitForBackupTasks()
+    Builder.Close(Path("sha256.txt"))
+    assert [Task.Name for Task in FailedTasks] == ["MySQL"]
+    with zipfile.ZipFile(tmp_path / "archive.zip") as ZipFile:
+        assert "MySQL.sql" not in ZipFile.namelist()
+        assert ZipFile.read("MySQL.error.log") == b"boom\n"
@@ -0,0 +1,30 @@
+import os
+import zipfile
+
+import pytest
+
+import Backup
+from Checksum import Manifest
+
+FailingDump = ["sh", "-c", "echo 'CREATE TABLE partial'; echo 'mysqldump: Lost connection' >&2; exit 2"]
+
+@pytest.mark.parametrize("ShellCommand", [FailingDump, ["NonexistentDumpCommand"]])
+def test_FailedDumpFailsTheTaskAndLeavesNoOutput(tmp_path, monkeypatch, ShellCommand):
+    monkeypatch.chdir(tmp_path)
+    Manifest.Clear()
+    Backup.SubmitBackupTask("MySQL", "io", None, Backup.BackupDatabase, ShellCommand, "MySQL.sql", "MySQL.error.log", "MySQL")
+    Backup.SubmitBackupTask("MySQL流式", "io", None, Backup.BackupDatabaseStream, ShellCommand, "Stream.sql.zip", "Stream.sql", "Stream.error.log", "MySQL")
+    FailedTasks = Backup.WaitForBackupTasks()
+    # 失败的任务会让Main.py的单次运行以非0返回值退出
+    assert sorted(Task.Name for Task in FailedTasks) == ["MySQL", "MySQL流式"]
+    assert os.path.exists("MySQL.sql") == False and os.path.exists("Stream.sql.zip") == False
+    assert Manifest.Digests == {}
+
+def test_SuccessfulDumpIsRecorded(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    Manifest.Clear()
+    Backup.SubmitBackupTask("MySQL流式", "io", None, Backup.BackupDatabaseStream, ["echo", "CREATE TABLE t;"], "Stream.sql.zip", "Stream.sql", "Stream.error.log", "MySQL")
+    assert Backup.WaitForBackupTasks() == []
+    with zipfile.ZipFile("Stream.sql.zip") as ArchiveFile:
+        assert ArchiveFile.read("Stream.sql") == b"CREATE TABLE t;\n"
+    assert "Stream.sql.zip" in Manifest.Digests
@@ -0,0 +1,55 @@
+import hashlib
+import random
+
+import pytest
+
+import ChunkStore
+import Upload
+
+MiB = 1024 * 1024
+
+def RandomData(Size: int, Seed: int) -> bytes:
+    return random.Random(Seed).randbytes(Size)
+
+def ChunkHashes(FilePath) -> list[str]:
+    return [hashlib.sha256(Chunk).hexdigest() for Chunk in ChunkStore.SplitIntoChunks(str(FilePath))]
+
+def test_ChunkSizesStayWithinLimits(tmp_path):
+    FilePath = tmp_path / "data.bin"
+    FilePath.write_bytes(RandomData(40 * MiB, 1))
+    Sizes = [len(Chunk) for Chunk in ChunkStore.SplitIntoChunks(str(FilePath))]
+    assert sum(Sizes) == 40 * MiB
+    assert all(ChunkStore.MinChunkSize <= Size <= ChunkStore.MaxChunkSize for Size in Sizes[:-1])
+    # 边界由内容决定，不会总是退化成最大分块
+    assert max(Sizes[:-1]) < ChunkStore.MaxChunkSize
+
+def test_InsertedByteOnlyChangesNearbyChunks(tmp_path):
+    Data = RandomData(24 * MiB, 2)
+    Original, Shifted = tmp_path / "original.bin", tmp_path / "shifted.bin"
+    Original.write_bytes(Data)
+    Shifted.write_bytes(Data[:100] + b"!" + Data[100:])
+    OriginalHashes, ShiftedHashes = ChunkHashes(Original), ChunkHashes(Shifted)
+    assert len(OriginalHashes) >= 3
+    assert OriginalHashes[1:] == ShiftedHashes[1:]
+
+@pytest.mark.skipif(ChunkStore.numpy is None, reason="没有安装numpy")
+def test_NumpyAndPythonBoundariesAgree():
+    for Seed in range(3):
+        Data = RandomData(8 * MiB, Seed)
+        assert ChunkStore.FindChunkBoundaryNumpy(Data, len(Data)) == ChunkStore.FindChunkBoundaryPython(Data, len(Data))
+
+def test_OptimizeChunkStoreKeepsSharedChunks(Bucket, monkeypatch, tmp_path):
+    Data = RandomData(12 * MiB, 3)
+    First, Second = tmp_path / "2025-01-01 00-00-00.zip", tmp_path / "2025-01-02 00-00-00.zip"
+    First.write_bytes(Data)
+    ChunkStore.UploadFileToChunkStore(str(First))
+    Second.write_bytes(Data[:-MiB] + RandomData(2 * MiB, 4))
+    # 空间只够保留一个备份，最旧的清单被删除，但与新备份共享的分块必须保留
+    monkeypatch.setattr(ChunkStore, "R2_Free_Space", 15 * MiB)
+    ChunkStore.UploadFileToChunkStore(str(Second))
+    Keys = {Object["Key"] for Page in Upload.S3.get_paginator("list_objects_v2").paginate(Bucket=Upload.R2_Bucket_Name) for Object in Page.get("Contents", [])}
+    assert {Key for Key in Keys if Key.startswith(ChunkStore.ManifestPrefix)} == {ChunkStore.ManifestPrefix + Second.name + ".json"}
+    Referenced = {ChunkStore.ChunkPrefix + Hash for Hash in ChunkHashes(Second)}
+    assert {Key for Key in Keys if Key.startswith(ChunkStore.ChunkPrefix)} == Referenced
+    ChunkStore.DownloadFromChunkStore(Second.name, tmp_path / "restored.zip")
+    assert (tmp_path / "restored.zip").read_bytes() == Second.read_bytes()
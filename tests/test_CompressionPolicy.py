@@ -0,0 +1,47 @@
+import os
+import zipfile
+
+import CompressionPolicy
+from CompressionPolicy import CompressionPolicy as Policy, CompressionRule, LargeFileThreshold
+
+def test_ChooseTier(tmp_path):
+    Rules = [CompressionRule("*/uploads/*", "stored"), CompressionRule("*.sql", "high", 1024)]
+    Chooser = Policy(tmp_path / "cache.sqlite3", Rules)
+    Files = {
+        "uploads/text.txt": b"a" * 4096,
+        "small.sql": b"INSERT" * 10,
+        "large.sql": b"INSERT" * 1024,
+        "photo.jpg": b"a" * 4096,
+        "tiny.txt": b"a",
+        "random.bin": os.urandom(4096),
+        "text.txt": b"abc" * 4096 }
+    for Name, Data in Files.items():
+        (tmp_path / Name).parent.mkdir(exist_ok=True)
+        (tmp_path / Name).write_bytes(Data)
+    Tiers = {Name: Chooser.ChooseTier(str(tmp_path / Name), os.stat(tmp_path / Name)) for Name in Files}
+    assert Tiers == {"uploads/text.txt": "stored", "small.sql": "fast", "large.sql": "high", "photo.jpg": "stored", "tiny.txt": "fast", "random.bin": "stored", "text.txt": "fast"}
+
+def test_StreamedMembersFollowThePolicy(tmp_path, monkeypatch):
+    monkeypatch.setattr(CompressionPolicy, "Policy", Policy(tmp_path / "cache.sqlite3", [CompressionRule("PostgreSQL.sql", "fast")]))
+    assert CompressionPolicy.ChooseStreamCompression("MySQL.sql", zipfile.ZIP_DEFLATED).Tier == "high"
+    assert CompressionPolicy.ChooseStreamCompression("PostgreSQL.sql", zipfile.ZIP_DEFLATED).Tier == "fast"
+    assert CompressionPolicy.ChooseStreamCompression("error.log", zipfile.ZIP_DEFLATED, 100).Tier == "fast"
+    monkeypatch.setattr(CompressionPolicy, "Policy", None)
+    assert CompressionPolicy.ChooseStreamCompression("MySQL.sql", zipfile.ZIP_DEFLATED, LargeFileThreshold).Level == 6
+
+def test_SaveOnlyPrunesArchivedDirectories(tmp_path):
+    for Directory in ("website", "other"):
+        (tmp_path / Directory).mkdir()
+        (tmp_path / Directory / "keep.txt").write_bytes(b"abc" * 1024)
+        (tmp_path / Directory / "gone.txt").write_bytes(b"abc" * 1024)
+    Chooser = Policy(tmp_path / "cache.sqlite3", [])
+    for Directory in ("website", "other"):
+        for Name in ("keep.txt", "gone.txt"):
+            Chooser.Choose(str(tmp_path / Directory / Name), os.stat(tmp_path / Directory / Name), zipfile.ZIP_DEFLATED)
+    Chooser.Save()
+    (tmp_path / "website" / "gone.txt").unlink()
+    (tmp_path / "other" / "gone.txt").unlink()
+    # 本次只打包了website，other下的缓存不检查也不删除
+    Chooser.Choose(str(tmp_path / "website" / "keep.txt"), os.stat(tmp_path / "website" / "keep.txt"), zipfile.ZIP_DEFLATED)
+    Chooser.Save()
+    assert sorted(os.path.relpath(FilePath, tmp_path) for FilePath in Policy(tmp_path / "cache.sqlite3", []).Samples) == ["other/gone.txt", "other/keep.txt", "website/keep.txt"]
@@ -0,0 +1,40 @@
+import subprocess
+
+import pytest
+
+import DatabaseDump
+
+def DumpCommands(tmp_path, monkeypatch, SplitLargeTables: bool) -> list[list[str]]:
+    Commands: list[list[str]] = []
+    monkeypatch.setattr(DatabaseDump, "ListMySQLDatabases", lambda: ["shop"])
+    monkeypatch.setattr(DatabaseDump, "ListMySQLLargeTables", lambda: {"shop": ["orders"]})
+    monkeypatch.setattr(DatabaseDump, "BackupDatabase", lambda ShellCommand, *args: Commands.append(ShellCommand))
+    DatabaseDump.BackupMySQLDatabases(tmp_path / "MySQL", 2, SplitLargeTables)
+    return Commands
+
+def test_LargeTablesStayInTheDatabaseSnapshotByDefault(tmp_path, monkeypatch):
+    Commands = DumpCommands(tmp_path, monkeypatch, False)
+    assert len(Commands) == 1 and Commands[0][-2:] == ["--databases", "shop"]
+    assert not any(Argument.startswith("--ignore-table") for Argument in Commands[0])
+
+def test_SplitLargeTablesIsOptIn(tmp_path, monkeypatch):
+    Commands = DumpCommands(tmp_path, monkeypatch, True)
+    assert sorted(Command[-1] for Command in Commands) == ["orders", "shop"]
+    assert "--ignore-table=shop.orders" in next(Command for Command in Commands if Command[-1] == "shop")
+
+def test_FailedDatabaseListingFailsTheBackup(tmp_path, monkeypatch):
+    monkeypatch.setattr(DatabaseDump.subprocess, "run", lambda *args, **kwargs: subprocess.CompletedProcess(args, 1, "", "Access denied"))
+    with pytest.raises(RuntimeError):
+        DatabaseDump.BackupMySQLDatabases(tmp_path / "MySQL", 2)
+
+def test_EveryDatabaseIsDumpedBeforeFailuresAreRaised(tmp_path, monkeypatch):
+    Dumped: list[str] = []
+    def FakeBackupDatabase(ShellCommand: list[str], *args):
+        Dumped.append(ShellCommand[-1])
+        if ShellCommand[-1] == "broken":
+            raise RuntimeError("mysqldump的返回值为2")
+    monkeypatch.setattr(DatabaseDump, "ListMySQLDatabases", lambda: ["broken", "shop", "blog"])
+    monkeypatch.setattr(DatabaseDump, "BackupDatabase", FakeBackupDatabase)
+    with pytest.raises(RuntimeError, match="1 个MySQL数据库备份失败"):
+        DatabaseDump.BackupMySQLDatabases(tmp_path / "MySQL", 2)
+    assert sorted(Dumped) == ["blog", "broken", "shop"]
@@ -0,0 +1,46 @@
+from concurrent.futures import ThreadPoolExecutor
+import random
+import zipfile
+
+import pytest
+
+import ParallelZip
+from PrepareBackup import GetIntegerArgumentValue
+
+def MakeTree(Root) -> dict[str, bytes]:
+    Generator = random.Random(7)
+    Files = {
+        "index.html": b"<html>hello</html>\n" * 1000,
+        "empty.txt": b"",
+        "media/photo.jpg": Generator.randbytes(100 * 1024),
+        # 大于分块大小的文件会被拆成多个块并行压缩，再拼接成一个成员
+        "data/large.log": b"".join(f"line {Index} {Generator.random()}\n".encode() for Index in range(600000)),
+        "中文/说明.txt": "备份".encode("utf-8") * 100 }
+    for Name, Contents in Files.items():
+        (Root / Name).parent.mkdir(parents=True, exist_ok=True)
+        (Root / Name).write_bytes(Contents)
+    return Files
+
+@pytest.mark.parametrize("Method", [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED])
+def test_ParallelZipRoundTrip(tmp_path, Method):
+    Source = tmp_path / "site"
+    Files = MakeTree(Source)
+    assert len(Files["data/large.log"]) > ParallelZip.ParallelZipChunkSize
+    ArchivePath = tmp_path / "site.zip"
+    with ThreadPoolExecutor(4) as CompressionPool:
+        Entries = ParallelZip.ParallelZipDirectoryTree(str(ArchivePath), Source, CompressionPool, 4, Method, (".jpg",))
+    assert len(Entries) == len(Files)
+    with zipfile.ZipFile(ArchivePath) as Archive:
+        assert Archive.testzip() is None
+        assert {Name: Archive.read(Name) for Name in Archive.namelist()} == Files
+        assert Archive.getinfo("media/photo.jpg").compress_type == zipfile.ZIP_STORED
+        assert Archive.getinfo("data/large.log").compress_type == Method
+
+def test_IntegerArgumentValidation(monkeypatch):
+    monkeypatch.setattr("sys.argv", ["Main.py", "--cpu-jobs=8", "--io-jobs=abc", "--nice=40"])
+    assert GetIntegerArgumentValue("--cpu-jobs", 1, 1) == 8
+    assert GetIntegerArgumentValue("--device-jobs", None, 0) is None
+    with pytest.raises(SystemExit):
+        GetIntegerArgumentValue("--io-jobs", 4, 1)
+    with pytest.raises(SystemExit):
+        GetIntegerArgumentValue("--nice", 0, -20, 19)
@@ -0,0 +1,36 @@
+import subprocess
+import sys
+from threading import Thread
+
+import ProcessTimer
+from ProcessTimer import MeasureExecutionTime, WaitForChildProcess
+
+@MeasureExecutionTime("子进程", Label=lambda ShellCommand: ShellCommand[1])
+def RunChild(ShellCommand: list[str]):
+    with subprocess.Popen(ShellCommand) as Process:
+        WaitForChildProcess(Process)
+
+def StagesNamed(Name: str) -> dict[str, ProcessTimer.StageRecord]:
+    return {Stage.Label: Stage for Stage in ProcessTimer.StageRecords if Stage.Name == Name}
+
+def test_ChildCPUIsAttributedToTheWaitingStage():
+    ProcessTimer.ResetRunRecords()
+    # 忙碌的子进程先结束，进程级的RUSAGE_CHILDREN会把它的CPU时间也算进仍在等待sleep的阶段
+    Busy = Thread(target=RunChild, args=([sys.executable, "-c", "import time\nEnd = time.process_time() + 0.5\nwhile time.process_time() < End: pass"],))
+    Idle = Thread(target=RunChild, args=(["sleep", "1"],))
+    Idle.start()
+    Busy.start()
+    Busy.join()
+    Idle.join()
+    Stages = StagesNamed("子进程")
+    assert Stages["-c"].ChildCPUSeconds >= 0.4
+    assert Stages["1"].ChildCPUSeconds < 0.1
+
+def test_StreamingUploadRecordsStage(Bucket):
+    import Upload
+    ProcessTimer.ResetRunRecords()
+    Streaming = Upload.StreamingUpload("stream.zip", 100)
+    Streaming.write(b"x" * 1000)
+    Streaming.Complete()
+    Stage = StagesNamed("流式上传备份文件")["stream.zip"]
+    assert Stage.Succeeded == True and Stage.BytesIn == 1000
@@ -0,0 +1,33 @@
+import pytest
+
+from Incremental import FileIndex, IndexFileName
+from Restore import RestoreMembers
+from test_Retention import MakeBackup
+
+@pytest.fixture
+def Chain(tmp_path):
+    BackupRootDirectory = tmp_path / "Backup"
+    BackupRootDirectory.mkdir()
+    SourceDirectory = tmp_path / "Website"
+    SourceDirectory.mkdir()
+    (SourceDirectory / "unchanged.php").write_text("unchanged")
+    (SourceDirectory / "changed.php").write_text("old")
+    Index = FileIndex(tmp_path / IndexFileName)
+    MakeBackup(BackupRootDirectory, Index, "2025-01-01 00-00-00.zip", SourceDirectory, True)
+    (SourceDirectory / "changed.php").write_text("new content")
+    MakeBackup(BackupRootDirectory, Index, "2025-01-02 00-00-00.zip", SourceDirectory, False)
+    Index.Close()
+    return BackupRootDirectory
+
+def test_RestoreFollowsIncrementalChain(Chain, tmp_path):
+    OutputDirectory = tmp_path / "Restored"
+    assert RestoreMembers(str(Chain / "2025-01-02 00-00-00.zip"), ["WebsiteRoot.zip/*.php"], OutputDirectory) == True
+    assert (OutputDirectory / "WebsiteRoot.zip" / "unchanged.php").read_text() == "unchanged"
+    assert (OutputDirectory / "WebsiteRoot.zip" / "changed.php").read_text() == "new content"
+
+def test_RestoreReportsMissingReferencedArchive(Chain, tmp_path, caplog):
+    (Chain / "2025-01-01 00-00-00.zip").unlink()
+    OutputDirectory = tmp_path / "Restored"
+    assert RestoreMembers(str(Chain / "2025-01-02 00-00-00.zip"), ["WebsiteRoot.zip/*.php"], OutputDirectory) == False
+    assert (OutputDirectory / "WebsiteRoot.zip" / "changed.php").read_text() == "new content"
+    assert any("2025-01-01 00-00-00.zip" in Record.getMessage() and "unchanged.php" in Record.getMessage() for Record in caplog.records)
@@ -0,0 +1,103 @@
+import json
+import os
+
+import pytest
+
+import ResumableUpload
+import Upload
+
+MiB = 1024 * 1024
+
+@pytest.fixture
+def RecordedParts(Bucket, monkeypatch):
+    # 记录每个分块的大小，同时在每个分块之后改变测得的速度，模拟自适应上传过程中速度的波动
+    Parts: list[tuple[int, int]] = []
+    OriginalUploadPart = Upload.S3.upload_part
+    def UploadPart(**kwargs):
+        Parts.append((kwargs["PartNumber"], len(kwargs["Body"])))
+        Upload.Controller.Rate = (len(Parts) % 3 + 1) * MiB
+        return OriginalUploadPart(**kwargs)
+    monkeypatch.setattr(Upload.S3, "upload_part", UploadPart)
+    monkeypatch.setattr(Upload.Controller, "MaxPartSize", 8 * MiB)
+    Upload.Controller.Configure(Adaptive=True, BandwidthLimit=0)
+    Upload.Controller.Rate = 2 * MiB
+    yield Parts
+    Upload.Controller.Configure(Adaptive=False, BandwidthLimit=0)
+    Upload.Controller.Rate = 0
+
+def AssertUniformParts(Parts: list[tuple[int, int]]):
+    Sizes = [Size for _, Size in sorted(dict(Parts).items())]
+    assert len(set(Sizes[:-1])) <= 1
+    assert Sizes[-1] <= Sizes[0]
+
+def test_StreamingUploadUsesOnePartSize(Bucket, RecordedParts):
+    Data = os.urandom(23 * MiB + 17)
+    Streaming = Upload.StreamingUpload("stream.zip", len(Data) // 4)
+    for Offset in range(0, len(Data), 3 * MiB + 1):
+        Streaming.write(Data[Offset:Offset + 3 * MiB + 1])
+    Streaming.Complete()
+    AssertUniformParts(RecordedParts)
+    assert Upload.S3.get_object(Bucket=Upload.R2_Bucket_Name, Key="stream.zip")["Body"].read() == Data
+
+def test_ResumableUploadResumesWithSamePartSize(Bucket, RecordedParts, monkeypatch, tmp_path):
+    FilePath = tmp_path / "archive.zip"
+    Data = os.urandom(29 * MiB + 5)
+    FilePath.write_bytes(Data)
+    OriginalUploadPart = Upload.S3.upload_part
+    def FailingUploadPart(**kwargs):
+        if kwargs["PartNumber"] == 3:
+            raise ConnectionError("网络中断")
+        return OriginalUploadPart(**kwargs)
+    monkeypatch.setattr(Upload.S3, "upload_part", FailingUploadPart)
+    with pytest.raises(ConnectionError):
+        ResumableUpload.ResumableUploadFile(FilePath)
+    Journal = json.loads(FilePath.with_name(FilePath.name + ResumableUpload.UploadJournalSuffix).read_text())
+    assert "3" not in Journal["Parts"]
+    monkeypatch.setattr(Upload.S3, "upload_part", OriginalUploadPart)
+    FirstAttempt = {PartNumber for PartNumber, _ in RecordedParts if str(PartNumber) in Journal["Parts"]}
+    RecordedParts.clear()
+    ResumableUpload.ResumableUploadFile(FilePath)
+    # 已经上传过的分块不会重新上传，续传的分块与第一次使用相同的分块大小
+    assert FirstAttempt.isdisjoint(PartNumber for PartNumber, _ in RecordedParts)
+    assert all(Size == Journal["PartSize"] for PartNumber, Size in RecordedParts if PartNumber * Journal["PartSize"] < len(Data))
+    assert Upload.S3.get_object(Bucket=Upload.R2_Bucket_Name, Key="archive.zip")["Body"].read() == Data
+    assert FilePath.with_name(FilePath.name + ResumableUpload.UploadJournalSuffix).exists() == False
+
+def InterruptUpload(FilePath, monkeypatch):
+    OriginalUploadPart = Upload.S3.upload_part
+    def FailingUploadPart(**kwargs):
+        if kwargs["PartNumber"] == 3:
+            raise ConnectionError("网络中断")
+        return OriginalUploadPart(**kwargs)
+    monkeypatch.setattr(Upload.S3, "upload_part", FailingUploadPart)
+    with pytest.raises(ConnectionError):
+        ResumableUpload.ResumableUploadFile(FilePath)
+    monkeypatch.setattr(Upload.S3, "upload_part", OriginalUploadPart)
+    return json.loads(FilePath.with_name(FilePath.name + ResumableUpload.UploadJournalSuffix).read_text())
+
+def test_DiscardedJournalAbortsOldUpload(Bucket, RecordedParts, monkeypatch, tmp_path):
+    FilePath = tmp_path / "archive.zip"
+    FilePath.write_bytes(os.urandom(29 * MiB))
+    Journal = InterruptUpload(FilePath, monkeypatch)
+    Data = os.urandom(31 * MiB)
+    FilePath.write_bytes(Data)
+    ResumableUpload.ResumableUploadFile(FilePath)
+    assert Upload.S3.list_multipart_uploads(Bucket=Upload.R2_Bucket_Name).get("Uploads", []) == []
+    assert Upload.S3.get_object(Bucket=Upload.R2_Bucket_Name, Key="archive.zip")["Body"].read() == Data
+    with pytest.raises(Upload.S3.exceptions.NoSuchUpload):
+        Upload.S3.list_parts(Bucket=Upload.R2_Bucket_Name, Key="archive.zip", UploadId=Journal["UploadId"])
+
+def test_ResumeReuploadsPartsWhoseContentChanged(Bucket, RecordedParts, monkeypatch, tmp_path):
+    FilePath = tmp_path / "archive.zip"
+    Data = bytearray(os.urandom(29 * MiB))
+    FilePath.write_bytes(Data)
+    InterruptUpload(FilePath, monkeypatch)
+    # 改写第一个分块的内容，但保持文件大小和修改时间不变
+    Status = FilePath.stat()
+    Data[0:4] = b"XXXX"
+    FilePath.write_bytes(Data)
+    os.utime(FilePath, ns=(Status.st_atime_ns, Status.st_mtime_ns))
+    RecordedParts.clear()
+    ResumableUpload.ResumableUploadFile(FilePath)
+    assert 1 in {PartNumber for PartNumber, _ in RecordedParts}
+    assert Upload.S3.get_object(Bucket=Upload.R2_Bucket_Name, Key="archive.zip")["Body"].read() == bytes(Data)
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+import os
+from pathlib import Path
+import zipfile
+
+import pytest
+
+from Incremental import FileIndex, IncrementalZipDirectoryTree, IndexFileName, RestoreIncremental
+from Retention import BackupEntry, EnforceRetention, ParseRetentionPolicy, PlanRetention, RetentionPolicy, ScanBackupDirectory
+
+def MakeBackup(BackupRootDirectory: Path, Index: FileIndex, ArchiveName: str, SourceDirectory: Path, FullBackup: bool):
+    # 与Main.py相同的结构：来源目录先打包成WebsiteRoot.zip，再和其他文件一起打包成以时间命名的备份文件
+    WorkDirectory = BackupRootDirectory.parent / "Work"
+    WorkDirectory.mkdir(exist_ok=True)
+    SourceZip = WorkDirectory / "WebsiteRoot.zip"
+    IncrementalZipDirectoryTree(str(SourceZip), SourceDirectory, Index, ArchiveName, FullBackup, zipfile.ZIP_DEFLATED, ())
+    with zipfile.ZipFile(BackupRootDirectory / ArchiveName, "w", zipfile.ZIP_STORED) as Archive:
+        Archive.write(SourceZip, SourceZip.name)
+    Index.RecordBackup(ArchiveName, "full" if FullBackup else "incremental")
+
+def test_RetentionKeepsArchivesReferencedByIncrementals(tmp_path):
+    BackupRootDirectory = tmp_path / "Backup"
+    BackupRootDirectory.mkdir()
+    SourceDirectory = tmp_path / "www"
+    SourceDirectory.mkdir()
+    (SourceDirectory / "index.php").write_text("<?php echo 'unchanged';")
+    (SourceDirectory / "config.php").write_text("version 1")
+    Index = FileIndex(tmp_path / IndexFileName)
+    MakeBackup(BackupRootDirectory, Index, "2025-01-01 00-00-00.zip", SourceDirectory, FullBackup=True)
+    (SourceDirectory / "config.php").write_text("version 2, longer")
+    MakeBackup(BackupRootDirectory, Index, "2025-01-02 00-00-00.zip", SourceDirectory, FullBackup=False)
+    Index.Close()
+
+    Plan = EnforceRetention(BackupRootDirectory, RetentionPolicy(KeepLast=1))
+    assert sorted(Backup.Name for Backup, _ in Plan.Keep) == ["2025-01-01 00-00-00.zip", "2025-01-02 00-00-00.zip"]
+    assert Plan.Delete == []
+    assert (BackupRootDirectory / "2025-01-01 00-00-00.zip").exists()
+
+    OutputDirectory = tmp_path / "Restore"
+    RestoreIncremental(BackupRootDirectory, "2025-01-02 00-00-00.zip", "WebsiteRoot.zip", OutputDirectory)
+    assert (OutputDirectory / "index.php").read_text() == "<?php echo 'unchanged';"
+    assert (OutputDirectory / "config.php").read_text() == "version 2, longer"
+
+def test_PlanRetentionFollowsReferenceChains():
+    Backups = [BackupEntry(f"2025-01-0{Day} 00-00-00.zip", Path(f"2025-01-0{Day} 00-00-00.zip"), 100, datetime(2025, 1, Day), False) for Day in (4, 3, 2, 1)]
+    References = {"2025-01-04 00-00-00.zip": {"2025-01-03 00-00-00.zip"}, "2025-01-03 00-00-00.zip": {"2025-01-01 00-00-00.zip"}}
+    Plan = PlanRetention(Backups, RetentionPolicy(KeepLast=1), Now=datetime(2025, 1, 5), References=References)
+    assert sorted(Backup.Name for Backup, _ in Plan.Delete) == ["2025-01-02 00-00-00.zip"]
+    # 没有引用关系时只保留最新的一个
+    Plan = PlanRetention(Backups, RetentionPolicy(KeepLast=1), Now=datetime(2025, 1, 5))
+    assert len(Plan.Keep) == 1
+
+def test_ScanBackupDirectoryOnlyAttachesKnownCompanions(tmp_path):
+    (tmp_path / "2025-01-01 00-00-00.zip").write_bytes(b"x" * 100)
+    (tmp_path / "2025-01-01 00-00-00.zip.upload.json").write_bytes(b"{}")
+    # 打包中途失败留下的同名目录与备份文件是各自独立的条目
+    (tmp_path / "2025-01-02 00-00-00").mkdir()
+    (tmp_path / "2025-01-02 00-00-00" / "WebsiteRoot.zip").write_bytes(b"y" * 10)
+    (tmp_path / "2025-01-02 00-00-00.zip").write_bytes(b"z" * 200)
+    Backups = {Backup.Name: Backup for Backup in ScanBackupDirectory(tmp_path)}
+    assert set(Backups) == {"2025-01-01 00-00-00.zip", "2025-01-02 00-00-00", "2025-01-02 00-00-00.zip"}
+    assert Backups["2025-01-01 00-00-00.zip"].Size == 102
+    assert Backups["2025-01-02 00-00-00.zip"].Size == 200 and Backups["2025-01-02 00-00-00.zip"].Companions == []
+
+def test_RetentionArgumentsAreValidated(monkeypatch):
+    monkeypatch.setattr("sys.argv", ["Main.py", "--keep-daily=7", "--keep-within=12h"])
+    Policy = ParseRetentionPolicy(1024)
+    assert (Policy.KeepDaily, Policy.KeepWithin) == (7, timedelta(hours=12))
+    monkeypatch.setattr("sys.argv", ["Main.py", "--keep-within=30"])
+    assert ParseRetentionPolicy(1024).KeepWithin == timedelta(days=30)
+    for Argument in ("--keep-last=-1", "--keep-weekly=abc", "--keep-within=soon"):
+        monkeypatch.setattr("sys.argv", ["Main.py", Argument])
+        with pytest.raises(SystemExit):
+            ParseRetentionPolicy(1024)
@@ -0,0 +1,39 @@
+from threading import Lock
+import time
+
+from TaskScheduler import BackupTaskScheduler
+
+def test_LargestTaskStartsFirstAndFailuresAreCollected(tmp_path):
+    for Name, Size in (("small", 10), ("large", 1000), ("medium", 100)):
+        (tmp_path / Name).write_bytes(b"x" * Size)
+    Scheduler = BackupTaskScheduler({"cpu": 1, "io": 1}, None)
+    Started: list[str] = []
+    def Run(Name: str):
+        Started.append(Name)
+        if Name == "medium":
+            raise OSError("读取失败")
+    for Name in ("small", "large", "medium"):
+        Scheduler.Submit(Name, "cpu", tmp_path / Name, Run, Name)
+    # 大小未知的任务（例如数据库备份）排在所有已知大小的任务之前
+    Scheduler.Submit("database", "cpu", None, Run, "database")
+    FailedTasks = Scheduler.Wait()
+    assert Started == ["database", "large", "medium", "small"]
+    assert [(Task.Name, Task.Error) for Task in FailedTasks] == [("medium", "OSError: 读取失败")]
+
+def test_DestinationDeviceLimitsTasksWithoutSource(tmp_path):
+    Scheduler = BackupTaskScheduler({"cpu": 1, "io": 4}, 1, tmp_path / "Backup")
+    Running = 0
+    MaxRunning = 0
+    RunningLock = Lock()
+    def Run():
+        nonlocal Running, MaxRunning
+        with RunningLock:
+            Running += 1
+            MaxRunning = max(MaxRunning, Running)
+        time.sleep(0.05)
+        with RunningLock:
+            Running -= 1
+    for Name in ("MySQL", "PostgreSQL", "website"):
+        Scheduler.Submit(Name, "io", None, Run)
+    assert Scheduler.Wait() == []
+    assert MaxRunning == 1
@@ -0,0 +1,16 @@
+from TransferController import MaxPartCount, MinPartSize, TransferController
+
+def test_ChoosePartSizeRespectsLimits():
+    Controller = TransferController(8, 64 * 1024 * 1024)
+    assert Controller.ChoosePartSize(0) == 64 * 1024 * 1024
+    Controller.Configure(Adaptive=False, BandwidthLimit=1024 * 1024)
+    assert Controller.ChoosePartSize(0) == MinPartSize
+    # 分块数量不能超过上限，否则完成上传时会被拒绝
+    TotalSize = 1000 * 1024 ** 3
+    assert Controller.ChoosePartSize(TotalSize) * MaxPartCount >= TotalSize
+
+def test_ChoosePartSizeFollowsMeasuredRate():
+    Controller = TransferController(8, 64 * 1024 * 1024)
+    Controller.Configure(Adaptive=True, BandwidthLimit=0)
+    Controller.Rate = 4 * 1024 * 1024
+    assert Controller.ChoosePartSize(0) == 8 * 1024 * 1024
@@ -0,0 +1,47 @@
+import Upload
+
+def test_OptimizeStorageDeletesWholeChains(Bucket, monkeypatch):
+    for Key in ("2025-01-01 00-00-00.zip", "2025-01-02 00-00-00.zip", "2025-01-03 00-00-00.zip"):
+        Upload.S3.put_object(Bucket=Upload.R2_Bucket_Name, Key=Key, Body=b"x" * 100)
+    monkeypatch.setattr(Upload, "R2_Free_Space", 250)
+    # 第二个备份是引用第一个备份的增量备份，第三个是新的完整备份
+    Upload.ConfigureArchiveReferences({"2025-01-02 00-00-00.zip": {"2025-01-01 00-00-00.zip"}})
+    try:
+        Upload.OptimizeStorage(0)
+    finally:
+        Upload.ConfigureArchiveReferences({})
+    Remaining = [Object["Key"] for Object in Upload.S3.list_objects_v2(Bucket=Upload.R2_Bucket_Name).get("Contents", [])]
+    assert Remaining == ["2025-01-03 00-00-00.zip"]
+
+def test_OptimizeStorageLeavesChunkStoreAlone(Bucket, monkeypatch):
+    Upload.S3.put_object(Bucket=Upload.R2_Bucket_Name, Key="chunks/0001", Body=b"c" * 100)
+    Upload.S3.put_object(Bucket=Upload.R2_Bucket_Name, Key="manifests/old.zip.json", Body=b"{}")
+    Upload.S3.put_object(Bucket=Upload.R2_Bucket_Name, Key="2025-01-01 00-00-00.zip", Body=b"x" * 100)
+    monkeypatch.setattr(Upload, "R2_Free_Space", 150)
+    Upload.OptimizeStorage(0)
+    Remaining = {Object["Key"] for Object in Upload.S3.list_objects_v2(Bucket=Upload.R2_Bucket_Name).get("Contents", [])}
+    assert Remaining == {"chunks/0001", "manifests/old.zip.json"}
+
+def test_OptimizeStorageOnlyLogsDeletedKeys(Bucket, monkeypatch, caplog):
+    for Key in ("2025-01-01 00-00-00.zip", "2025-01-02 00-00-00.zip"):
+        Upload.S3.put_object(Bucket=Upload.R2_Bucket_Name, Key=Key, Body=b"x" * 100)
+    monkeypatch.setattr(Upload, "R2_Free_Space", 50)
+    OriginalDeleteObjects = Upload.S3.delete_objects
+    def PartiallyFailingDeleteObjects(**kwargs):
+        Response = OriginalDeleteObjects(Bucket=kwargs["Bucket"], Delete={"Objects": kwargs["Delete"]["Objects"][:1], "Quiet": True})
+        Response["Errors"] = [{"Key": Object["Key"], "Code": "AccessDenied", "Message": "denied"} for Object in kwargs["Delete"]["Objects"][1:]]
+        return Response
+    monkeypatch.setattr(Upload.S3, "delete_objects", PartiallyFailingDeleteObjects)
+    Upload.OptimizeStorage(0)
+    Deleted = [Record.getMessage() for Record in caplog.records if "已删除" in Record.getMessage()]
+    assert len(Deleted) == 1 and "2025-01-01 00-00-00.zip" in Deleted[0]
+
+def test_StreamingUploadKeepsItselfWhenSpaceIsTight(Bucket, monkeypatch):
+    Upload.S3.put_object(Bucket=Upload.R2_Bucket_Name, Key="2025-01-01 00-00-00.zip", Body=b"x" * 100)
+    Streaming = Upload.StreamingUpload("2025-01-02 00-00-00.zip", 100)
+    Streaming.write(b"y" * 300)
+    # 上传过程中空间变得紧张，上传完成后的清理只能删除旧备份，不能删除刚上传的备份
+    monkeypatch.setattr(Upload, "R2_Free_Space", 200)
+    Streaming.Complete()
+    Remaining = [Object["Key"] for Object in Upload.S3.list_objects_v2(Bucket=Upload.R2_Bucket_Name).get("Contents", [])]
+    assert Remaining == ["2025-01-02 00-00-00.zip"]